@@ -63,6 +63,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # first, to time the whole request
+    'utils.middleware.RequestMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -108,6 +110,22 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/2.2/topics/cache/
+# holds the versions of the response caches (utils.cache): with more than one process, use a
+# backend they share, e.g. django.core.cache.backends.memcached.MemcachedCache
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('CACHE_LOCATION', ''),
+    }
+}
+
+# seconds a process serves a response cache entry at most, so that it picks up the changes
+# saved by other processes even when the cache backend is not shared
+RESPONSE_CACHE_MAX_AGE = float(os.getenv('RESPONSE_CACHE_MAX_AGE', '300'))
+
+
 # Password validation
 # https://docs.djangoproject.com/en/2.2/ref/settings/#auth-password-validators
 
@@ -119,6 +137,11 @@ AUTH_PASSWORD_VALIDATORS = [
 ]
 
 TOKEN_PASSWORD_RESET_EXPIRED_AFTER = 60 * 60  # Seconds
+IDEMPOTENCY_KEY_TTL = timedelta(hours=int(os.getenv('IDEMPOTENCY_KEY_TTL_HOURS', '24')))
+# bearer token required to scrape /metrics/; without one, only these addresses may scrape it
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+METRICS_INTERNAL_IPS = [ip.strip() for ip in os.getenv('METRICS_INTERNAL_IPS', '127.0.0.1,::1').split(',')
+                        if ip.strip()]
 AUTH_USER_MODEL = 'users.User'
 
 JWT_AUTH = {
@@ -185,4 +208,19 @@ QUEUE_SERVER = os.getenv('ORDER_QUEUE_SERVER', 'localhost:5672')
 QUEUE_USER = os.getenv('ORDER_QUEUE_USER', 'rabbituser')
 QUEUE_PASSWORD = os.getenv('ORDER_QUEUE_PASSWORD', 'rabbitpassword')
 
-EMAIL_NOTIF_QUEUE_NAME = os.getenv('EMAIL_NOTIF_QUEUE_NAME', 'emailnotifqueue')
\ No newline at end of file
+EMAIL_NOTIF_QUEUE_NAME = os.getenv('EMAIL_NOTIF_QUEUE_NAME', 'emailnotifqueue')
+
+# How case notifications are handed over (see sms.queue):
+# 'outbox' queues them in the database, for the `drain_notification_outbox` command;
+# 'amqp' publishes them to EMAIL_NOTIF_QUEUE_NAME, for the `email_notification_subscribe` worker
+NOTIFICATION_BACKEND = os.getenv('NOTIFICATION_BACKEND', 'outbox')
+NOTIFICATION_BROKER_URL = os.getenv('NOTIFICATION_BROKER_URL',
+                                    f'amqp://{QUEUE_USER}:{QUEUE_PASSWORD}@{QUEUE_SERVER}//')
+NOTIFICATION_CONFIRM_TIMEOUT = float(os.getenv('NOTIFICATION_CONFIRM_TIMEOUT', '5'))
+# notifications the broker could not take, until `replay_notification_spill` publishes them
+NOTIFICATION_SPILL_PATH = os.getenv('NOTIFICATION_SPILL_PATH',
+                                    os.path.join(BASE_DIR, 'var', 'notification-spill.ndjson'))
+# seconds before each new attempt at a notification the worker failed to send; once they are
+# used up it goes to the dead letter queue, for `notification_dead_letters`
+NOTIFICATION_RETRY_DELAYS = [float(delay) for delay in os.getenv('NOTIFICATION_RETRY_DELAYS', '30,120,600,3600')
+                             .split(',')]
@@ -3,6 +3,7 @@ from django.contrib import admin
 from django.urls import path, include
 
 from users.views import obtain_jwt_token
+from utils.metrics import metrics_view
 
 urlpatterns = [
     path('admin/', admin.site.urls),
@@ -13,4 +14,6 @@ urlpatterns = [
     path('', include('users.urls')),
     path('', include('masterdata.urls')),
 
+    path('metrics/', metrics_view, name='metrics'),
+
 ]
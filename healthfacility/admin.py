@@ -7,4 +7,8 @@ class HealthFacilityAdmin(admin.ModelAdmin):
     search_fields = ('name', 'code',)
     list_display = ('name', 'code', 'facility_level', 'linked_facility')
 
+    def get_queryset(self, request):
+        # inactive facilities too
+        return models.HealthFacility.all_objects.all()
+
 
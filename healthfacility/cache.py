@@ -0,0 +1,4 @@
+from utils.cache import VersionedResponseCache
+
+# health facility data, invalidated whenever a facility is saved (see healthfacility.models)
+facility_cache = VersionedResponseCache('healthfacility')
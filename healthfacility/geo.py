@@ -0,0 +1,166 @@
+"""
+Facility Locations
+==================
+
+An in-process spatial index over the coordinates of the active health facilities.
+
+Facilities are kept in a k-d tree over their positions as points on the unit sphere
+(x, y, z), where the straight-line (chord) distance grows with the great-circle distance,
+so the usual k-d tree pruning applies as is: no special cases at the poles or across the
+antimeridian, and clustered facilities (a city with hundreds of clinics) are split as
+finely as they need.  A k-nearest lookup visits a few dozen nodes.  Distances are
+great-circle distances in kilometres.
+
+Facilities at 0, 0 (the default of `HealthFacility.latitude`/`longitude`) have no known
+location and are left out.  The index is kept for as long as the version of
+`healthfacility.cache.facility_cache` does not change, i.e. until a facility is saved;
+it is then rebuilt in the background, the previous one being served in the meantime.
+"""
+import heapq
+import logging
+import math
+import threading
+from collections import namedtuple
+
+from django.db import connection
+
+from healthfacility.cache import facility_cache
+from healthfacility.models import HealthFacility
+
+logger = logging.getLogger(__name__)
+
+EARTH_RADIUS_KM = 6371.0088
+
+LEAF_SIZE = 16
+
+FacilityLocation = namedtuple(
+    'FacilityLocation', ['id', 'name', 'code', 'level', 'address', 'latitude', 'longitude']
+)
+
+
+def to_unit_vector(latitude: float, longitude: float) -> tuple:
+    lat, lon = math.radians(latitude), math.radians(longitude)
+    return math.cos(lat) * math.cos(lon), math.cos(lat) * math.sin(lon), math.sin(lat)
+
+
+def chord_to_km(chord: float) -> float:
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, chord / 2))
+
+
+def km_to_chord(km: float) -> float:
+    return 2 * math.sin(min(km / (2 * EARTH_RADIUS_KM), math.pi / 2))
+
+
+class FacilityIndex(object):
+
+    def __init__(self, facilities: list):
+        self.facilities = facilities
+        points = [(to_unit_vector(f.latitude, f.longitude), f) for f in facilities]
+        self.root = self._build(points) if points else None
+
+    @classmethod
+    def build(cls) -> 'FacilityIndex':
+        rows = HealthFacility.objects \
+            .exclude(latitude=0, longitude=0) \
+            .values_list('id', 'name', 'code', 'facility_level', 'address', 'latitude', 'longitude')
+        return cls([
+            FacilityLocation(id, name, code, level, address, float(latitude), float(longitude))
+            for id, name, code, level, address, latitude, longitude in rows
+        ])
+
+    def _build(self, points: list):
+        """ A leaf is a list of (point, facility) pairs, a node an (axis, split, left, right)
+        tuple: the points of `left` are <= split on that axis, the ones of `right` >= split.
+        """
+        if len(points) <= LEAF_SIZE:
+            return points
+        # split on the axis with the widest spread
+        axis = max(range(3), key=lambda i: max(p[i] for p, _ in points) - min(p[i] for p, _ in points))
+        points.sort(key=lambda item: item[0][axis])
+        middle = len(points) // 2
+        return axis, points[middle][0][axis], self._build(points[:middle]), self._build(points[middle:])
+
+    def nearest(self, latitude: float, longitude: float, k: int=5, max_distance: float=None,
+                predicate=None) -> list:
+        """ The `k` facilities nearest to a point, nearest first, as (distance, facility) pairs.
+
+        :param max_distance: leave out the facilities further than this many kilometres
+        :param predicate: leave out the facilities for which `predicate(facility)` is false
+        """
+        if self.root is None or k < 1:
+            return []
+        query = to_unit_vector(latitude, longitude)
+        limit = km_to_chord(max_distance) ** 2 if max_distance is not None else math.inf
+
+        # max-heap (negated squared chords) of the best k so far
+        best = []
+        # nodes to visit, each with a lower bound of the distance to its points
+        stack = [(self.root, 0.0)]
+        while stack:
+            node, min_distance = stack.pop()
+            bound = -best[0][0] if len(best) == k else limit
+            if min_distance > bound:
+                continue
+            if isinstance(node, list):
+                for point, f in node:
+                    distance = (point[0] - query[0]) ** 2 + (point[1] - query[1]) ** 2 + (point[2] - query[2]) ** 2
+                    if distance > bound or (predicate is not None and not predicate(f)):
+                        continue
+                    if len(best) < k:
+                        heapq.heappush(best, (-distance, f.id, f))
+                    elif distance < -best[0][0]:
+                        heapq.heapreplace(best, (-distance, f.id, f))
+                    bound = -best[0][0] if len(best) == k else limit
+                continue
+
+            axis, split, left, right = node
+            diff = query[axis] - split
+            near, far = (left, right) if diff < 0 else (right, left)
+            # the far side is at least |diff| away; it is pushed first, to be visited last
+            stack.append((far, max(min_distance, diff * diff)))
+            stack.append((near, min_distance))
+
+        return [(chord_to_km(math.sqrt(-distance)), f) for distance, _, f in sorted(best, reverse=True)]
+
+
+_index = None
+_index_version = None
+_index_lock = threading.Lock()
+_index_rebuilding = False
+
+
+def get_facility_index() -> FacilityIndex:
+    """ The location index of the active facilities.
+
+    The first call builds it; after that, once a facility is saved (or the index is older
+    than `settings.RESPONSE_CACHE_MAX_AGE`), the previous index keeps being served while a
+    new one is built in a background thread.
+    """
+    global _index, _index_version, _index_rebuilding
+    version = facility_cache.get_generation()
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = FacilityIndex.build()
+                _index_version = version
+    elif _index_version != version and not _index_rebuilding:
+        with _index_lock:
+            if _index_version != version and not _index_rebuilding:
+                _index_rebuilding = True
+                threading.Thread(target=_rebuild_facility_index, args=(version,), daemon=True).start()
+    return _index
+
+
+def _rebuild_facility_index(version):
+    global _index, _index_version, _index_rebuilding
+    try:
+        index = FacilityIndex.build()
+        with _index_lock:
+            _index = index
+            _index_version = version
+    except Exception:
+        logger.exception('Could not rebuild the facility location index')
+    finally:
+        _index_rebuilding = False
+        # the thread's own database connection
+        connection.close()
@@ -0,0 +1,15 @@
+from django.core.management import BaseCommand
+
+from healthfacility.cache import facility_cache
+from healthfacility.models import FacilityReferral
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the facility referral closure from linked_facility, ' \
+           'after facilities were written without save().'
+
+    def handle(self, *args, **options):
+        rows = FacilityReferral.objects.rebuild()
+        # reaches running servers through a shared cache backend, or after RESPONSE_CACHE_MAX_AGE
+        facility_cache.invalidate()
+        self.stdout.write(f'Rebuilt {rows} facility referral row(s)')
@@ -0,0 +1,17 @@
+# Generated by Django 2.0.2 on 2026-10-18 19:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('healthfacility', '0002_auto_20190916_1018'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='healthfacility',
+            index=models.Index(fields=['name', 'id'], name='facility_name_idx'),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 2.0.2 on 2026-10-18 19:09
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+# the closure of the existing referral links, see FacilityReferralQuerySet.rebuild()
+POPULATE_REFERRALS_SQL = """
+    WITH RECURSIVE chain (ancestor_id, descendant_id, depth, path) AS (
+        SELECT id, id, 0, ARRAY[id] FROM health_facility
+        UNION ALL
+        SELECT f.linked_facility_id, chain.descendant_id, chain.depth + 1, chain.path || f.linked_facility_id
+        FROM chain JOIN health_facility f ON f.id = chain.ancestor_id
+        WHERE f.linked_facility_id IS NOT NULL AND NOT f.linked_facility_id = ANY(chain.path)
+    )
+    INSERT INTO health_facility_referral (ancestor_id, descendant_id, depth)
+    SELECT ancestor_id, descendant_id, depth FROM chain
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('healthfacility', '0003_facility_name_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FacilityReferral',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.PositiveIntegerField()),
+                ('ancestor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='descendant_referrals', to='healthfacility.HealthFacility')),
+                ('descendant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ancestor_referrals', to='healthfacility.HealthFacility')),
+            ],
+            options={
+                'db_table': 'health_facility_referral',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='facilityreferral',
+            index=models.Index(fields=['descendant', 'depth'], name='referral_descendant_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='facilityreferral',
+            unique_together={('ancestor', 'descendant')},
+        ),
+        migrations.RunSQL(POPULATE_REFERRALS_SQL, migrations.RunSQL.noop),
+    ]
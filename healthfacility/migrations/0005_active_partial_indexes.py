@@ -0,0 +1,23 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    """ Indexes of the active facilities only, the ones `HealthFacility.objects` returns.
+    """
+
+    dependencies = [
+        ('healthfacility', '0004_facility_referral'),
+    ]
+
+    operations = [
+        # sub-district fan-out of the case routing
+        migrations.RunSQL(
+            'CREATE INDEX facility_active_sub_district_idx ON health_facility (sub_district_id) WHERE is_active',
+            'DROP INDEX facility_active_sub_district_idx',
+        ),
+        # default listing of the facility directory
+        migrations.RunSQL(
+            'CREATE INDEX facility_active_name_idx ON health_facility (name, id) WHERE is_active',
+            'DROP INDEX facility_active_name_idx',
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 2.0.2 on 2026-10-18 19:58
+
+from django.db import migrations
+import django.db.models.manager
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('healthfacility', '0005_active_partial_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='healthfacility',
+            options={'default_manager_name': 'all_objects'},
+        ),
+        migrations.AlterModelManagers(
+            name='healthfacility',
+            managers=[
+                ('all_objects', django.db.models.manager.Manager()),
+            ],
+        ),
+    ]
@@ -1,7 +1,13 @@
-from django.db import models, router
+from django.core.exceptions import ValidationError
+from django.db import models, router, connections, transaction
+from django.db.models.signals import post_save, post_delete, pre_delete
+from django.dispatch import receiver
 from django.urls import reverse
 
+from healthfacility.cache import facility_cache
+
 from masterdata.models import Province, City, District, SubDistrict
+from utils.models import ActiveManager
 
 HEALTHFACILITY_TYPE_DISTRICT = '3'
 HEALTHFACILITY_TYPE_HEALTH_CENTER = '2'
@@ -59,11 +65,59 @@ class HealthFacility(models.Model):
         null=True
     )
 
+    # active facilities only, see utils.models.ActiveManager
+    objects = ActiveManager()
+    all_objects = models.Manager()
+
     def __str__(self):
         return f'{self.name} - {self.code}'
 
+    def clean(self):
+        self.check_referral_cycle()
+
+    def save(self, *args, **kwargs):
+        """ Saves the facility, and moves its referral subtree along when `linked_facility` changes.
+        """
+        self.check_referral_cycle()
+        using = kwargs.get('using') or router.db_for_write(self.__class__, instance=self)
+        with transaction.atomic(using=using):
+            relink = self._state.adding or \
+                FacilityReferral.objects.using(using).get_parent_id(self.pk) != self.linked_facility_id
+            super().save(*args, **kwargs)
+            if relink:
+                FacilityReferral.objects.using(using).relink(self)
+
+    def check_referral_cycle(self):
+        """ Refuses a `linked_facility` that is the facility itself, or one it refers cases to.
+        """
+        if self.linked_facility_id is None or self.pk is None:
+            return
+        if self.linked_facility_id == self.pk or \
+                FacilityReferral.objects.filter(ancestor_id=self.pk, descendant_id=self.linked_facility_id).exists():
+            raise ValidationError({
+                'linked_facility': f'Linking to facility {self.linked_facility_id} would make a referral cycle.'
+            })
+
+    def get_referral_chain(self):
+        """ The facilities this one escalates to, nearest first.
+        """
+        return HealthFacility.objects \
+            .filter(descendant_referrals__descendant=self, descendant_referrals__depth__gt=0) \
+            .order_by('descendant_referrals__depth')
+
+    def get_referral_subtree(self):
+        """ Every facility that refers to this one, directly or not.
+        """
+        return HealthFacility.objects.filter(ancestor_referrals__ancestor=self, ancestor_referrals__depth__gt=0)
+
     class Meta:
         db_table = 'health_facility'
+        # `objects` hides the deactivated facilities; dumpdata, the admin and the like see them all
+        default_manager_name = 'all_objects'
+        indexes = [
+            # the directory is listed by name
+            models.Index(fields=['name', 'id'], name='facility_name_idx'),
+        ]
 
     # def get_absolute_url(self):
     #     return reverse('product:warehouse:details', kwargs={'slug': self.slug})
@@ -77,4 +131,102 @@ class HealthFacility(models.Model):
         """
         using = using or router.db_for_write(self.__class__, instance=self)
         self.is_active = False
-        return self.save(using=using)
\ No newline at end of file
+        return self.save(using=using)
+
+
+@receiver(post_save, sender=HealthFacility)
+@receiver(post_delete, sender=HealthFacility)
+def invalidate_facility_cache(sender, **kwargs):
+    facility_cache.invalidate(using=kwargs.get('using'))
+
+
+class FacilityReferralQuerySet(models.QuerySet):
+
+    def get_parent_id(self, facility_id):
+        if facility_id is None:
+            return None
+        return self.filter(descendant_id=facility_id, depth=1).values_list('ancestor_id', flat=True).first()
+
+    def relink(self, facility: HealthFacility):
+        """ Moves the subtree of a facility under its current `linked_facility`.
+        """
+        with connections[self.db].cursor() as cursor:
+            cursor.execute(
+                'INSERT INTO health_facility_referral (ancestor_id, descendant_id, depth) VALUES (%s, %s, 0) '
+                'ON CONFLICT DO NOTHING',
+                [facility.pk, facility.pk]
+            )
+            self._detach(cursor, facility.pk)
+            if facility.linked_facility_id is not None:
+                cursor.execute(
+                    'INSERT INTO health_facility_referral (ancestor_id, descendant_id, depth) '
+                    'SELECT a.ancestor_id, d.descendant_id, a.depth + d.depth + 1 '
+                    'FROM health_facility_referral a, health_facility_referral d '
+                    'WHERE a.descendant_id = %s AND d.ancestor_id = %s',
+                    [facility.linked_facility_id, facility.pk]
+                )
+
+    def detach(self, facility: HealthFacility):
+        """ Unlinks the subtree of a facility from the facilities above it.
+        """
+        with connections[self.db].cursor() as cursor:
+            self._detach(cursor, facility.pk)
+
+    @staticmethod
+    def _detach(cursor, facility_id):
+        cursor.execute(
+            'DELETE FROM health_facility_referral '
+            'WHERE descendant_id IN (SELECT descendant_id FROM health_facility_referral WHERE ancestor_id = %s) '
+            'AND ancestor_id IN (SELECT ancestor_id FROM health_facility_referral WHERE descendant_id = %s AND depth > 0)',
+            [facility_id, facility_id]
+        )
+
+    def rebuild(self) -> int:
+        """ Recomputes the whole table from `linked_facility`, for when facilities were written
+        without `save()` (`update()`, `bulk_create()`, raw SQL...).  A chain that loops back on
+        itself is cut where it would repeat a facility.
+        """
+        with transaction.atomic(using=self.db), connections[self.db].cursor() as cursor:
+            cursor.execute('DELETE FROM health_facility_referral')
+            cursor.execute(REBUILD_REFERRALS_SQL)
+            return cursor.rowcount
+
+
+REBUILD_REFERRALS_SQL = """
+    WITH RECURSIVE chain (ancestor_id, descendant_id, depth, path) AS (
+        SELECT id, id, 0, ARRAY[id] FROM health_facility
+        UNION ALL
+        SELECT f.linked_facility_id, chain.descendant_id, chain.depth + 1, chain.path || f.linked_facility_id
+        FROM chain JOIN health_facility f ON f.id = chain.ancestor_id
+        WHERE f.linked_facility_id IS NOT NULL AND NOT f.linked_facility_id = ANY(chain.path)
+    )
+    INSERT INTO health_facility_referral (ancestor_id, descendant_id, depth)
+    SELECT ancestor_id, descendant_id, depth FROM chain
+"""
+
+
+class FacilityReferral(models.Model):
+    """ The transitive closure of `HealthFacility.linked_facility`: one row for every facility
+    and every facility it escalates to, directly or not (plus the facility itself, at depth 0).
+
+    Kept up to date by `HealthFacility.save()`, so that the whole referral chain of a
+    facility, or everything under a district office, is a single indexed lookup.
+    """
+    ancestor = models.ForeignKey(HealthFacility, on_delete=models.CASCADE, related_name='descendant_referrals')
+    descendant = models.ForeignKey(HealthFacility, on_delete=models.CASCADE, related_name='ancestor_referrals')
+    depth = models.PositiveIntegerField()
+
+    objects = FacilityReferralQuerySet.as_manager()
+
+    class Meta:
+        db_table = 'health_facility_referral'
+        unique_together = ('ancestor', 'descendant')
+        indexes = [
+            models.Index(fields=['descendant', 'depth'], name='referral_descendant_idx'),
+        ]
+
+
+@receiver(pre_delete, sender=HealthFacility)
+def detach_facility_referrals(sender, instance, using, **kwargs):
+    # the rows of the facility itself go with it, the ones of its subtree stay
+    FacilityReferral.objects.using(using).detach(instance)
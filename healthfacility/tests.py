@@ -1,3 +1,57 @@
+from unittest import mock
+
 from django.test import TestCase
+from django.urls import reverse
+from rest_framework.test import APIClient
+
+from healthfacility import geo
+from healthfacility.cache import facility_cache
+from healthfacility.models import HealthFacility
+from users.models import User
+
+
+class FacilityIndexTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        HealthFacility.objects.create(name='Puskesmas Nusaniwe', code='P01', latitude=-3.71, longitude=128.16)
+
+    @mock.patch.multiple(geo, _index=None, _index_version=None)
+    def test_previous_index_is_served_while_rebuilding(self):
+        index = geo.get_facility_index()
+        HealthFacility.objects.create(name='RSUD Haulussy', code='R01', latitude=-3.70, longitude=128.18)
+        with mock.patch.object(geo, 'threading') as threading, \
+                mock.patch.object(facility_cache, 'get_generation', return_value=(0, 0)):
+            thread = threading.Thread
+            self.assertIs(geo.get_facility_index(), index)
+            self.assertIs(geo.get_facility_index(), index)
+            self.assertEqual(len(index.nearest(-3.7, 128.17, k=5)), 1)
+            self.assertEqual(thread.call_count, 1)
+
+            # what the thread runs, minus closing the test connection
+            with mock.patch.object(geo, 'connection'):
+                thread.call_args[1]['target'](*thread.call_args[1]['args'])
+            rebuilt = geo.get_facility_index()
+            self.assertIsNot(rebuilt, index)
+            self.assertEqual(len(rebuilt.nearest(-3.7, 128.17, k=5)), 2)
+            self.assertEqual(thread.call_count, 1)
+
+
+class HealthFacilityNearestAPITest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(email='petugas@pustu.test', password='secret', phone_number='0811')
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
 
-# Create your tests here.
+    def test_radius_must_be_positive(self):
+        url = reverse('health_facility_nearest')
+        for radius in ('-5', '0', 'nan', 'inf'):
+            response = self.client.get(url, {'latitude': '-3.7', 'longitude': '128.17', 'radius': radius})
+            self.assertEqual(response.status_code, 400, radius)
+            self.assertIn('radius', response.json())
+        response = self.client.get(url, {'latitude': '-3.7', 'longitude': '128.17', 'radius': '5'})
+        self.assertEqual(response.status_code, 200)
@@ -1,7 +1,8 @@
 from django.urls import path
 
-from healthfacility.views import HealthFacilityListAPI
+from healthfacility.views import HealthFacilityListAPI, HealthFacilityNearestAPI
 
 urlpatterns = [
     path('health-facility-list/', HealthFacilityListAPI.as_view(), name='health_facility_list'),
+    path('health-facility-nearest/', HealthFacilityNearestAPI.as_view(), name='health_facility_nearest'),
 ]
\ No newline at end of file
@@ -1,31 +1,170 @@
-from django.http import JsonResponse
+import math
+
+from rest_framework.exceptions import ValidationError
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.views import APIView
 
-from healthfacility.models import HealthFacility
+from healthfacility.cache import facility_cache
+from healthfacility.geo import get_facility_index
+from healthfacility.models import HealthFacility, HEALTHFACILITY_TYPES
+from sms.models import CaseInformation
+from utils.cache import CachedResponse, cached_response
+from utils.drf import KeysetLinkHeaderPagination, convert_env_boolean
+from utils.http import JsonResponse
 
 
 class HealthFacilityListAPI(APIView):
+    """ The health facility directory.
+
+    Facilities are listed by name, paginated with an opaque cursor (see
+    `utils.drf.KeysetLinkHeaderPagination`, the next page is linked from the Link header),
+    and can be filtered by `province`, `city`, `district`, `sub_district`, `level` and
+    `is_active` (only the active ones are listed by default); `under` lists the facilities
+    referring to a facility, directly or not.  Each page is built in one query and kept,
+    serialized, in `healthfacility.cache.facility_cache` until a facility is saved.
+    """
     permission_classes = (IsAuthenticated,)
+    pagination_class = KeysetLinkHeaderPagination
+    ordering = ('name', 'id')
+    page_size = 100
+    region_filters = ('province', 'city', 'district', 'sub_district')
 
     def get(self, request):
         """ Gets all health facility exists.
         """
-        healthfacility = HealthFacility.objects.all()
+        queryset = self.filter_queryset(request, self.get_base_queryset(request))
+        entry = facility_cache.get(
+            f'{self.__class__.__name__}:{request.get_full_path()}:{request.get_host()}',
+            lambda: self.build(request, queryset)
+        )
+        return cached_response(request, entry)
+
+    def get_base_queryset(self, request):
+        """ The active facilities, unless `is_active` asks otherwise.
+        """
+        is_active = request.GET.get('is_active')
+        if is_active:
+            return HealthFacility.all_objects.filter(is_active=convert_env_boolean(is_active))
+        return HealthFacility.objects.all()
+
+    def filter_queryset(self, request, queryset):
+        for param in self.region_filters:
+            value = request.GET.get(param)
+            if value:
+                if not value.isdigit():
+                    raise ValidationError({param: ['A valid integer is required.']})
+                queryset = queryset.filter(**{f'{param}_id': int(value)})
+
+        level = request.GET.get('level')
+        if level:
+            if level not in dict(HEALTHFACILITY_TYPES):
+                raise ValidationError({'level': [f'"{level}" is not a valid facility level.']})
+            queryset = queryset.filter(facility_level=level)
 
-        healthfacility = healthfacility[:100]
+        under = request.GET.get('under')
+        if under:
+            if not under.isdigit():
+                raise ValidationError({'under': ['A valid integer is required.']})
+            queryset = queryset.filter(ancestor_referrals__ancestor_id=int(under), ancestor_referrals__depth__gt=0)
+        return queryset
+
+    def build(self, request, queryset) -> CachedResponse:
+        paginator = self.pagination_class(ordering=self.ordering, page_size=self.page_size)
+        healthfacility = paginator.paginate_queryset(
+            queryset
+            .select_related('linked_facility')
+            .only(
+                'id', 'name', 'code', 'facility_level', 'address', 'is_active',
+                'linked_facility__id', 'linked_facility__name'
+            ),
+            request
+        )
 
         resp_json = []
         for h in healthfacility:
             resp_json.append({
+                'id': h.id,
                 'name': h.name,
                 'code': h.code,
                 'level': h.facility_level,
                 'address': h.address,
+                'isActive': h.is_active,
                 'linked': h.linked_facility.name if h.linked_facility else ''
                 # 'href': request.build_absolute_uri(
                 #     reverse('shipping_details', kwargs={'warehouse': warehouse, 'pk': s.id})
                 # ),
             })
 
-        return JsonResponse(resp_json, safe=False)
\ No newline at end of file
+        return CachedResponse.from_json(resp_json, headers=paginator.get_paginated_headers())
+
+
+class HealthFacilityNearestAPI(APIView):
+    """ The active facilities nearest to a location, nearest first.
+
+    The location is either given by `latitude` and `longitude`, or taken from the case
+    `case`.  `k` (default 5, at most 50) is the number of facilities, `level` restricts them
+    to one facility level and `radius` (km) leaves out the ones further away.
+    """
+    permission_classes = (IsAuthenticated,)
+    default_k = 5
+    max_k = 50
+
+    def get(self, request):
+        latitude, longitude = self.get_location(request)
+        k = min(max(self.get_number(request, 'k', int, self.default_k), 1), self.max_k)
+        radius = self.get_number(request, 'radius', float, None)
+        if radius is not None and not (math.isfinite(radius) and radius > 0):
+            raise ValidationError({'radius': ['Ensure this value is a number greater than 0.']})
+
+        level = request.GET.get('level') or None
+        if level is not None and level not in dict(HEALTHFACILITY_TYPES):
+            raise ValidationError({'level': [f'"{level}" is not a valid facility level.']})
+
+        resp_json = []
+        nearest = get_facility_index().nearest(
+            latitude, longitude, k=k, max_distance=radius,
+            predicate=(lambda f: f.level == level) if level else None
+        )
+        for distance, f in nearest:
+            resp_json.append({
+                'id': f.id,
+                'name': f.name,
+                'code': f.code,
+                'level': f.level,
+                'address': f.address,
+                'latitude': f.latitude,
+                'longitude': f.longitude,
+                'distance': round(distance, 3),
+            })
+
+        return JsonResponse(resp_json, safe=False)
+
+    def get_location(self, request) -> tuple:
+        if request.GET.get('case'):
+            case_id = self.get_number(request, 'case', int, None)
+            location = CaseInformation.objects.filter(pk=case_id).values_list('latitude', 'longitude').first()
+            if location is None:
+                raise ValidationError({'case': [f'Case "{case_id}" does not exist.']})
+            if not any(location):
+                raise ValidationError({'case': [f'Case "{case_id}" has no location.']})
+            return float(location[0]), float(location[1])
+
+        latitude = self.get_number(request, 'latitude', float, None)
+        longitude = self.get_number(request, 'longitude', float, None)
+        if latitude is None or longitude is None:
+            raise ValidationError({'latitude': ['A location (latitude and longitude) or a case is required.']})
+        if not -90 <= latitude <= 90:
+            raise ValidationError({'latitude': ['Ensure this value is between -90 and 90.']})
+        if not -180 <= longitude <= 180:
+            raise ValidationError({'longitude': ['Ensure this value is between -180 and 180.']})
+        return latitude, longitude
+
+    @staticmethod
+    def get_number(request, param: str, type_, default):
+        value = request.GET.get(param)
+        if value in (None, ''):
+            return default
+        try:
+            return type_(value)
+        except ValueError:
+            raise ValidationError({param: ['A valid number is required.']})
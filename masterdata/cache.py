@@ -0,0 +1,4 @@
+from utils.cache import VersionedResponseCache
+
+# serialized region lists, invalidated whenever a region is saved (see masterdata.models)
+region_cache = VersionedResponseCache('masterdata')
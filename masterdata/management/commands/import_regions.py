@@ -0,0 +1,361 @@
+import csv
+import os
+import time
+from collections import OrderedDict
+from datetime import date, datetime
+
+import yaml
+from yaml.constructor import SafeConstructor
+from yaml.nodes import ScalarNode
+from django.core.management import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from masterdata.cache import region_cache
+from masterdata.search import REGION_LEVELS, LEVEL_ORDER
+
+LEVEL_BY_MODEL = {model._meta.label_lower: level for level, model, _ in REGION_LEVELS}
+
+
+class Command(BaseCommand):
+    help = '''Imports provinces, cities, districts and sub districts from a YAML fixture or a CSV file.
+
+    The file is streamed and the regions are upserted in bulk batches: a region whose code
+    (or, without a code, whose pk) already exists is updated, any other one is inserted.
+
+    YAML files are read in the `loaddata` fixture format (see masterdata/fixtures/master_ambon.yaml);
+    a region may name its parent by pk (`province_id`, `city_id`, `district_id`) or by `parent_code`.
+    CSV files have the columns level, code, name, parent_code, and optionally id, is_active and created.
+    Inserted regions keep the `created` time of the file, if any.
+    '''
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='YAML fixture or CSV file.')
+        parser.add_argument('--format', choices=('yaml', 'csv'),
+                            help='File format, guessed from the file extension by default.')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Regions written per batch.')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        file_format = options['format'] or os.path.splitext(path)[1].lstrip('.').lower()
+        if file_format == 'yml':
+            file_format = 'yaml'
+        if file_format not in ('yaml', 'csv'):
+            raise CommandError(f'Unknown region file format "{file_format}", use --format.')
+
+        started = time.perf_counter()
+        importer = RegionImporter(batch_size=options['batch_size'])
+        with open(path, encoding='utf-8', newline='' if file_format == 'csv' else None) as stream, \
+                transaction.atomic():
+            rows = read_csv_regions(stream) if file_format == 'csv' else read_yaml_regions(stream)
+            for row in rows:
+                importer.add(row)
+            importer.flush()
+            importer.reset_sequences()
+
+        # bulk writes don't send post_save; running servers get the new version through a shared
+        # cache backend, or rebuild their entries after RESPONSE_CACHE_MAX_AGE (see utils.cache)
+        region_cache.invalidate()
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(
+            f'{importer.read} region(s) read: {importer.inserted} inserted, {importer.updated} updated, '
+            f'{importer.unchanged} unchanged in {elapsed:.2f}s ({importer.read / elapsed:.0f} rows/s)'
+        )
+
+
+def read_yaml_regions(stream):
+    """ Yields the regions of a fixture one by one, without loading the whole document.
+    """
+    for number, item in enumerate(iter_yaml_items(stream), start=1):
+        if not isinstance(item, dict):
+            raise CommandError(f'Item {number}: a region must be an object.')
+        level = LEVEL_BY_MODEL.get(str(item.get('model', '')).lower())
+        if level is None:
+            raise CommandError(f'Item {number}: "{item.get("model")}" is not a region model.')
+
+        fields = item.get('fields') or {}
+        parent_field = REGION_LEVELS[LEVEL_ORDER[level]][2]
+        parent_pk = None
+        if parent_field:
+            parent_pk = fields.get(parent_field, fields.get(parent_field[:-len('_id')]))
+        yield RegionRow(
+            number=number,
+            level=level,
+            pk=item.get('pk'),
+            code=fields.get('code'),
+            name=fields.get('name'),
+            is_active=fields.get('is_active', True),
+            created=fields.get('created'),
+            parent_pk=parent_pk,
+            parent_code=fields.get('parent_code'),
+        )
+
+
+def iter_yaml_items(stream):
+    """ Yields the items of a top-level YAML list as they are parsed.
+
+    The items are built straight from the parser events, so the LibYAML parser can be used
+    (it can't compose one node at a time); anchors and aliases are not supported.
+    """
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)(stream)
+    try:
+        loader.get_event()  # stream start
+        if loader.check_event(yaml.StreamEndEvent):
+            return
+        loader.get_event()  # document start
+        if not loader.check_event(yaml.SequenceStartEvent):
+            raise CommandError('A region fixture must be a list of objects.')
+        loader.get_event()
+
+        # containers being built, each with the key waiting for its value (mappings only)
+        stack = []
+        while True:
+            event = loader.get_event()
+            if isinstance(event, yaml.MappingStartEvent):
+                stack.append(({}, [None]))
+                continue
+            elif isinstance(event, yaml.SequenceStartEvent):
+                stack.append(([], None))
+                continue
+            elif isinstance(event, (yaml.MappingEndEvent, yaml.SequenceEndEvent)):
+                if not stack:
+                    return
+                value, _ = stack.pop()
+            elif isinstance(event, yaml.ScalarEvent):
+                tag = event.tag
+                if tag in (None, '!'):
+                    tag = loader.resolve(ScalarNode, event.value, event.implicit)
+                node = ScalarNode(tag, event.value, style=event.style)
+                value = loader.yaml_constructors.get(tag, SafeConstructor.construct_undefined)(loader, node)
+            elif isinstance(event, yaml.AliasEvent):
+                raise CommandError('Region fixtures cannot use YAML aliases.')
+            else:
+                continue
+
+            if not stack:
+                yield value
+                continue
+            container, key = stack[-1]
+            if key is None:
+                container.append(value)
+            elif key[0] is None:
+                key[0] = value
+            else:
+                container[key[0]] = value
+                key[0] = None
+    finally:
+        loader.dispose()
+
+
+def read_csv_regions(stream):
+    for number, record in enumerate(csv.DictReader(stream), start=1):
+        level = (record.get('level') or '').strip()
+        if level not in LEVEL_ORDER:
+            raise CommandError(f'Row {number}: "{level}" is not a region level.')
+        yield RegionRow(
+            number=number,
+            level=level,
+            pk=record.get('id') or None,
+            code=record.get('code'),
+            name=record.get('name'),
+            is_active=record.get('is_active') or True,
+            created=record.get('created'),
+            parent_pk=None,
+            parent_code=record.get('parent_code'),
+        )
+
+
+class RegionRow(object):
+    __slots__ = ('number', 'level', 'pk', 'code', 'name', 'is_active', 'created', 'parent_pk', 'parent_code')
+
+    def __init__(self, number, level, pk, code, name, is_active, created, parent_pk, parent_code):
+        self.number = number
+        self.level = level
+        self.pk = int(pk) if pk not in (None, '') else None
+        self.code = (str(code).strip() or None) if code is not None else None
+        self.name = str(name).strip() if name is not None else ''
+        self.is_active = is_active not in (False, 0, '0', 'false', 'False', 'no')
+        self.created = parse_created(created, number)
+        self.parent_pk = int(parent_pk) if parent_pk not in (None, '') else None
+        self.parent_code = (str(parent_code).strip() or None) if parent_code is not None else None
+
+        if not self.name:
+            raise CommandError(f'Row {number}: a region needs a name.')
+        if len(self.name) > 50:
+            raise CommandError(f'Row {number}: "{self.name}" is longer than 50 characters.')
+
+
+def parse_created(value, number: int):
+    """ The `created` time of a region, as an aware datetime, or None to use the current time.
+
+    YAML timestamps are read in UTC; a CSV value without an offset is in the TIME_ZONE setting.
+    """
+    if value in (None, ''):
+        return None
+    if isinstance(value, str):
+        parsed = parse_datetime(value.strip())
+        if parsed is None:
+            raise CommandError(f'Row {number}: "{value}" is not a valid date and time.')
+        return timezone.make_aware(parsed) if timezone.is_naive(parsed) else parsed
+    if isinstance(value, datetime):
+        return timezone.make_aware(value, timezone.utc) if timezone.is_naive(value) else value
+    if isinstance(value, date):
+        return timezone.make_aware(datetime.combine(value, datetime.min.time()), timezone.utc)
+    raise CommandError(f'Row {number}: "{value}" is not a valid date and time.')
+
+
+class RegionImporter(object):
+    """ Upserts regions level by level, in batches.
+
+    The ids and current values of every region are loaded up front, so each batch costs
+    one INSERT and one UPDATE per level, and rows that didn't change are not written at
+    all.  Parents are looked up by code in the same in-memory map, which also learns the
+    ids of the regions inserted so far; levels are always flushed from the province down,
+    so a region can refer to a parent from the same batch.
+    """
+
+    def __init__(self, batch_size: int=1000):
+        self.batch_size = batch_size
+        self.levels = [LevelState(level, model, parent_field) for level, model, parent_field in REGION_LEVELS]
+        self.pending = 0
+        self.read = self.inserted = self.updated = self.unchanged = 0
+
+    def add(self, row: RegionRow):
+        self.read += 1
+        self.levels[LEVEL_ORDER[row.level]].add(row)
+        self.pending += 1
+        if self.pending >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        for order, state in enumerate(self.levels):
+            parent = self.levels[order - 1] if state.parent_field else None
+            inserted, updated, unchanged = state.flush(parent)
+            self.inserted += inserted
+            self.updated += updated
+            self.unchanged += unchanged
+        self.pending = 0
+
+    def reset_sequences(self):
+        """ Moves the id sequences past the explicit pks of the file.
+        """
+        statements = connection.ops.sequence_reset_sql(no_style(), [model for _, model, _ in REGION_LEVELS])
+        with connection.cursor() as cursor:
+            for sql in statements:
+                cursor.execute(sql)
+
+
+class LevelState(object):
+
+    def __init__(self, level, model, parent_field):
+        self.level = level
+        self.model = model
+        self.parent_field = parent_field
+        self.buffer = OrderedDict()
+
+        fields = ('id', 'name', 'code', 'is_active') + ((parent_field,) if parent_field else ())
+        # id -> (name, code, is_active, parent id)
+        self.rows = {}
+        self.ids_by_code = {}
+        for values in model.objects.values_list(*fields).iterator():
+            self.rows[values[0]] = values[1:4] + ((values[4],) if parent_field else (None,))
+            if values[2]:
+                self.ids_by_code[values[2]] = values[0]
+
+    def add(self, row: RegionRow):
+        # a region listed twice in a batch is written once, with its last values
+        if row.code:
+            key = ('code', row.code)
+        elif row.pk is not None:
+            key = ('pk', row.pk)
+        else:
+            key = ('row', row.number)
+        self.buffer.pop(key, None)
+        self.buffer[key] = row
+
+    def flush(self, parent: 'LevelState'=None) -> tuple:
+        creates, updates, unchanged = [], [], 0
+        for row in self.buffer.values():
+            values = (row.name, row.code, row.is_active, self.resolve_parent(row, parent))
+            pk = self.ids_by_code.get(row.code) if row.code else None
+            if pk is None and row.pk in self.rows:
+                pk = row.pk
+
+            if pk is None:
+                creates.append((row, values))
+            elif self.rows[pk] != values:
+                updates.append((pk, values))
+            else:
+                unchanged += 1
+        self.buffer.clear()
+
+        if creates:
+            for pk, (_, values) in zip(self.bulk_insert(creates), creates):
+                self.remember(pk, values)
+        if updates:
+            self.bulk_update(updates)
+            for pk, values in updates:
+                self.remember(pk, values)
+        return len(creates), len(updates), unchanged
+
+    def resolve_parent(self, row: RegionRow, parent: 'LevelState'):
+        if parent is None:
+            return None
+        if row.parent_code:
+            try:
+                return parent.ids_by_code[row.parent_code]
+            except KeyError:
+                raise CommandError(f'Row {row.number}: there is no {parent.level} with code "{row.parent_code}".')
+        return row.parent_pk
+
+    def bulk_insert(self, creates: list) -> list:
+        """ Inserts all the rows with a single `INSERT ... RETURNING id`, in order.
+
+        Cheaper than `bulk_create()`, which builds a model instance and prepares every
+        value of every row through the fields.
+        """
+        table = connection.ops.quote_name(self.model._meta.db_table)
+        columns = 'id, name, code, is_active, created'
+        if self.parent_field:
+            columns += f', {connection.ops.quote_name(self.parent_field)}'
+        placeholders, params = [], []
+        for row, values in creates:
+            pk = 'DEFAULT' if row.pk is None else '%s'
+            created = 'now()' if row.created is None else '%s'
+            placeholders.append(f'({pk}, %s, %s, %s, {created}{", %s" if self.parent_field else ""})')
+            params.extend(
+                ((row.pk,) if row.pk is not None else ()) + values[:3] +
+                ((row.created,) if row.created is not None else ()) + (values[3:] if self.parent_field else ())
+            )
+        with connection.cursor() as cursor:
+            cursor.execute(f'INSERT INTO {table} ({columns}) VALUES {", ".join(placeholders)} RETURNING id', params)
+            return [pk for pk, in cursor.fetchall()]
+
+    def bulk_update(self, updates: list):
+        """ Updates all the rows with a single `UPDATE ... FROM (VALUES ...)`.
+        """
+        table = connection.ops.quote_name(self.model._meta.db_table)
+        assignments = 'name = v.name, code = v.code, is_active = v.is_active'
+        if self.parent_field:
+            assignments += f', {connection.ops.quote_name(self.parent_field)} = v.parent_id'
+        placeholders = ', '.join(['(%s::integer, %s::varchar, %s::varchar, %s::boolean, %s::integer)'] * len(updates))
+        params = [param for pk, values in updates for param in (pk,) + values]
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'UPDATE {table} AS t SET {assignments} '
+                f'FROM (VALUES {placeholders}) AS v (id, name, code, is_active, parent_id) '
+                f'WHERE t.id = v.id',
+                params
+            )
+
+    def remember(self, pk, values):
+        old = self.rows.get(pk)
+        if old is not None and old[1] and self.ids_by_code.get(old[1]) == pk:
+            del self.ids_by_code[old[1]]
+        self.rows[pk] = values
+        if values[1]:
+            self.ids_by_code[values[1]] = pk
@@ -1,4 +1,8 @@
 from django.db import models
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from masterdata.cache import region_cache
 
 
 class Province(models.Model):
@@ -75,3 +79,15 @@ class SubDistrict(models.Model):
 
     class Meta:
         db_table = 'master_sub_district'
+
+
+@receiver(post_save, sender=Province)
+@receiver(post_save, sender=City)
+@receiver(post_save, sender=District)
+@receiver(post_save, sender=SubDistrict)
+@receiver(post_delete, sender=Province)
+@receiver(post_delete, sender=City)
+@receiver(post_delete, sender=District)
+@receiver(post_delete, sender=SubDistrict)
+def invalidate_region_cache(sender, **kwargs):
+    region_cache.invalidate(using=kwargs.get('using'))
@@ -0,0 +1,36 @@
+"""
+Region Names
+============
+
+The names of every province, city, district and sub district by id, read in four queries
+and kept for as long as the masterdata version of `masterdata.cache.region_cache` does
+not change, so that labelling a case with its regions costs no query.
+"""
+import threading
+
+from masterdata.cache import region_cache
+from masterdata.models import Province, City, District, SubDistrict
+
+REGION_MODELS = (
+    ('province', Province),
+    ('city', City),
+    ('district', District),
+    ('sub_district', SubDistrict),
+)
+
+_names = None
+_names_version = None
+_names_lock = threading.Lock()
+
+
+def get_region_names() -> dict:
+    """ {level: {id: name}} for the current masterdata version.
+    """
+    global _names, _names_version
+    version = region_cache.get_generation()
+    if _names is None or _names_version != version:
+        with _names_lock:
+            if _names is None or _names_version != version:
+                _names = {level: dict(model.objects.values_list('id', 'name')) for level, model in REGION_MODELS}
+                _names_version = version
+    return _names
@@ -0,0 +1,241 @@
+"""
+Region Search
+=============
+
+An in-memory typeahead index over the names of every province, city, district and
+sub district.
+
+The index is built from the masterdata tables in four queries and kept for as long as
+the masterdata version of `masterdata.cache.region_cache` does not change, then built
+again in the background (see `get_region_index`).  It holds:
+
+* a sorted list of every word of every name, searched with `bisect` for word prefixes;
+* for the short prefixes (up to `SHORT_PREFIX_LENGTH` characters), whose ranges in that
+  list are too long to rank on every keystroke, the best `SHORT_PREFIX_CANDIDATES`
+  regions, precomputed per level;
+* a trigram → regions map, used for fuzzy matches (typos) when the prefixes alone do
+  not fill the requested number of results.
+
+Matches are ranked: exact name, then name prefix, then word prefix, then fuzzy matches
+by trigram similarity; higher levels (province first) and shorter names win ties.
+"""
+import heapq
+import logging
+import re
+import threading
+import unicodedata
+from bisect import bisect_left
+from collections import namedtuple, Counter
+
+from django.db import connection
+
+from masterdata.cache import region_cache
+from masterdata.models import Province, City, District, SubDistrict
+
+logger = logging.getLogger(__name__)
+
+REGION_LEVELS = (
+    # level, model, parent field
+    ('province', Province, None),
+    ('city', City, 'province_id'),
+    ('district', District, 'city_id'),
+    ('sub_district', SubDistrict, 'district_id'),
+)
+LEVEL_ORDER = {level: order for order, (level, _, _) in enumerate(REGION_LEVELS)}
+
+RANK_EXACT = 0
+RANK_NAME_PREFIX = 1
+RANK_WORD_PREFIX = 2
+RANK_FUZZY = 3
+
+MIN_FUZZY_SIMILARITY = 0.3
+
+SHORT_PREFIX_LENGTH = 3
+# at least twice the largest result size, see RegionSearchIndex.__init__
+SHORT_PREFIX_CANDIDATES = 100
+
+Region = namedtuple('Region', ['level', 'id', 'name', 'code', 'parent', 'normalized', 'words'])
+
+
+def normalize(text: str) -> str:
+    """ Lower-cases, strips accents and punctuation, and collapses whitespace.
+
+    >>> normalize('Ds.  Latuhalat')
+    'ds latuhalat'
+    """
+    text = unicodedata.normalize('NFKD', text or '').encode('ascii', 'ignore').decode('ascii')
+    return ' '.join(re.sub(r'[^a-z0-9]+', ' ', text.lower()).split())
+
+
+def trigrams(text: str) -> set:
+    padded = f'  {text} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class RegionSearchIndex(object):
+
+    def __init__(self, regions: list):
+        self.regions = regions
+        self.by_key = {(r.level, r.id): r for r in regions}
+
+        self.by_name = {}
+        for index, r in enumerate(regions):
+            self.by_name.setdefault(r.normalized, []).append(index)
+
+        words = sorted((word, index) for index, r in enumerate(regions) for word in r.words)
+        self.words = [word for word, _ in words]
+        self.word_regions = [index for _, index in words]
+
+        # Keep the best candidates of each short prefix: name prefixes first, then by the
+        # tie-breakers of the ranking.  Exact matches are looked up in `by_name`, and while
+        # there are fewer name prefix matches than the requested results, at least half
+        # the candidates are left for the word prefix matches.
+        tie_breakers = [self._tie_breaker(index) for index in range(len(regions))]
+        short_prefixes = {}
+        for index, r in enumerate(regions):
+            for prefix in {word[:n] for word in r.words for n in range(1, SHORT_PREFIX_LENGTH + 1)}:
+                candidate = (not r.normalized.startswith(prefix), tie_breakers[index], index)
+                short_prefixes.setdefault((prefix, None), []).append(candidate)
+                short_prefixes.setdefault((prefix, r.level), []).append(candidate)
+        self.short_prefixes = {
+            key: [index for _, _, index in heapq.nsmallest(SHORT_PREFIX_CANDIDATES, candidates)]
+            for key, candidates in short_prefixes.items()
+        }
+
+        self.trigrams = {}
+        self.trigram_counts = []
+        for index, r in enumerate(regions):
+            grams = trigrams(r.normalized)
+            self.trigram_counts.append(len(grams))
+            for gram in grams:
+                self.trigrams.setdefault(gram, []).append(index)
+
+    @classmethod
+    def build(cls) -> 'RegionSearchIndex':
+        regions = []
+        for order, (level, model, parent_field) in enumerate(REGION_LEVELS):
+            fields = ('id', 'name', 'code') + ((parent_field,) if parent_field else ())
+            parent_level = REGION_LEVELS[order - 1][0] if parent_field else None
+            for row in model.objects.values_list(*fields):
+                normalized = normalize(row[1])
+                regions.append(Region(
+                    level=level,
+                    id=row[0],
+                    name=row[1],
+                    code=row[2],
+                    parent=(parent_level, row[3]) if parent_field and row[3] is not None else None,
+                    normalized=normalized,
+                    words=tuple(set(normalized.split())),
+                ))
+        return cls(regions)
+
+    def search(self, query: str, level: str=None, limit: int=10) -> list:
+        """ Ranked regions matching `query`, optionally restricted to one level.
+        """
+        query = normalize(query)
+        if not query:
+            return []
+        tokens = query.split()
+
+        token = max(tokens, key=len)
+        if len(token) <= SHORT_PREFIX_LENGTH:
+            candidates = set(self.short_prefixes.get((token, level), ())) | set(self.by_name.get(query, ()))
+        else:
+            candidates = self._word_prefix_matches(token)
+
+        ranks = {}
+        for index in candidates:
+            r = self.regions[index]
+            if all(any(word.startswith(token) for word in r.words) for token in tokens):
+                if r.normalized == query:
+                    ranks[index] = (RANK_EXACT, 0)
+                elif r.normalized.startswith(query):
+                    ranks[index] = (RANK_NAME_PREFIX, 0)
+                else:
+                    ranks[index] = (RANK_WORD_PREFIX, 0)
+
+        if level is not None:
+            ranks = {index: rank for index, rank in ranks.items() if self.regions[index].level == level}
+
+        if len(ranks) < limit and len(query) > SHORT_PREFIX_LENGTH:
+            for index, similarity in self._fuzzy_matches(query, level):
+                ranks.setdefault(index, (RANK_FUZZY, -similarity))
+
+        ordered = sorted(ranks, key=lambda index: (ranks[index], self._tie_breaker(index)))
+        return [self.regions[index] for index in ordered[:limit]]
+
+    def path(self, region: Region) -> list:
+        """ The ancestors of a region, from the province down to its parent.
+        """
+        ancestors = []
+        parent = self.by_key.get(region.parent) if region.parent else None
+        while parent is not None:
+            ancestors.append(parent)
+            parent = self.by_key.get(parent.parent) if parent.parent else None
+        return list(reversed(ancestors))
+
+    def _tie_breaker(self, index: int) -> tuple:
+        r = self.regions[index]
+        return LEVEL_ORDER[r.level], len(r.name), r.normalized
+
+    def _word_prefix_matches(self, prefix: str) -> set:
+        start = bisect_left(self.words, prefix)
+        end = bisect_left(self.words, prefix + '\uffff', lo=start)
+        return set(self.word_regions[start:end])
+
+    def _fuzzy_matches(self, query: str, level: str=None) -> list:
+        grams = trigrams(query)
+        shared = Counter()
+        for gram in grams:
+            shared.update(self.trigrams.get(gram, ()))
+
+        matches = []
+        for index, count in shared.items():
+            # Jaccard similarity of the trigram sets
+            similarity = count / (len(grams) + self.trigram_counts[index] - count)
+            if similarity >= MIN_FUZZY_SIMILARITY and (level is None or self.regions[index].level == level):
+                matches.append((index, similarity))
+        return matches
+
+
+_index = None
+_index_version = None
+_index_lock = threading.Lock()
+_index_rebuilding = False
+
+
+def get_region_index() -> RegionSearchIndex:
+    """ The search index of the masterdata regions.
+
+    The first call builds it; after that, once a region is saved (or the index is older than
+    `settings.RESPONSE_CACHE_MAX_AGE`), the previous index keeps being served while a new one
+    is built in a background thread, so that no request waits for the rebuild.
+    """
+    global _index, _index_version, _index_rebuilding
+    version = region_cache.get_generation()
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = RegionSearchIndex.build()
+                _index_version = version
+    elif _index_version != version and not _index_rebuilding:
+        with _index_lock:
+            if _index_version != version and not _index_rebuilding:
+                _index_rebuilding = True
+                threading.Thread(target=_rebuild_region_index, args=(version,), daemon=True).start()
+    return _index
+
+
+def _rebuild_region_index(version):
+    global _index, _index_version, _index_rebuilding
+    try:
+        index = RegionSearchIndex.build()
+        with _index_lock:
+            _index = index
+            _index_version = version
+    except Exception:
+        logger.exception('Could not rebuild the region search index')
+    finally:
+        _index_rebuilding = False
+        # the thread's own database connection
+        connection.close()
@@ -1,3 +1,89 @@
-from django.test import TestCase
+import os
+import tempfile
+from datetime import datetime
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.core.management import call_command
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
+
+from masterdata import search
+from masterdata.cache import region_cache
+from masterdata.models import Province, SubDistrict
+from masterdata.names import get_region_names
+
+
+class RegionCacheTest(TransactionTestCase):
+
+    def test_saves_invalidate_once_committed(self):
+        version = region_cache.get_version()
+        get_region_names()
+        with transaction.atomic():
+            province = Province.objects.create(name='Maluku')
+            self.assertEqual(region_cache.get_version(), version)
+            self.assertNotIn(province.pk, get_region_names()['province'])
+        self.assertGreater(region_cache.get_version(), version)
+        self.assertIn(province.pk, get_region_names()['province'])
+
+    def test_entries_expire(self):
+        with mock.patch('utils.cache.time.monotonic', return_value=1000.0):
+            generation = region_cache.get_generation()
+            self.assertEqual(region_cache.get('key', lambda: 'old'), 'old')
+            self.assertEqual(region_cache.get('key', lambda: 'new'), 'old')
+        with mock.patch('utils.cache.time.monotonic', return_value=1000.0 + region_cache.max_age):
+            self.assertNotEqual(region_cache.get_generation(), generation)
+            self.assertEqual(region_cache.get('key', lambda: 'new'), 'new')
+
+    def test_zero_max_age_turns_caching_off(self):
+        with mock.patch.object(region_cache, 'max_age', 0):
+            self.assertEqual(region_cache.get('key', lambda: 'old'), 'old')
+            self.assertEqual(region_cache.get('key', lambda: 'new'), 'new')
+            self.assertNotEqual(region_cache.get_generation(), region_cache.get_generation())
+
+
+class RegionIndexTest(TestCase):
+    fixtures = ['master_ambon']
+
+    @mock.patch.multiple(search, _index=None, _index_version=None)
+    def test_previous_index_is_served_while_rebuilding(self):
+        index = search.get_region_index()
+        with mock.patch.object(search, 'threading') as threading, \
+                mock.patch.object(region_cache, 'get_generation', return_value=(0, 0)):
+            thread = threading.Thread
+            self.assertIs(search.get_region_index(), index)
+            self.assertIs(search.get_region_index(), index)
+            self.assertEqual(thread.call_count, 1)
+
+            # what the thread runs, minus closing the test connection
+            with mock.patch.object(search, 'connection'):
+                thread.call_args[1]['target'](*thread.call_args[1]['args'])
+            rebuilt = search.get_region_index()
+            self.assertIsNot(rebuilt, index)
+            self.assertEqual(search.get_region_index(), rebuilt)
+            self.assertEqual(thread.call_count, 1)
+
+
+class ImportRegionsTest(TestCase):
+
+    def import_regions(self, path: str):
+        call_command('import_regions', path, stdout=StringIO())
+
+    def test_fixture_keeps_created(self):
+        self.import_regions(os.path.join(os.path.dirname(__file__), 'fixtures', 'master_ambon.yaml'))
+        created = datetime(2017, 9, 2, 4, 20, 17, 895780, tzinfo=timezone.utc)
+        self.assertEqual(Province.objects.get(pk=1).created, created)
+        self.assertFalse(SubDistrict.objects.exclude(created=created).exists())
+
+    def test_csv_created(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as f:
+            f.write('level,code,name,parent_code,created\n'
+                    'province,81,Maluku,,2017-09-02T11:20:17+07:00\n'
+                    'city,8171,Ambon,81,\n')
+        self.addCleanup(os.remove, f.name)
+        self.import_regions(f.name)
+        province = Province.objects.get(code='81')
+        self.assertEqual(province.created, datetime(2017, 9, 2, 4, 20, 17, tzinfo=timezone.utc))
+        # without a created time, the time of the import
+        self.assertGreater(province.province.get().created, province.created)
@@ -1,10 +1,13 @@
 from django.urls import path
 
-from masterdata.views import ProvinceListAPI, CityListAPI, DistrictListAPI, SubDistrictListAPI
+from masterdata.views import ProvinceListAPI, CityListAPI, DistrictListAPI, SubDistrictListAPI, RegionTreeAPI, \
+    RegionSearchAPI
 
 urlpatterns = [
     path('province-list/', ProvinceListAPI.as_view(), name='province_list'),
     path('city-list/', CityListAPI.as_view(), name='city_list'),
     path('district-list/', DistrictListAPI.as_view(), name='district_list'),
     path('sub-district-list/', SubDistrictListAPI.as_view(), name='sub_district_list'),
+    path('region-tree/', RegionTreeAPI.as_view(), name='region_tree'),
+    path('region-search/', RegionSearchAPI.as_view(), name='region_search'),
 ]
\ No newline at end of file
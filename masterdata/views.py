@@ -1,94 +1,194 @@
-from django.http import JsonResponse
+from abc import ABCMeta, abstractmethod
+
+from rest_framework.exceptions import ValidationError
 from rest_framework.views import APIView
 
+from masterdata.cache import region_cache
 from masterdata.models import Province, City, District, SubDistrict
+from masterdata.search import get_region_index, LEVEL_ORDER
+from utils.cache import CachedResponse, cached_response
+from utils.http import JsonResponse
+
 
+class RegionListAPI(APIView, metaclass=ABCMeta):
+    """ Base view for the region lists.
 
-class ProvinceListAPI(APIView):
+    Regions almost never change, so every list is built once per filter value, served
+    from `masterdata.cache.region_cache` as ready-made bytes with a strong ETag, and
+    rebuilt only after a region has been saved.
+    """
+    filter_param = None
 
     def get(self, request):
+        filter_value = request.GET.get(self.filter_param) if self.filter_param else None
+        entry = region_cache.get(
+            f'{self.__class__.__name__}:{filter_value or ""}',
+            lambda: CachedResponse.from_json(self.build(filter_value))
+        )
+        return cached_response(request, entry)
+
+    @abstractmethod
+    def build(self, filter_value) -> list:
+        """ The list of regions, filtered on `filter_value` (when given)
+        """
+
+
+class ProvinceListAPI(RegionListAPI):
+    filter_param = 'name'
+
+    def build(self, name) -> list:
         """ Gets all province
         """
-        if request.GET.get('name'):
-            province = Province.objects.filter(name=request.GET.get('name'))
+        if name:
+            province = Province.objects.filter(name=name)
         else:
             province = Province.objects.all()
 
-        resp_json = []
-        for c in province:
-            resp_json.append({
-                'id': c.id,
-                'name': c.name,
-                'code': c.code
-            })
-
-        return JsonResponse(resp_json, safe=False)
+        return [
+            {
+                'id': c['id'],
+                'name': c['name'],
+                'code': c['code']
+            }
+            for c in province.values('id', 'name', 'code')
+        ]
 
 
-class CityListAPI(APIView):
+class CityListAPI(RegionListAPI):
+    filter_param = 'province'
 
-    def get(self, request):
+    def build(self, province_id) -> list:
         """ Gets all city
         """
-
-        if request.GET.get('province'):
-            city = City.objects.filter(province_id=request.GET.get('province'))
+        if province_id:
+            city = City.objects.filter(province_id=province_id)
         else:
             city = City.objects.all()
 
-        resp_json = []
-        for c in city:
-            resp_json.append({
-                'id': c.id,
-                'name': c.name,
-                'code': c.code,
-                'province': c.province.name if c.province else ''
-            })
-
-        return JsonResponse(resp_json, safe=False)
+        return [
+            {
+                'id': c['id'],
+                'name': c['name'],
+                'code': c['code'],
+                'province': c['province__name'] or ''
+            }
+            for c in city.values('id', 'name', 'code', 'province__name')
+        ]
 
 
-class DistrictListAPI(APIView):
+class DistrictListAPI(RegionListAPI):
+    filter_param = 'city'
 
-    def get(self, request):
+    def build(self, city_id) -> list:
         """ Gets all district
         """
-
-        if request.GET.get('city'):
-            district = District.objects.filter(city_id=request.GET.get('city'))
+        if city_id:
+            district = District.objects.filter(city_id=city_id)
         else:
             district = District.objects.all()
 
-        resp_json = []
-        for c in district:
-            resp_json.append({
-                'id': c.id,
-                'name': c.name,
-                'code': c.code,
-                'city': c.city.name if c.city else ''
-            })
-
-        return JsonResponse(resp_json, safe=False)
+        return [
+            {
+                'id': c['id'],
+                'name': c['name'],
+                'code': c['code'],
+                'city': c['city__name'] or ''
+            }
+            for c in district.values('id', 'name', 'code', 'city__name')
+        ]
 
 
-class SubDistrictListAPI(APIView):
+class SubDistrictListAPI(RegionListAPI):
+    filter_param = 'district'
 
-    def get(self, request):
+    def build(self, district_id) -> list:
         """ Gets all sub district
         """
-
-        if request.GET.get('district'):
-            sub_district = SubDistrict.objects.filter(district_id=request.GET.get('district'))
+        if district_id:
+            sub_district = SubDistrict.objects.filter(district_id=district_id)
         else:
             sub_district = SubDistrict.objects.all()
 
+        return [
+            {
+                'id': c['id'],
+                'name': c['name'],
+                'code': c['code'],
+                'district': c['district__name'] or ''
+            }
+            for c in sub_district.values('id', 'name', 'code', 'district__name')
+        ]
+
+
+class RegionTreeAPI(APIView):
+    """ The whole province → city → district → sub district hierarchy, in one response.
+
+    Lets the clients fill their region pickers at start-up with a single download.  The
+    tree is built and gzip-compressed once per version of the masterdata, and its version
+    is sent in the `X-Region-Version` header (and as the ETag), so a client holding the
+    current tree can skip the download with `If-None-Match`.
+
+    Regions without a parent are not part of the tree.
+    """
+
+    def get(self, request):
+        entry = region_cache.get('RegionTreeAPI', lambda: CachedResponse.from_json(self.build(), compress=True))
+        response = cached_response(request, entry)
+        response['X-Region-Version'] = entry.version
+        return response
+
+    def build(self) -> list:
+        sub_districts = {}
+        for c in SubDistrict.objects.filter(district__isnull=False).values('id', 'name', 'code', 'district_id'):
+            sub_districts.setdefault(c.pop('district_id'), []).append(c)
+
+        districts = {}
+        for c in District.objects.filter(city__isnull=False).values('id', 'name', 'code', 'city_id'):
+            c['subDistricts'] = sub_districts.get(c['id'], [])
+            districts.setdefault(c.pop('city_id'), []).append(c)
+
+        cities = {}
+        for c in City.objects.filter(province__isnull=False).values('id', 'name', 'code', 'province_id'):
+            c['districts'] = districts.get(c['id'], [])
+            cities.setdefault(c.pop('province_id'), []).append(c)
+
+        provinces = list(Province.objects.values('id', 'name', 'code'))
+        for c in provinces:
+            c['cities'] = cities.get(c['id'], [])
+        return provinces
+
+
+class RegionSearchAPI(APIView):
+    """ Typeahead search over the names of all four region levels.
+
+    `q` is matched on name and word prefixes, falling back to fuzzy (trigram) matches; `level`
+    (province, city, district or sub_district) restricts the search to one level.  Each match
+    comes with its ancestor path, from the province down.
+    """
+    default_limit = 10
+    max_limit = 50
+
+    def get(self, request):
+        level = request.GET.get('level') or None
+        if level is not None and level not in LEVEL_ORDER:
+            raise ValidationError({'level': [f'"{level}" is not a valid region level.']})
+        try:
+            limit = min(max(int(request.GET.get('limit', self.default_limit)), 1), self.max_limit)
+        except ValueError:
+            raise ValidationError({'limit': ['A valid integer is required.']})
+
+        index = get_region_index()
         resp_json = []
-        for c in sub_district:
+        for region in index.search(request.GET.get('q', ''), level=level, limit=limit):
             resp_json.append({
-                'id': c.id,
-                'name': c.name,
-                'code': c.code,
-                'district': c.district.name if c.district else ''
+                'id': region.id,
+                'level': region.level,
+                'name': region.name,
+                'code': region.code,
+                'path': [
+                    {'id': ancestor.id, 'level': ancestor.level, 'name': ancestor.name}
+                    for ancestor in index.path(region)
+                ],
             })
 
-        return JsonResponse(resp_json, safe=False)
\ No newline at end of file
+        return JsonResponse(resp_json, safe=False)
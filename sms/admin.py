@@ -7,3 +7,7 @@ class CaseInformationAdmin(admin.ModelAdmin):
     search_fields = ('name', 'patient_contact',)
     list_display = ('name', 'patient_contact', 'disease_type', 'case_report_type', 'classification_case')
 
+    def get_queryset(self, request):
+        # inactive cases too
+        return models.CaseInformation.all_objects.all()
+
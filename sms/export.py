@@ -0,0 +1,122 @@
+"""
+Case Export
+===========
+
+Streams case information, with its region names and reporting facility, as CSV or
+NDJSON.
+
+Rows are read with a server-side cursor (`QuerySet.iterator()`), `EXPORT_CHUNK_SIZE`
+at a time, as plain tuples, and written out as they come, so an export of millions of
+cases runs in constant memory, both from the `case-information-export/` endpoint and
+the `export_cases` command.
+"""
+import csv
+from datetime import datetime, time, timedelta
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import CharField, Q
+from django.db.models.functions import Cast
+from django.utils import timezone
+
+from sms.models import CaseInformation, MessageInformation
+
+EXPORT_CHUNK_SIZE = 2000
+
+EXPORT_FORMATS = {
+    # format: content type
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson',
+}
+
+EXPORT_COLUMNS = (
+    # column, field
+    ('id', 'id'),
+    ('created', 'created'),
+    ('name', 'name'),
+    ('gender', 'gender'),
+    ('age', 'age'),
+    ('is_pregnant', 'is_pregnant'),
+    ('patient_contact', 'patient_contact'),
+    ('disease_type', 'disease_type'),
+    ('case_report_type', 'case_report_type'),
+    ('classification_case', 'classification_case'),
+    ('address', 'address'),
+    ('latitude', 'latitude_text'),
+    ('longitude', 'longitude_text'),
+    ('province', 'province__name'),
+    ('city', 'city__name'),
+    ('district', 'district__name'),
+    ('sub_district', 'sub_district__name'),
+    ('facility_code', 'user__health_facility__code'),
+    ('facility', 'user__health_facility__name'),
+)
+
+EXPORT_REGION_FILTERS = ('province', 'city', 'district', 'sub_district')
+
+
+def get_export_queryset(date_from=None, date_to=None, facility=None, **regions):
+    """ The active cases to export, oldest first.
+
+    :param date_from: first day of the export (by creation date)
+    :param date_to: last day of the export
+    :param facility: only export the cases sent from or to this health facility (id)
+    :param regions: province, city, district and/or sub_district ids
+    """
+    queryset = CaseInformation.objects.annotate(
+        # as the database prints them, '0.000000000' rather than Decimal's '0E-9'
+        latitude_text=Cast('latitude', CharField()),
+        longitude_text=Cast('longitude', CharField()),
+    )
+    if date_from is not None:
+        queryset = queryset.filter(created__gte=timezone.make_aware(datetime.combine(date_from, time.min)))
+    if date_to is not None:
+        queryset = queryset.filter(created__lt=timezone.make_aware(datetime.combine(date_to + timedelta(days=1), time.min)))
+    if facility is not None:
+        messages = MessageInformation.objects.values('case_information_id')
+        queryset = queryset.filter(
+            Q(pk__in=messages.filter(origin_facility=facility)) |
+            Q(pk__in=messages.filter(destination_facility=facility))
+        )
+    for region in EXPORT_REGION_FILTERS:
+        if regions.get(region) is not None:
+            queryset = queryset.filter(**{f'{region}_id': regions[region]})
+    return queryset.order_by('created', 'id').values_list(*[field for _, field in EXPORT_COLUMNS])
+
+
+def iter_export(queryset, export_format: str='csv', chunk_size: int=EXPORT_CHUNK_SIZE):
+    """ Yields the export as utf-8 encoded chunks of about `chunk_size` rows.
+    """
+    columns = [column for column, _ in EXPORT_COLUMNS]
+    buffer = ExportBuffer()
+
+    if export_format == 'csv':
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        write = writer.writerow
+    else:
+        encoder = DjangoJSONEncoder()
+
+        def write(row):
+            buffer.write(encoder.encode(dict(zip(columns, row))))
+            buffer.write('\n')
+
+    for count, row in enumerate(queryset.iterator(chunk_size=chunk_size), start=1):
+        write(row)
+        if count % chunk_size == 0:
+            yield buffer.flush()
+    yield buffer.flush()
+
+
+class ExportBuffer(object):
+    """ The file-like object `csv.writer` writes to, emptied after every chunk.
+    """
+    def __init__(self):
+        self.parts = []
+
+    def write(self, value: str):
+        self.parts.append(value)
+
+    def flush(self) -> bytes:
+        data = ''.join(self.parts).encode('utf-8')
+        self.parts = []
+        return data
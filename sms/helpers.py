@@ -1,20 +1,72 @@
-from smtplib import SMTPException
+import threading
+from smtplib import SMTPException, SMTPRecipientsRefused, SMTPResponseException, SMTPServerDisconnected
 
 from django.core.mail import EmailMultiAlternatives
-from django.template.loader import render_to_string
+from django.template.loader import get_template
 
 from healthfacility.models import HealthFacility
 from users.models import User
 
+NOTIFICATION_TEXT_TEMPLATE = 'case_information/email_notification/email_notification.txt'
+NOTIFICATION_HTML_TEMPLATE = 'case_information/email_notification/email_notification.html'
 
-def send_notification_email(user: User, dest: HealthFacility, case_information):
-    """ Send Email Notification
 
-    :param user: User object
-    :return: Email send status
+class NotificationRenderer(object):
+    """ Renders notification emails from templates loaded and compiled once.
+
+    `render_to_string` looks the templates up and parses them again on every call unless the
+    cached template loader is on, which Django leaves off with DEBUG.  The renderer of a
+    process (`get_notification_renderer`) keeps them for its lifetime: template changes
+    need a restart.
     """
+    def __init__(self, text_template: str=NOTIFICATION_TEXT_TEMPLATE, html_template: str=NOTIFICATION_HTML_TEMPLATE):
+        self.text_template = get_template(text_template)
+        self.html_template = get_template(html_template)
+
+    def render(self, user: User, dest: HealthFacility, case_information, recipients: list) -> EmailMultiAlternatives:
+        """ Build the notification email for a case, sent from `user` to `dest`
+
+        :param user: User object of the reporter
+        :param dest: Destination health facility
+        :param case_information: Case information, as queued by `sms.models.create_message`
+        :param recipients: Email addresses to send it to, the members of `dest` (see
+            `sms.recipients.get_recipients`)
+        :return: The email, with its HTML alternative attached
+        """
+        content = build_notification_context(user, dest, case_information)
+        email = EmailMultiAlternatives(
+            subject=f'Case Information from {user.health_facility.name} #MI{case_information.get("mi")} #CI{case_information.get("ci")}',
+            body=self.text_template.render(content),
+            from_email='no-reply@mail.garuda.com',
+            to=list(recipients)
+        )
+        email.attach_alternative(self.html_template.render(content), 'text/html')
+        return email
+
+    def render_many(self, notifications) -> list:
+        """ The emails of a batch of notifications, as (user, dest, case_information, recipients)
+        tuples, in order.
+        """
+        return [self.render(*notification) for notification in notifications]
 
-    content = {
+
+_renderer = None
+_renderer_lock = threading.Lock()
+
+
+def get_notification_renderer() -> NotificationRenderer:
+    """ The renderer of this process.
+    """
+    global _renderer
+    if _renderer is None:
+        with _renderer_lock:
+            if _renderer is None:
+                _renderer = NotificationRenderer()
+    return _renderer
+
+
+def build_notification_context(user: User, dest: HealthFacility, case_information) -> dict:
+    return {
         'reporter': {
             'name': f'{user.first_name} {user.last_name}',
             'health_facility': user.health_facility.name
@@ -39,24 +91,59 @@ def send_notification_email(user: User, dest: HealthFacility, case_information):
         }
     }
 
-    try:
-        # log.info(f"Sending Email notification: {user}")
-        email = EmailMultiAlternatives(
-            subject=f'Case Information from {user.health_facility.name} #MI{case_information.get("mi")} #CI{case_information.get("ci")}',
-            body=render_to_string('case_information/email_notification/email_notification.txt', content),
-            from_email='no-reply@mail.garuda.com',
-            # to=[user.email, ]
-            to=['azharieazharou@gmail.com', 'rully.annihilator@gmail.com' ]
-        )
 
-        email.attach_alternative(
-            render_to_string(
-                'case_information/email_notification/email_notification.html',
-                content),
-            'text/html')
-
-        return email.send()
-    except SMTPException as e:
-        # log.error(f'Send Notification email failed : {str(e)}')
-        print(e)
-        return 0
\ No newline at end of file
+def build_notification_email(user: User, dest: HealthFacility, case_information,
+                             recipients: list) -> EmailMultiAlternatives:
+    """ Build the notification email for a case, sent from `user` to `dest`; see
+    `NotificationRenderer.render`.
+    """
+    return get_notification_renderer().render(user, dest, case_information, recipients)
+
+
+def send_notification_emails(emails: list, connection) -> list:
+    """ Sends a batch of emails over `connection`, with a single `send_messages` call unless
+    some fail.
+
+    An email that fails is skipped and the ones after it are sent in a new call.  A transient
+    error (see `is_transient_email_error`) stops the batch there, as the next emails would
+    fail too.
+
+    :return: the outcome of each email attempted, in order: None once sent, or the error it
+        failed with; the emails after a transient error are not attempted
+    """
+    errors = []
+
+    def unsent():
+        for email in emails[len(errors):]:
+            # replaced by the error when sending it fails
+            errors.append(None)
+            yield email
+
+    while len(errors) < len(emails):
+        attempted = len(errors)
+        try:
+            connection.send_messages(unsent())
+        except Exception as e:
+            if len(errors) == attempted:
+                # failed before the next email was taken, e.g. while connecting
+                errors.append(e)
+            else:
+                errors[-1] = e
+            if is_transient_email_error(e):
+                break
+    return errors
+
+
+def is_transient_email_error(error: Exception) -> bool:
+    """ Whether sending an email again later may succeed: the server could not be reached, or
+    it replied with a 4xx code, as it does when throttling (e.g. 421 too many connections,
+    451 or 452 rate limited).
+    """
+    if isinstance(error, SMTPRecipientsRefused):
+        return bool(error.recipients) and all(400 <= code < 500 for code, _ in error.recipients.values())
+    if isinstance(error, SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    if isinstance(error, SMTPServerDisconnected):
+        return True
+    # SMTPException derives from OSError, the remaining OSErrors are socket errors
+    return isinstance(error, OSError) and not isinstance(error, SMTPException)
@@ -0,0 +1,443 @@
+import http.client
+import itertools
+import json
+import math
+import random
+import re
+import subprocess
+import threading
+import time
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+from django.db import connections
+from django.test import Client
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework_jwt.settings import api_settings
+
+from healthfacility.models import HealthFacility, HEALTHFACILITY_TYPE_CLINIC, HEALTHFACILITY_TYPE_HEALTH_CENTER
+from masterdata.models import Province, City, District, SubDistrict
+from sms.management.commands.benchmark_case_payload import make_case_payload
+from sms.models import CaseInformation, MessageInformation
+from users.models import User
+from utils.http import LinkHeaderField, LinkHeaderRel
+
+PERCENTILES = (50, 95, 99)
+
+SERVER_TIMING_DB = re.compile(r'db;dur=(?P<duration>[\d.]+);desc="(?P<queries>\d+) queries"')
+
+
+class Command(BaseCommand):
+    help = '''Measures the latency and the database queries of the API hot paths.
+
+    Drives the case feeds, case creation, login, the region lists and the facility
+    directory, as users of the dataset written by `seed_benchmark`, and reports the
+    p50/p95/p99 latency and the queries per request of each scenario.  Query counts and
+    database time are read from the Server-Timing header (see utils.middleware), so they
+    are the same whether the requests go through the Django test client, in this process
+    (the default), or over HTTP to a running server (--url).
+
+    Results can be saved (--output) as a JSON baseline, and compared with an earlier one
+    (--compare): a scenario regresses when its p95 grows by more than --threshold, or when
+    it makes more queries.  Case creation writes new cases to the database.
+    '''
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200, help='Timed requests per scenario.')
+        parser.add_argument('--warmup', type=int, default=20, help='Untimed requests per scenario, first.')
+        parser.add_argument('--concurrency', type=int, default=1, help='Clients sending requests at once.')
+        parser.add_argument('--users', type=int, default=50, help='Distinct users the requests are spread over.')
+        parser.add_argument('--password', default='benchmark', help='Password of the seeded users.')
+        parser.add_argument('--scenario', action='append', dest='scenarios', metavar='NAME',
+                            help='Only run this scenario; may be repeated.')
+        parser.add_argument('--url', help='Base URL of a running server, instead of the in-process test client.')
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--output', '-o', help='Save the results to this JSON file.')
+        parser.add_argument('--compare', help='Compare the results with this JSON baseline.')
+        parser.add_argument('--threshold', type=float, default=0.2,
+                            help='Relative p95 growth reported as a regression.')
+        parser.add_argument('--fail-on-regression', action='store_true',
+                            help='Exit with an error when a scenario regressed.')
+
+    def handle(self, *args, **options):
+        if options['concurrency'] < 1 or options['requests'] < 1:
+            raise CommandError('--requests and --concurrency must be at least 1.')
+        baseline = None
+        if options['compare']:
+            with open(options['compare'], encoding='utf-8') as f:
+                baseline = json.load(f)
+        if settings.DEBUG and not options['url']:
+            self.stderr.write('DEBUG is on: every query is also logged, latencies are not representative.')
+
+        rnd = random.Random(options['seed'])
+        dataset = Dataset.load(rnd, options['users'], options['password'])
+        scenarios = build_scenarios(dataset)
+        if options['scenarios']:
+            unknown = set(options['scenarios']) - {scenario.name for scenario in scenarios}
+            if unknown:
+                raise CommandError(f'Unknown scenario(s): {", ".join(sorted(unknown))}.')
+            scenarios = [scenario for scenario in scenarios if scenario.name in options['scenarios']]
+
+        transport = HttpTransport(options['url']) if options['url'] else ClientTransport()
+        dataset.prepare(transport)
+
+        results = {
+            'created': timezone.now().isoformat(),
+            'revision': get_revision(),
+            'target': options['url'] or 'in-process',
+            'database': dataset.describe(),
+            'options': {key: options[key] for key in ('requests', 'warmup', 'concurrency', 'users', 'seed')},
+            'scenarios': {},
+        }
+        self.stdout.write(f'{"scenario":<24} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"req/s":>8} '
+                          f'{"queries":>8} {"db ms":>7} {"errors":>6}')
+        for scenario in scenarios:
+            result = run_scenario(scenario, transport, dataset, rnd, options)
+            results['scenarios'][scenario.name] = result
+            self.stdout.write(
+                f'{scenario.name:<24} {result["p50"]:8.2f} {result["p95"]:8.2f} {result["p99"]:8.2f} '
+                f'{result["throughput"]:8.1f} {str(result["queries"]):>8} {result["db_p50"]:7.2f} {result["errors"]:6}'
+            )
+
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+            self.stdout.write(f'Results saved to {options["output"]}')
+
+        if baseline is not None:
+            regressions = self.compare(baseline, results, options['threshold'])
+            if regressions and options['fail_on_regression']:
+                raise CommandError(f'{len(regressions)} scenario(s) regressed: {", ".join(regressions)}.')
+
+    def compare(self, baseline: dict, results: dict, threshold: float) -> list:
+        """ Prints the change of every scenario since the baseline.
+
+        :return: the names of the scenarios that regressed
+        """
+        self.stdout.write(f'\nCompared with {baseline.get("revision") or "the baseline"} '
+                          f'({baseline.get("created", "?")}):')
+        regressions = []
+        for name, result in results['scenarios'].items():
+            before = baseline.get('scenarios', {}).get(name)
+            if before is None:
+                self.stdout.write(f'{name:<24} not in the baseline')
+                continue
+            changes = ' '.join(
+                f'p{p} {before[f"p{p}"]:.2f} -> {result[f"p{p}"]:.2f} ({relative_change(before[f"p{p}"], result[f"p{p}"]):+.0%})'
+                for p in PERCENTILES
+            )
+            regressed = result['p95'] > before['p95'] * (1 + threshold) or \
+                (result['queries'] or 0) > (before['queries'] or 0)
+            if regressed:
+                regressions.append(name)
+            self.stdout.write(
+                f'{name:<24} {changes}  queries {before["queries"]} -> {result["queries"]}'
+                f'{"  REGRESSION" if regressed else ""}'
+            )
+        return regressions
+
+
+class Scenario(object):
+    """ One kind of request: `build(user)` gives its path and JSON body, if any.
+    """
+
+    def __init__(self, name: str, method: str, build, pool: str='reporters', authenticated: bool=True,
+                 expected_status: int=200):
+        self.name = name
+        self.method = method
+        self.build = build
+        self.pool = pool
+        self.authenticated = authenticated
+        self.expected_status = expected_status
+
+
+def build_scenarios(dataset: 'Dataset') -> list:
+    case_list = reverse('case_information_list')
+    return [
+        Scenario('login', 'POST', lambda user: (reverse('user-login'), {'email': user.email, 'password': dataset.password}),
+                 authenticated=False),
+        Scenario('case_feed', 'GET', lambda user: (case_list, None)),
+        Scenario('case_feed_deep', 'GET', lambda user: (dataset.deep_pages[user.pk], None)),
+        Scenario('sent_feed', 'GET', lambda user: (reverse('sent_case_list'), None)),
+        Scenario('received_feed', 'GET', lambda user: (reverse('received_case_list'), None), pool='receivers'),
+        Scenario('case_create', 'POST', lambda user: (case_list, dataset.case_payload(user)), expected_status=201),
+        Scenario('province_list', 'GET', lambda user: (reverse('province_list'), None), authenticated=False),
+        Scenario('city_list', 'GET', lambda user: (f'{reverse("city_list")}?province={user.health_facility.province_id}', None),
+                 authenticated=False),
+        Scenario('district_list', 'GET', lambda user: (f'{reverse("district_list")}?city={user.health_facility.city_id}', None),
+                 authenticated=False),
+        Scenario('sub_district_list', 'GET',
+                 lambda user: (f'{reverse("sub_district_list")}?district={user.health_facility.district_id}', None),
+                 authenticated=False),
+        Scenario('region_tree', 'GET', lambda user: (reverse('region_tree'), None), authenticated=False),
+        Scenario('region_search', 'GET',
+                 lambda user: (f'{reverse("region_search")}?q={user.health_facility.sub_district.name[:8]}', None),
+                 authenticated=False),
+        Scenario('facility_list', 'GET',
+                 lambda user: (f'{reverse("health_facility_list")}?district={user.health_facility.district_id}', None)),
+        Scenario('facility_nearest', 'GET', lambda user: (
+            f'{reverse("health_facility_nearest")}?latitude={user.health_facility.latitude}'
+            f'&longitude={user.health_facility.longitude}', None)),
+    ]
+
+
+class Dataset(object):
+    """ The users the requests are sent as: clinic staff (reporters) and health center staff
+    (receivers), drawn at random from the database.
+    """
+    # how far `case_feed_deep` pages into the feed
+    DEEP_PAGE = 5
+
+    def __init__(self, reporters: list, receivers: list, password: str):
+        self.pools = {'reporters': reporters, 'receivers': receivers}
+        self.password = password
+        self.tokens = {}
+        self.deep_pages = {}
+        self.case_numbers = itertools.count()
+
+    @classmethod
+    def load(cls, rnd: random.Random, users: int, password: str) -> 'Dataset':
+        pools = []
+        for level in (HEALTHFACILITY_TYPE_CLINIC, HEALTHFACILITY_TYPE_HEALTH_CENTER):
+            ids = list(User.objects.filter(health_facility__facility_level=level).order_by('id').values_list('id', flat=True))
+            if not ids:
+                raise CommandError('There are no users to benchmark with, run `seed_benchmark` first.')
+            pools.append(list(
+                User.objects.filter(pk__in=rnd.sample(ids, min(users, len(ids))))
+                .select_related('health_facility__sub_district').order_by('id')
+            ))
+        return cls(*pools, password=password)
+
+    def prepare(self, transport: 'Transport'):
+        """ Signs the users in, and finds the page of their feed `case_feed_deep` starts on.
+        """
+        payload_handler, encode_handler = api_settings.JWT_PAYLOAD_HANDLER, api_settings.JWT_ENCODE_HANDLER
+        for user in self.pools['reporters'] + self.pools['receivers']:
+            self.tokens[user.pk] = encode_handler(payload_handler(user))
+
+        for user in self.pools['reporters']:
+            path = reverse('case_information_list')
+            for _ in range(self.DEEP_PAGE - 1):
+                status, headers = transport.request('GET', path, None, self.get_headers(user))
+                next_path = get_next_path(headers.get('Link'))
+                if status != 200 or next_path is None:
+                    break
+                path = next_path
+            self.deep_pages[user.pk] = path
+
+    def get_headers(self, user: User, authenticated: bool=True) -> dict:
+        if not authenticated:
+            return {}
+        return {'Authorization': f'{api_settings.JWT_AUTH_HEADER_PREFIX} {self.tokens[user.pk]}'}
+
+    def case_payload(self, user: User) -> dict:
+        facility = user.health_facility
+        payload = make_case_payload(next(self.case_numbers))
+        payload.update(province=facility.province_id, city=facility.city_id,
+                       district=facility.district_id, sub_district=facility.sub_district_id)
+        return payload
+
+    @staticmethod
+    def describe() -> dict:
+        return {
+            'vendor': connections['default'].vendor,
+            'provinces': Province.objects.count(),
+            'cities': City.objects.count(),
+            'districts': District.objects.count(),
+            'sub_districts': SubDistrict.objects.count(),
+            'facilities': HealthFacility.objects.count(),
+            'users': User.objects.count(),
+            'cases': CaseInformation.objects.count(),
+            'messages': MessageInformation.objects.count(),
+        }
+
+
+def run_scenario(scenario: Scenario, transport: 'Transport', dataset: Dataset, rnd: random.Random,
+                 options: dict) -> dict:
+    """ Sends the warm-up requests, then the timed ones from `--concurrency` threads.
+    """
+    pool = dataset.pools[scenario.pool]
+    plan = []
+    for _ in range(options['warmup'] + options['requests']):
+        user = rnd.choice(pool)
+        path, body = scenario.build(user)
+        plan.append((path, body, dataset.get_headers(user, scenario.authenticated)))
+
+    for path, body, headers in plan[:options['warmup']]:
+        transport.request(scenario.method, path, body, headers)
+
+    samples = []
+    timed = plan[options['warmup']:]
+    lock = threading.Lock()
+
+    def worker(requests):
+        mine = []
+        try:
+            for path, body, headers in requests:
+                started = time.perf_counter()
+                status, response_headers = transport.request(scenario.method, path, body, headers)
+                elapsed = time.perf_counter() - started
+                mine.append((elapsed, status, response_headers.get('Server-Timing', '')))
+        finally:
+            transport.close()
+            with lock:
+                samples.extend(mine)
+
+    concurrency = min(options['concurrency'], len(timed))
+    started = time.perf_counter()
+    if concurrency == 1:
+        worker(timed)
+    else:
+        threads = [threading.Thread(target=worker, args=(timed[i::concurrency],)) for i in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    wall_time = time.perf_counter() - started
+
+    latencies = sorted(elapsed * 1000 for elapsed, _, _ in samples)
+    queries, db_times = [], []
+    for _, _, server_timing in samples:
+        match = SERVER_TIMING_DB.search(server_timing)
+        if match:
+            queries.append(int(match.group('queries')))
+            db_times.append(float(match.group('duration')))
+    queries.sort()
+    db_times.sort()
+
+    result = {f'p{p}': percentile(latencies, p) for p in PERCENTILES}
+    result.update(
+        requests=len(samples),
+        errors=sum(1 for _, status, _ in samples if status != scenario.expected_status),
+        mean=sum(latencies) / len(latencies),
+        max=latencies[-1],
+        throughput=len(samples) / wall_time,
+        queries=percentile(queries, 50) if queries else None,
+        queries_max=queries[-1] if queries else None,
+        db_p50=percentile(db_times, 50) if db_times else 0.0,
+    )
+    return result
+
+
+class Transport(object):
+
+    def request(self, method: str, path: str, body, headers: dict) -> tuple:
+        """ Sends a request, with `body` as JSON, and reads the whole response.
+
+        :return: status code, response headers
+        """
+        raise NotImplementedError('Transports must implement request()')
+
+    def close(self):
+        """ Called by each thread when it is done.
+        """
+
+
+class ClientTransport(Transport):
+    """ Requests served in this process, by the Django test client: the whole middleware
+    and view stack, without the network and the WSGI server.
+    """
+
+    def __init__(self):
+        self.host = next((host for host in settings.ALLOWED_HOSTS if host not in ('*', '') and not host.startswith('.')),
+                         'localhost')
+        self.local = threading.local()
+
+    def request(self, method: str, path: str, body, headers: dict) -> tuple:
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = self.local.client = Client(HTTP_HOST=self.host)
+        extra = {f'HTTP_{name.upper().replace("-", "_")}': value for name, value in headers.items()}
+        if method == 'GET':
+            response = client.get(path, **extra)
+        else:
+            response = client.generic(method, path, json.dumps(body), content_type='application/json', **extra)
+        if response.streaming:
+            for _ in response.streaming_content:
+                pass
+        return response.status_code, {name: value for name, value in response.items()}
+
+    def close(self):
+        # the thread's own database connections
+        connections.close_all()
+
+
+class HttpTransport(Transport):
+    """ Requests sent to a running server, over one keep-alive connection per thread.
+    """
+
+    def __init__(self, base_url: str):
+        url = urlsplit(base_url)
+        if url.scheme not in ('http', 'https') or not url.netloc:
+            raise CommandError(f'"{base_url}" is not an http(s) URL.')
+        self.url = url
+        self.local = threading.local()
+
+    def get_connection(self) -> http.client.HTTPConnection:
+        conn = getattr(self.local, 'connection', None)
+        if conn is None:
+            cls = http.client.HTTPSConnection if self.url.scheme == 'https' else http.client.HTTPConnection
+            conn = self.local.connection = cls(self.url.netloc, timeout=60)
+        return conn
+
+    def request(self, method: str, path: str, body, headers: dict) -> tuple:
+        parts = urlsplit(path)
+        # pagination links are absolute, the other paths are relative to the base URL
+        path = parts.path if parts.netloc else self.url.path.rstrip('/') + parts.path
+        if parts.query:
+            path += f'?{parts.query}'
+        headers = dict(headers)
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        conn = self.get_connection()
+        try:
+            conn.request(method, path, data, headers)
+            response = conn.getresponse()
+        except (http.client.HTTPException, OSError):
+            # the server closed the keep-alive connection, retry once on a new one
+            conn.close()
+            conn.request(method, path, data, headers)
+            response = conn.getresponse()
+        response.read()
+        return response.status, dict(response.getheaders())
+
+    def close(self):
+        conn = getattr(self.local, 'connection', None)
+        if conn is not None:
+            conn.close()
+            self.local.connection = None
+
+
+def get_next_path(link_header: str):
+    for part in (link_header or '').split(', '):
+        if part:
+            field = LinkHeaderField.from_string(part)
+            if field.rel == LinkHeaderRel.next:
+                return field.url
+    return None
+
+
+def percentile(values: list, p: float) -> float:
+    """ Nearest-rank percentile of sorted values.
+    """
+    return values[max(math.ceil(p / 100 * len(values)) - 1, 0)]
+
+
+def relative_change(before: float, after: float) -> float:
+    return (after - before) / before if before else 0.0
+
+
+def get_revision():
+    """ The git commit the code is at, if it runs from a checkout.
+    """
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True, universal_newlines=True
+        ).stdout.strip() or None
+    except (OSError, subprocess.CalledProcessError):
+        return None
@@ -0,0 +1,62 @@
+import json
+import random
+import timeit
+
+from django.core.management import BaseCommand
+
+from sms.models import GENDER_TYPES, DISEASE_TYPES, CASE_TYPES, CLASSIFICATION_TYPES
+from sms.schemas import CaseInformationSchema
+
+CASE_FIELDS = (
+    'name', 'gender', 'age', 'is_pregnant', 'patient_contact', 'disease_type', 'case_report_type',
+    'classification_case', 'address', 'province', 'city', 'district', 'sub_district',
+)
+
+
+class Command(BaseCommand):
+    help = 'Compares parsing a case payload with CaseInformationSchema against one json.loads() per field.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--payloads', type=int, default=1000, help='Number of distinct payloads.')
+        parser.add_argument('--repeat', type=int, default=5, help='Best of this many runs is reported.')
+
+    def handle(self, *args, **options):
+        bodies = [json.dumps(make_case_payload(i)).encode('utf-8') for i in range(options['payloads'])]
+
+        def per_field_loads():
+            for body in bodies:
+                {field: json.loads(body)[field] for field in CASE_FIELDS}
+
+        def schema_parse():
+            for body in bodies:
+                CaseInformationSchema.parse(body)
+
+        results = {}
+        for name, bench in (('json.loads per field', per_field_loads), ('CaseInformationSchema', schema_parse)):
+            best = min(timeit.repeat(bench, number=1, repeat=options['repeat']))
+            results[name] = best / len(bodies) * 1e6
+            self.stdout.write(f'{name:<24} {results[name]:8.2f} us/payload')
+
+        baseline, schema = results.values()
+        self.stdout.write(f'speed-up: {baseline / schema:.1f}x')
+
+
+def make_case_payload(seed: int) -> dict:
+    """ A case payload shaped like the ones sent by the field devices.
+    """
+    rnd = random.Random(seed)
+    return {
+        'name': f'Pasien {seed}',
+        'gender': rnd.choice(GENDER_TYPES)[0],
+        'age': rnd.randint(1, 90),
+        'is_pregnant': rnd.random() < 0.1,
+        'patient_contact': f'08{rnd.randint(10 ** 9, 10 ** 10 - 1)}',
+        'disease_type': rnd.choice(DISEASE_TYPES)[0],
+        'case_report_type': rnd.choice(CASE_TYPES)[0],
+        'classification_case': rnd.choice(CLASSIFICATION_TYPES)[0],
+        'address': f'Jl. Pattimura No. {rnd.randint(1, 200)}, Kel. Benteng, Kec. Nusaniwe',
+        'province': 1,
+        'city': 1,
+        'district': rnd.randint(1, 5),
+        'sub_district': rnd.randint(1, 21),
+    }
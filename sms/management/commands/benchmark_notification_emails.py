@@ -0,0 +1,82 @@
+import time
+
+from django.core.mail import get_connection
+from django.core.management import BaseCommand, CommandError
+
+from healthfacility.models import HealthFacility
+from sms.helpers import NotificationRenderer, get_notification_renderer, send_notification_emails
+from sms.management.commands.benchmark_case_payload import make_case_payload
+from users.models import User
+from utils.smtpsink import SMTPSink
+
+
+class Command(BaseCommand):
+    help = '''Measures how many notification emails per second are rendered and sent.
+
+    Compares loading the templates for every email over a new SMTP connection each (as
+    `render_to_string` and `EmailMessage.send()` do) with the process renderer
+    (sms.helpers.NotificationRenderer) sending batches over one connection.  The emails go
+    to an SMTP sink (utils.smtpsink) taking --latency milliseconds per email.
+    '''
+
+    def add_arguments(self, parser):
+        parser.add_argument('--emails', type=int, default=500)
+        parser.add_argument('--batch-size', type=int, default=50, help='Emails sent per connection.')
+        parser.add_argument('--latency', type=float, default=0.0, help='Milliseconds the sink takes per email.')
+
+    def handle(self, *args, **options):
+        destination = HealthFacility.objects.filter(members__isnull=False).order_by('id').first()
+        reporter = User.objects.select_related('health_facility').filter(health_facility__isnull=False) \
+            .exclude(health_facility=destination).order_by('id').first()
+        if destination is None or reporter is None:
+            raise CommandError('There are no facilities with members to notify, run `seed_benchmark` first.')
+        recipients = list(destination.members.values_list('email', flat=True))
+        notifications = [
+            (reporter, destination, dict(make_case_payload(i), mi=i, ci=i), recipients)
+            for i in range(options['emails'])
+        ]
+        batch_size = options['batch_size']
+
+        sink = SMTPSink(latency=options['latency'] / 1000).start()
+
+        def new_connection():
+            return get_connection(
+                'django.core.mail.backends.smtp.EmailBackend', host='127.0.0.1', port=sink.port,
+                username='', password='', use_tls=False, use_ssl=False
+            )
+
+        def render_per_email():
+            return [NotificationRenderer().render(*notification) for notification in notifications]
+
+        def render_cached():
+            return get_notification_renderer().render_many(notifications)
+
+        def send_per_email():
+            for notification in notifications:
+                new_connection().send_messages([NotificationRenderer().render(*notification)])
+
+        def send_batches():
+            renderer = get_notification_renderer()
+            connection = new_connection()
+            with connection:
+                for start in range(0, len(notifications), batch_size):
+                    send_notification_emails(renderer.render_many(notifications[start:start + batch_size]), connection)
+
+        get_notification_renderer()
+        try:
+            for name, bench in (
+                ('render, templates per email', render_per_email),
+                ('render, templates loaded once', render_cached),
+                ('send, connection per email', send_per_email),
+                (f'send, batches of {batch_size}', send_batches),
+            ):
+                sink.reset()
+                started = time.perf_counter()
+                bench()
+                elapsed = time.perf_counter() - started
+                self.stdout.write(
+                    f'{name:<32} {len(notifications) / elapsed:8.0f} emails/s '
+                    f'({elapsed / len(notifications) * 1000:.2f} ms/email, {sink.connections} SMTP connection(s))'
+                )
+        finally:
+            sink.stop()
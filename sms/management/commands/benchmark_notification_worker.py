@@ -0,0 +1,90 @@
+import threading
+import time
+
+from django.core.mail import get_connection
+from django.core.management import BaseCommand, CommandError
+from kombu import Connection, Exchange, Queue
+
+from healthfacility.models import HealthFacility
+from sms.management.commands.benchmark_case_payload import make_case_payload
+from sms.management.commands.email_notification_subscribe import EmailNotificationWorker
+from users.models import User
+from utils.smtpsink import SMTPSink
+
+
+class Command(BaseCommand):
+    help = '''Measures the throughput of the notification worker against a local SMTP sink.
+
+    Publishes --messages notifications to an in-memory queue, then sends them with
+    EmailNotificationWorker once per --concurrency value, to an SMTP sink (utils.smtpsink)
+    taking --latency milliseconds per email.  The notifications go from and to facilities
+    of the database, e.g. as seeded by `seed_benchmark`.
+    '''
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=500)
+        parser.add_argument('--concurrency', default='1,4,16', help='Comma separated sender thread counts.')
+        parser.add_argument('--prefetch', type=int, default=20)
+        parser.add_argument('--latency', type=float, default=20.0, help='Milliseconds the sink takes per email.')
+        parser.add_argument('--timeout', type=float, default=300.0, help='Seconds a run may take.')
+
+    def handle(self, *args, **options):
+        try:
+            concurrencies = [int(value) for value in options['concurrency'].split(',')]
+        except ValueError:
+            raise CommandError('--concurrency must be a list of numbers, e.g. 1,4,16.')
+
+        destination = HealthFacility.objects.filter(members__isnull=False).order_by('id').first()
+        reporter = User.objects.filter(health_facility__isnull=False).exclude(health_facility=destination) \
+            .order_by('id').first()
+        if destination is None or reporter is None:
+            raise CommandError('There are no facilities with members to notify, run `seed_benchmark` first.')
+        bodies = [
+            dict(make_case_payload(i), mi=i, ci=i, email=reporter.email, code=destination.code)
+            for i in range(options['messages'])
+        ]
+
+        sink = SMTPSink(latency=options['latency'] / 1000).start()
+        try:
+            for concurrency in concurrencies:
+                sink.reset()
+                elapsed, worker = self.run_worker(bodies, sink, concurrency, options)
+                self.stdout.write(
+                    f'concurrency {concurrency:>3}, prefetch {options["prefetch"]}: {worker.sent} sent, '
+                    f'{worker.failed} failed in {elapsed:.2f}s ({worker.sent / elapsed:.0f} emails/s) '
+                    f'over {sink.connections} SMTP connection(s)'
+                )
+        finally:
+            sink.stop()
+
+    @staticmethod
+    def run_worker(bodies: list, sink: SMTPSink, concurrency: int, options: dict) -> tuple:
+        name = f'benchmark-notifications-{concurrency}'
+        notifications = Queue(name, Exchange(name, type='direct'), routing_key=name)
+        # the in-memory transport polls its queues once a second by default
+        with Connection('memory://', transport_options={'polling_interval': 0.01}) as conn:
+            producer = conn.Producer(serializer='json')
+            for body in bodies:
+                producer.publish(body, exchange=notifications.exchange, routing_key=name, declare=[notifications])
+
+            worker = EmailNotificationWorker(
+                conn, [notifications], prefetch=options['prefetch'], concurrency=concurrency,
+                get_mail_connection=lambda: get_connection(
+                    'django.core.mail.backends.smtp.EmailBackend', host='127.0.0.1', port=sink.port,
+                    username='', password='', use_tls=False, use_ssl=False
+                )
+            )
+            thread = threading.Thread(target=worker.run)
+            started = time.perf_counter()
+            thread.start()
+            try:
+                while worker.sent + worker.failed < len(bodies):
+                    if time.perf_counter() - started > options['timeout']:
+                        raise CommandError(f'The worker took more than {options["timeout"]}s.')
+                    time.sleep(0.01)
+                elapsed = time.perf_counter() - started
+            finally:
+                worker.should_stop = True
+                thread.join()
+                worker.close()
+        return elapsed, worker
@@ -0,0 +1,156 @@
+import logging
+import time
+from datetime import timedelta
+
+from django.core.mail import get_connection
+from django.core.management import BaseCommand
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from sms.helpers import get_notification_renderer, is_transient_email_error, send_notification_emails
+from sms.models import NotificationOutbox
+from sms.recipients import get_recipients
+
+logger = logging.getLogger(__name__)
+
+# how long a claimed batch is kept from the other drain workers; a worker that dies while
+# sending releases its rows after this
+CLAIM_TIMEOUT = timedelta(minutes=5)
+# delay before the next attempt at a notification that failed, doubled after each failure
+RETRY_DELAY = timedelta(seconds=30)
+MAX_RETRY_DELAY = timedelta(hours=1)
+
+
+class Command(BaseCommand):
+    help = 'Sends the queued notification emails in batches, over a single SMTP connection.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=50,
+                            help='Notifications claimed and sent per batch.')
+        parser.add_argument('--interval', type=float, default=5.0,
+                            help='Seconds to wait before polling again once the outbox is empty.')
+        parser.add_argument('--max-interval', type=float, default=300.0,
+                            help='Seconds to wait at most while the mail server is unavailable.')
+        parser.add_argument('--max-attempts', type=int, default=5,
+                            help='Failed notifications are retried until they reach this many attempts.')
+        parser.add_argument('--once', action='store_true',
+                            help='Drain the outbox once and exit, instead of polling forever.')
+
+    def handle(self, *args, **options):
+        connection = get_connection()
+        interval = options['interval']
+        try:
+            while True:
+                try:
+                    sent = drain_notification_outbox(connection, options['batch_size'], options['max_attempts'])
+                except Exception as e:
+                    if not is_transient_email_error(e):
+                        raise
+                    # mail server unavailable or throttling, the batch is queued again: back off
+                    self.stderr.write(f'Cannot send notifications, retrying in {interval:g}s: {e!r}')
+                    connection.close()
+                    if options['once']:
+                        break
+                    time.sleep(interval)
+                    interval = min(interval * 2, options['max_interval'])
+                    continue
+                interval = options['interval']
+                if sent:
+                    self.stdout.write(f'Processed {sent} notification(s)')
+                    continue
+                if options['once']:
+                    break
+                connection.close()
+                time.sleep(interval)
+        finally:
+            connection.close()
+
+
+def claim_notifications(batch_size: int=50) -> list:
+    """ Claims a batch of due notifications for `CLAIM_TIMEOUT`, in a transaction of its own.
+
+    Rows are locked with SKIP LOCKED while claimed, so several drain workers can run side by
+    side; the locks are released before anything is sent.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        batch = list(
+            NotificationOutbox.objects
+            .select_for_update(skip_locked=True, of=('self',))
+            .select_related('reporter__health_facility', 'destination_facility')
+            .filter(sent__isnull=True, dead__isnull=True, next_attempt__lte=now)
+            .order_by('next_attempt', 'id')[:batch_size]
+        )
+        NotificationOutbox.objects.filter(pk__in=[n.pk for n in batch]).update(next_attempt=now + CLAIM_TIMEOUT)
+    return batch
+
+
+def drain_notification_outbox(connection, batch_size=50, max_attempts=5) -> int:
+    """ Sends one batch of due notifications over `connection`, which is left open so that
+    the next batch can reuse it.
+
+    Notifications go to the members of their destination facility; the ones with nobody to
+    notify are marked sent without an email.  The others are rendered together and sent with
+    a single `send_messages` call (see `send_notification_emails`).  A notification that fails
+    is retried after a growing delay, and marked dead at its `max_attempts`th attempt.  When
+    the mail server is unavailable or throttling (see `is_transient_email_error`), the batch
+    stops there and the error is raised; the notifications not sent are released without
+    counting an attempt.
+
+    :return: the number of notifications handled in this batch, sent or failed
+    """
+    batch = claim_notifications(batch_size)
+    if not batch:
+        return 0
+
+    sent, failed, to_send = [], [], []
+    try:
+        for notification in batch:
+            recipients = get_recipients(notification.destination_facility_id)
+            if not recipients:
+                # as the queue worker does, there is nobody to send it to
+                logger.info(f'Nobody to notify at facility {notification.destination_facility_id} '
+                            f'of notification {notification.pk}')
+                sent.append(notification.pk)
+            elif notification.reporter is None or notification.reporter.health_facility is None:
+                failed.append((notification, ValueError(
+                    f'Reporter {notification.reporter_id} is unknown or has no health facility')))
+            else:
+                to_send.append((notification, list(recipients)))
+        if not to_send:
+            return len(batch)
+
+        emails = get_notification_renderer().render_many(
+            (n.reporter, n.destination_facility, n.payload, recipients) for n, recipients in to_send
+        )
+        connection.open()
+        errors = send_notification_emails(emails, connection)
+        for (notification, _), error in zip(to_send, errors):
+            if error is None:
+                sent.append(notification.pk)
+            elif is_transient_email_error(error):
+                # the last one attempted, the rest of the batch is released
+                raise error
+            else:
+                failed.append((notification, error))
+    finally:
+        now = timezone.now()
+        NotificationOutbox.objects.filter(pk__in=sent).update(sent=now, attempts=F('attempts') + 1)
+        for notification, error in failed:
+            fail_notification(notification, error, max_attempts, now)
+        handled = set(sent) | {notification.pk for notification, _ in failed}
+        NotificationOutbox.objects.filter(pk__in=[n.pk for n in batch if n.pk not in handled]).update(next_attempt=now)
+
+    return len(batch)
+
+
+def fail_notification(notification: NotificationOutbox, error: Exception, max_attempts: int, now):
+    attempts = notification.attempts + 1
+    if attempts >= max_attempts:
+        logger.error(f'Giving up on notification {notification.pk} after {attempts} attempt(s): {error!r}')
+        changes = {'dead': now}
+    else:
+        logger.warning(f'Cannot send notification {notification.pk}, attempt {attempts}: {error!r}')
+        changes = {'next_attempt': now + min(RETRY_DELAY * 2 ** (attempts - 1), MAX_RETRY_DELAY)}
+    NotificationOutbox.objects.filter(pk=notification.pk).update(attempts=attempts, last_error=repr(error), **changes)
@@ -1,61 +1,254 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from smtplib import SMTPServerDisconnected
+
 from django.conf import settings
+from django.core.mail import get_connection
 from django.core.management import BaseCommand
-from django.db import transaction
-from kombu import Connection, Exchange, Queue, Message
+from django.db import OperationalError, close_old_connections
+from django.utils import timezone
+from kombu import Connection, Message, Producer
 from kombu.mixins import ConsumerMixin
 
-from sms.helpers import send_notification_email
-from users.models import User
+from sms.helpers import build_notification_email, is_transient_email_error
+from sms.queue import ERROR_HEADER, RETRIES_HEADER, get_dead_letter_queue, get_notification_queue, get_retry_queues
+from sms.recipients import get_facility, get_recipients, get_user
+
+logger = logging.getLogger(__name__)
 
 
 class Command(BaseCommand):
-    command = None
+    help = 'Sends the notification emails published to the notification queue (see sms.queue).'
 
     def add_arguments(self, parser):
-        pass
+        parser.add_argument('--prefetch', type=int, default=20,
+                            help='Messages delivered ahead of their acknowledgement, at most.')
+        parser.add_argument('--concurrency', type=int, default=4,
+                            help='Threads sending the emails, each over its own SMTP connection.')
 
     def handle(self, *args, **options):
-        exchange = Exchange(f"{settings.EMAIL_NOTIF_QUEUE_NAME}", type="direct")
-        queues = [Queue(f"{settings.EMAIL_NOTIF_QUEUE_NAME}", exchange, routing_key=f"{settings.EMAIL_NOTIF_QUEUE_NAME}")]
-        connection = f'amqp://{settings.QUEUE_USER}:{settings.QUEUE_PASSWORD}@{settings.QUEUE_SERVER}//'
-        with Connection(connection, heartbeat=4) as conn:
-            worker = EmailNotificationWorker(conn, queues)
-            worker.run()
+        name = settings.EMAIL_NOTIF_QUEUE_NAME
+        with Connection(settings.NOTIFICATION_BROKER_URL, heartbeat=4) as conn:
+            worker = EmailNotificationWorker(conn, [get_notification_queue(name)], prefetch=options['prefetch'],
+                                             concurrency=options['concurrency'],
+                                             retry_queues=get_retry_queues(name, settings.NOTIFICATION_RETRY_DELAYS),
+                                             dead_letter_queue=get_dead_letter_queue(name))
+            try:
+                worker.run()
+            finally:
+                worker.close()
 
 
 class EmailNotificationWorker(ConsumerMixin):
-    def __init__(self, connection, queues):
+    """ Sends the notification emails from a pool of threads.
+
+    Up to `prefetch` messages are delivered ahead and handed to `concurrency` sender
+    threads, each keeping its own SMTP connection open from one email to the next.  A
+    channel can't be shared between threads, so the senders report back through a queue,
+    and messages are acknowledged on the consumer thread, once their email was sent.
+
+    A notification that could not be sent is published to the next of the `retry_queues`
+    (see sms.queue), or to the `dead_letter_queue` when it failed for good (e.g. it is
+    `UndeliverableNotification`) or too many times, then acknowledged.  Without them, it
+    is rejected.  While the SMTP server throttles us, all the senders wait, longer after
+    each refusal.
+    """
+    # seconds between two checks for finished sends while no message comes in
+    ack_interval = 0.1
+    # seconds the senders wait after a transient error, doubled on each one in a row
+    min_backoff = 1.0
+    max_backoff = 60.0
+
+    def __init__(self, connection, queues, prefetch: int=20, concurrency: int=4, get_mail_connection=get_connection,
+                 retry_queues: list=(), dead_letter_queue=None):
         self.connection = connection
         self.queues = queues
+        self.prefetch = prefetch
+        self.retry_queues = list(retry_queues)
+        self.dead_letter_queue = dead_letter_queue
+        self.producer = None
+        self.get_mail_connection = get_mail_connection
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.local = threading.local()
+        self.mail_connections = []
+        self.mail_connections_lock = threading.Lock()
+        # (message, error) of the finished sends, to acknowledge
+        self.done = queue.Queue()
+        self.in_flight = 0
+        self.sent = self.retried = self.failed = 0
+        self.backoff = 0.0
+        self.resume_at = 0.0
+        self.backoff_lock = threading.Lock()
+
+    def get_consumers(self, Consumer, channel):
+        return [Consumer(queues=self.queues,
+                         callbacks=[self.on_message],
+                         prefetch_count=self.prefetch,
+                         accept=['json'])]
+
+    def run(self, _tokens=1, **kwargs):
+        kwargs.setdefault('safety_interval', self.ack_interval)
+        super().run(_tokens, **kwargs)
+
+    def on_consume_ready(self, connection, channel, consumers, **kwargs):
+        for q in self.retry_queues + [self.dead_letter_queue]:
+            if q is not None:
+                q(channel).declare()
+        self.producer = Producer(channel, serializer='json', auto_declare=False)
 
     def on_message(self, body, message: Message):
+        self.in_flight += 1
+        self.executor.submit(self.send, body, message)
+
+    def on_iteration(self):
+        if self.in_flight >= self.prefetch:
+            # no message comes in until one is acknowledged: wait for a send to finish,
+            # rather than for the broker (but not for long, heartbeats are due)
+            try:
+                self.settle(*self.done.get(timeout=self.ack_interval))
+            except queue.Empty:
+                return
+        while True:
+            try:
+                self.settle(*self.done.get_nowait())
+            except queue.Empty:
+                return
+
+    def on_consume_end(self, connection, channel):
+        # stopping: wait for the sends in progress, their messages can still be acknowledged
+        while self.in_flight:
+            self.settle(*self.done.get())
+
+    def settle(self, message: Message, error: Exception=None):
+        self.in_flight -= 1
         try:
-            with transaction.atomic(using='default'):
-                process_email_notification(body)
-            message.ack()
-        except Exception:
-            # _log.error(f'cant save email notification {body}')
+            if error is None:
+                message.ack()
+                self.sent += 1
+            else:
+                self.retry(message, error)
+        except self.connection.connection_errors + self.connection.channel_errors:
+            # the channel it came from is gone, the broker delivers it again
+            pass
+
+    def retry(self, message: Message, error: Exception):
+        """ Publishes the message to its next retry queue, or to the dead letters.
+        """
+        retries = (message.headers or {}).get(RETRIES_HEADER, 0)
+        if is_transient(error) and retries < len(self.retry_queues):
+            destination = self.retry_queues[retries]
+            logger.warning(f'Cannot send email notification {message.payload}, '
+                           f'retrying through {destination.name}: {error!r}')
+            self.retried += 1
+        else:
+            destination = self.dead_letter_queue
+            logger.error(f'Cannot send email notification {message.payload}: {error!r}')
+            self.failed += 1
+        if destination is None:
             message.reject()
+            return
+        self.producer.publish(
+            message.payload, exchange='', routing_key=destination.name, delivery_mode=2,
+            headers={RETRIES_HEADER: retries + 1, ERROR_HEADER: f'{timezone.now().isoformat()} {error!r}'}
+        )
+        message.ack()
+
+    def send(self, body, message: Message):
+        """ Runs on a sender thread.
+        """
+        close_old_connections()
+        self.wait_for_backoff()
+        try:
+            mail_connection = self.get_thread_mail_connection()
+            try:
+                process_email_notification(body, mail_connection)
+            except SMTPServerDisconnected:
+                # the server dropped the idle connection
+                mail_connection.close()
+                process_email_notification(body, mail_connection)
+        except Exception as e:
+            if is_transient(e):
+                # start over on a new SMTP connection, after the backoff
+                self.close_thread_mail_connection()
+                self.back_off()
+            self.done.put((message, e))
+        else:
+            self.backoff = 0.0
+            self.done.put((message, None))
+
+    def wait_for_backoff(self):
+        delay = self.resume_at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def back_off(self):
+        with self.backoff_lock:
+            self.backoff = min(self.max_backoff, self.backoff * 2 or self.min_backoff)
+            self.resume_at = max(self.resume_at, time.monotonic() + self.backoff)
+
+    def get_thread_mail_connection(self):
+        mail_connection = getattr(self.local, 'mail_connection', None)
+        if mail_connection is None:
+            mail_connection = self.local.mail_connection = self.get_mail_connection()
+            with self.mail_connections_lock:
+                self.mail_connections.append(mail_connection)
+        return mail_connection
+
+    def close_thread_mail_connection(self):
+        mail_connection = getattr(self.local, 'mail_connection', None)
+        if mail_connection is not None:
+            try:
+                mail_connection.close()
+            except Exception:
+                # it is dropped anyway
+                pass
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        for mail_connection in self.mail_connections:
+            mail_connection.close()
+        close_old_connections()
+
+
+def is_transient(error: Exception) -> bool:
+    """ Whether a notification that failed with this error may be sent later.
+    """
+    return is_transient_email_error(error) or isinstance(error, OperationalError)
+
+
+def process_email_notification(body, connection=None) -> int:
+    """ Sends the notification of a queued message (see sms.models.build_queue_messages) to
+    the members of its destination facility, as a single email.
+
+    The reporter, destination and recipients come from the cache of sms.recipients.
+
+    :param connection: the email backend to send it with, kept open
+    :return: the number of emails sent
+    :raises UndeliverableNotification: for an unknown reporter or destination, or a reporter
+        without a health facility
+    """
+    reporter = get_user(email=body.get('email'))
+    if reporter is None or reporter.health_facility is None:
+        raise UndeliverableNotification(f'Reporter {body.get("email")!r} is unknown or has no health facility')
+    destination = get_facility(code=body.get('code'))
+    if destination is None:
+        raise UndeliverableNotification(f'Destination facility {body.get("code")!r} is unknown')
+    recipients = get_recipients(destination.pk)
+    if not recipients:
+        logger.info(f'Nobody to notify at {destination.code} of message {body.get("mi")}')
+        return 0
+
+    email = build_notification_email(reporter, destination, body, recipients=list(recipients))
+    if connection is None:
+        return email.send()
+    connection.open()
+    return connection.send_messages([email])
 
-    def get_consumers(self, Consumer, channel):
-        return [Consumer(queues=self.queues,
-                         callbacks=[self.on_message])]
-
-
-def process_email_notification(body):
-    reporter = User.objects.filter(email=body.get('email')).first()
-    health_facility_member = User.objects.filter(health_facility__code=body.get('code'))
-    case_information = {
-        'name': body.get('name'),
-        'gender': body.get('gender'),
-        'age': body.get('age'),
-        'patient_contact': body.get('patient_contact'),
-        'disease_type': body.get('disease_type'),
-        'case_report_type': body.get('case_report_type'),
-        'classification_case': body.get('classification_case'),
-        'address': body.get('address'),
-        'is_pregnant': body.get('is_pregnant')
-    }
-    for member in health_facility_member:
-        send_notification_email(member, reporter, case_information)
 
+class UndeliverableNotification(Exception):
+    """ Raised for a notification that can never be sent; it goes to the dead letters.
+    """
+    pass
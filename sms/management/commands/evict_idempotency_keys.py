@@ -0,0 +1,11 @@
+from django.core.management import BaseCommand
+
+from sms.models import IdempotencyKey
+
+
+class Command(BaseCommand):
+    help = 'Removes the expired idempotency keys.'
+
+    def handle(self, *args, **options):
+        evicted = IdempotencyKey.objects.evict_expired()
+        self.stdout.write(f'Evicted {evicted} expired idempotency key(s)')
@@ -0,0 +1,49 @@
+import sys
+import time
+
+from django.core.management import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from sms.export import EXPORT_FORMATS, EXPORT_REGION_FILTERS, get_export_queryset, iter_export
+
+
+def date_argument(value):
+    day = parse_date(value)
+    if day is None:
+        raise ValueError(value)
+    return day
+
+
+class Command(BaseCommand):
+    help = 'Exports the active cases as CSV or NDJSON, streamed in constant memory.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', '-o', help='File to write to, the standard output by default.')
+        parser.add_argument('--format', choices=list(EXPORT_FORMATS), default='csv', dest='export_format')
+        parser.add_argument('--from', type=date_argument, dest='date_from', help='First day (YYYY-MM-DD).')
+        parser.add_argument('--to', type=date_argument, dest='date_to', help='Last day (YYYY-MM-DD).')
+        for region in EXPORT_REGION_FILTERS:
+            parser.add_argument(f'--{region.replace("_", "-")}', type=int, dest=region,
+                                help=f'Only export the cases of this {region.replace("_", " ")} id.')
+
+    def handle(self, *args, **options):
+        queryset = get_export_queryset(
+            date_from=options['date_from'],
+            date_to=options['date_to'],
+            **{region: options[region] for region in EXPORT_REGION_FILTERS}
+        )
+
+        started, size = time.perf_counter(), 0
+        try:
+            output = open(options['output'], 'wb') if options['output'] else sys.stdout.buffer
+        except OSError as e:
+            raise CommandError(f'Cannot write to {options["output"]}: {e}')
+        try:
+            for chunk in iter_export(queryset, options['export_format']):
+                output.write(chunk)
+                size += len(chunk)
+        finally:
+            if options['output']:
+                output.close()
+
+        self.stderr.write(f'Exported {size} bytes in {time.perf_counter() - started:.2f}s')
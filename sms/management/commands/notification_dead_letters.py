@@ -0,0 +1,66 @@
+import json
+
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+from kombu import Connection
+
+from sms.queue import ERROR_HEADER, RETRIES_HEADER, get_dead_letter_queue, get_publisher
+
+
+class Command(BaseCommand):
+    help = '''Lists the notifications the worker gave up on (see sms.queue), or sends them again.
+
+    Listed notifications stay in the dead letter queue.  With --replay they are published to
+    the notification queue again, with their retries reset; with --purge they are dropped.
+    '''
+
+    def add_arguments(self, parser):
+        parser.add_argument('--replay', action='store_true', help='Publishes them to the notification queue again.')
+        parser.add_argument('--purge', action='store_true', help='Drops them.')
+        parser.add_argument('--limit', type=int, default=None, help='Handles the oldest ones only.')
+        parser.add_argument('--batch-size', type=int, default=100, help='Notifications replayed per batch.')
+
+    def handle(self, *args, **options):
+        if options['replay'] and options['purge']:
+            raise CommandError('--replay and --purge can\'t be used together.')
+        limit = options['limit']
+
+        handled = 0
+        with Connection(settings.NOTIFICATION_BROKER_URL) as conn:
+            dead_letters = get_dead_letter_queue(settings.EMAIL_NOTIF_QUEUE_NAME)(conn.default_channel)
+            dead_letters.declare()
+            listed, batch = [], []
+            while limit is None or handled < limit:
+                # held until the end, so that the next get does not return the same one again
+                message = dead_letters.get(accept=['json'])
+                if message is None:
+                    break
+                handled += 1
+                headers = message.headers or {}
+                self.stdout.write(
+                    f'{json.dumps(message.payload)}\n'
+                    f'    {headers.get(RETRIES_HEADER, 0)} attempt(s), last error {headers.get(ERROR_HEADER)}'
+                )
+                if options['purge']:
+                    message.ack()
+                elif options['replay']:
+                    batch.append(message)
+                    if len(batch) >= options['batch_size']:
+                        self.replay(batch)
+                        batch = []
+                else:
+                    listed.append(message)
+            if batch:
+                self.replay(batch)
+            for message in listed:
+                message.requeue()
+
+        action = 'replayed' if options['replay'] else 'purged' if options['purge'] else 'dead'
+        self.stdout.write(f'{handled} notification(s) {action}')
+
+    @staticmethod
+    def replay(messages: list):
+        # those the broker does not confirm are spilled to disk, they can go either way
+        get_publisher().publish([message.payload for message in messages])
+        for message in messages:
+            message.ack()
@@ -0,0 +1,11 @@
+from django.core.management import BaseCommand
+
+from sms.models import CaseDailyRollup
+
+
+class Command(BaseCommand):
+    help = 'Recounts the daily case rollups from the case_information table.'
+
+    def handle(self, *args, **options):
+        cells = CaseDailyRollup.objects.rebuild()
+        self.stdout.write(f'Rebuilt {cells} case rollup cell(s)')
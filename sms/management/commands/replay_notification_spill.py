@@ -0,0 +1,17 @@
+from django.core.management import BaseCommand
+
+from sms.queue import get_publisher
+
+
+class Command(BaseCommand):
+    help = 'Publishes the notifications spilled to disk while the broker was unreachable (see sms.queue).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Notifications published per batch.')
+
+    def handle(self, *args, **options):
+        read, confirmed, skipped = get_publisher().replay(batch_size=options['batch_size'])
+        self.stdout.write(
+            f'Replayed {read} notification(s): {confirmed} published, {read - confirmed} spilled again, '
+            f'{skipped} unreadable line(s) skipped'
+        )
@@ -0,0 +1,229 @@
+import time
+
+from django.contrib.auth.hashers import make_password
+from django.core.management import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from healthfacility.cache import facility_cache
+from healthfacility.models import HealthFacility, FacilityReferral
+from masterdata.cache import region_cache
+from masterdata.models import Province, City, District, SubDistrict
+from sms.models import CaseInformation, MessageInformation, NotificationOutbox, IdempotencyKey, CaseDailyRollup
+from users.models import User
+
+# emptied by --flush, children first
+SEEDED_MODELS = (
+    NotificationOutbox, IdempotencyKey, MessageInformation, CaseDailyRollup, CaseInformation,
+    FacilityReferral, User, HealthFacility, SubDistrict, District, City, Province,
+)
+
+REGIONS_SQL = (
+    """
+    INSERT INTO master_province (name, code, is_active, created)
+    SELECT 'Provinsi ' || p, 'P' || p, true, now() FROM generate_series(1, %(provinces)s) p
+    """,
+    """
+    INSERT INTO master_city (name, code, is_active, created, province_id)
+    SELECT 'Kabupaten ' || p.code || '.' || c, p.code || '.' || c, true, now(), p.id
+    FROM master_province p CROSS JOIN generate_series(1, %(cities)s) c ORDER BY p.id, c
+    """,
+    """
+    INSERT INTO master_district (name, code, is_active, created, city_id)
+    SELECT 'Kecamatan ' || c.code || '.' || d, c.code || '.' || d, true, now(), c.id
+    FROM master_city c CROSS JOIN generate_series(1, %(districts)s) d ORDER BY c.id, d
+    """,
+    """
+    INSERT INTO master_sub_district (name, code, is_active, created, district_id)
+    SELECT 'Desa ' || d.code || '.' || s, d.code || '.' || s, true, now(), d.id
+    FROM master_district d CROSS JOIN generate_series(1, %(sub_districts)s) s ORDER BY d.id, s
+    """,
+)
+
+# every sub-district gets a spot somewhere over eastern Indonesia, its facilities are scattered around it
+FACILITY_COLUMNS = (
+    'name, is_active, created, modified, code, facility_level, address, latitude, longitude, '
+    'linked_facility_id, province_id, city_id, district_id, sub_district_id'
+)
+SUB_DISTRICT_LATITUDE = '(-8 + (s.id * 7919 %% 1000) / 100.0 + random() / 20)'
+SUB_DISTRICT_LONGITUDE = '(120 + (s.id * 104729 %% 1500) / 100.0 + random() / 20)'
+SUB_DISTRICTS = (
+    'master_sub_district s JOIN master_district d ON d.id = s.district_id JOIN master_city c ON c.id = d.city_id'
+)
+
+FACILITIES_SQL = (
+    # a district health office per district, in its first sub-district
+    f"""
+    INSERT INTO health_facility ({FACILITY_COLUMNS})
+    SELECT 'Dinas Kesehatan ' || d.code, true, now(), now(), 'D' || d.id, '3', 'Jl. Dinas No. ' || d.id,
+        {SUB_DISTRICT_LATITUDE}, {SUB_DISTRICT_LONGITUDE}, NULL, c.province_id, d.city_id, d.id, s.id
+    FROM {SUB_DISTRICTS}
+    WHERE s.id = (SELECT min(id) FROM master_sub_district WHERE district_id = d.id)
+    ORDER BY s.id
+    """,
+    # a health center per sub-district, linked to the district health office
+    f"""
+    INSERT INTO health_facility ({FACILITY_COLUMNS})
+    SELECT 'Puskesmas ' || s.code, true, now(), now(), 'H' || s.id, '2', 'Jl. Puskesmas No. ' || s.id,
+        {SUB_DISTRICT_LATITUDE}, {SUB_DISTRICT_LONGITUDE}, o.id, c.province_id, d.city_id, d.id, s.id
+    FROM {SUB_DISTRICTS} JOIN health_facility o ON o.district_id = d.id AND o.facility_level = '3'
+    ORDER BY s.id
+    """,
+    # clinics, linked to the health center of their sub-district
+    f"""
+    INSERT INTO health_facility ({FACILITY_COLUMNS})
+    SELECT 'Pustu ' || s.code || '-' || n, true, now(), now(), 'C' || s.id || '-' || n, '1',
+        'Jl. Pustu No. ' || n, {SUB_DISTRICT_LATITUDE}, {SUB_DISTRICT_LONGITUDE}, h.id,
+        c.province_id, d.city_id, d.id, s.id
+    FROM {SUB_DISTRICTS} JOIN health_facility h ON h.sub_district_id = s.id AND h.facility_level = '2'
+        CROSS JOIN generate_series(1, %(clinics)s) n
+    ORDER BY s.id, n
+    """,
+)
+
+# one user per health center and clinic, all with the same password
+USERS_SQL = """
+    INSERT INTO "user" (password, is_superuser, is_staff, is_active, date_joined, email, first_name, last_name,
+        phone_number, health_facility_id)
+    SELECT %(password)s, false, false, true, now(), 'petugas' || f.id || '@benchmark.test', 'Petugas', f.code,
+        '+62' || lpad(f.id::text, 10, '0'), f.id
+    FROM health_facility f WHERE f.facility_level IN ('1', '2') ORDER BY f.id
+"""
+
+# numbered reporters (clinic users) and sub-districts, to draw from at random
+DRAW_TABLES_SQL = (
+    """
+    CREATE TEMPORARY TABLE seed_reporter ON COMMIT DROP AS
+    SELECT row_number() OVER (ORDER BY u.id) AS n, u.id AS user_id,
+        f.province_id, f.city_id, f.district_id, f.sub_district_id
+    FROM "user" u JOIN health_facility f ON f.id = u.health_facility_id WHERE f.facility_level = '1'
+    """,
+    """
+    CREATE TEMPORARY TABLE seed_sub_district ON COMMIT DROP AS
+    SELECT row_number() OVER (ORDER BY s.id) AS n, s.id AS sub_district_id, d.id AS district_id,
+        d.city_id, c.province_id
+    FROM {sub_districts}
+    """.format(sub_districts=SUB_DISTRICTS),
+)
+
+CASES_SQL = """
+    INSERT INTO case_information (name, is_active, created, modified, gender, age, patient_contact, disease_type,
+        case_report_type, classification_case, address, latitude, longitude, user_id, is_pregnant,
+        province_id, city_id, district_id, sub_district_id)
+    SELECT 'Pasien ' || g.i, true, g.created, g.created, g.gender, g.age, '08' || (1000000000 + g.i),
+        g.disease_type, g.case_report_type, g.classification_case, 'Jl. Pattimura No. ' || (g.i %% 200 + 1), 0, 0,
+        r.user_id, g.gender = '2' AND g.age BETWEEN 15 AND 45 AND random() < 0.1,
+        coalesce(s.province_id, r.province_id), coalesce(s.city_id, r.city_id),
+        coalesce(s.district_id, r.district_id), coalesce(s.sub_district_id, r.sub_district_id)
+    FROM (
+        SELECT i,
+            1 + floor(random() * %(reporters)s)::integer AS reporter,
+            CASE WHEN random() < %(other_sub_district)s
+                THEN 1 + floor(random() * %(sub_districts)s)::integer END AS sub_district,
+            now() - random() * %(days)s * interval '1 day' AS created,
+            (ARRAY['1', '2'])[1 + floor(random() * 2)::integer] AS gender,
+            1 + floor(random() * 80)::integer AS age,
+            (ARRAY['pf', 'pf', 'pf', 'pv', 'pv', 'pm', 'po'])[1 + floor(random() * 7)::integer] AS disease_type,
+            (ARRAY['pcd', 'pcd', 'acd'])[1 + floor(random() * 3)::integer] AS case_report_type,
+            (ARRAY['imp', 'ind', 'ind'])[1 + floor(random() * 3)::integer] AS classification_case
+        FROM generate_series(%(start)s, %(stop)s) i
+    ) g
+    JOIN seed_reporter r ON r.n = g.reporter
+    LEFT JOIN seed_sub_district s ON s.n = g.sub_district
+    ORDER BY g.created
+"""
+
+# the messages `get_case_destinations()` would have sent: to the linked facility, and to every
+# facility of the patient's sub-district when it is not the reporter's
+MESSAGES_SQL = """
+    INSERT INTO message_information (created, modified, message_type, case_information_id,
+        origin_facility_id, destination_facility_id)
+    SELECT c.created, c.created, 'inbox', c.id, f.id, f.linked_facility_id
+    FROM case_information c JOIN "user" u ON u.id = c.user_id JOIN health_facility f ON f.id = u.health_facility_id
+    WHERE c.id > %(after)s
+    UNION ALL
+    SELECT c.created, c.created, 'inbox', c.id, f.id, d.id
+    FROM case_information c JOIN "user" u ON u.id = c.user_id JOIN health_facility f ON f.id = u.health_facility_id
+        JOIN health_facility d ON d.sub_district_id = c.sub_district_id
+    WHERE c.id > %(after)s AND c.sub_district_id <> f.sub_district_id
+"""
+
+
+class Command(BaseCommand):
+    help = '''Seeds a dataset for the `benchmark_api` command.
+
+    Writes a region hierarchy, a district health office per district, a health center per
+    sub-district and clinics under it, a user per health center and clinic (all with the
+    same password), and cases reported by the clinics over the last days, with the messages
+    case routing would have sent.  Everything is generated by the database, from a fixed
+    seed, so two runs with the same options produce the same dataset.
+
+    The defaults give about 4,600 facilities, a million cases and two million messages.
+    Refuses to write into a database that already has regions, facilities, users or cases,
+    unless --flush is given, which first EMPTIES those tables.
+    '''
+
+    def add_arguments(self, parser):
+        parser.add_argument('--provinces', type=int, default=4)
+        parser.add_argument('--cities', type=int, default=5, help='Cities per province.')
+        parser.add_argument('--districts', type=int, default=5, help='Districts per city.')
+        parser.add_argument('--sub-districts', type=int, default=5, help='Sub districts per district.')
+        parser.add_argument('--clinics', type=int, default=8, help='Clinics per sub district.')
+        parser.add_argument('--cases', type=int, default=1000000)
+        parser.add_argument('--days', type=int, default=365, help='Cases are spread over this many days.')
+        parser.add_argument('--other-sub-district', type=float, default=0.1,
+                            help='Share of the patients living outside the sub district of their clinic.')
+        parser.add_argument('--password', default='benchmark', help='Password of the seeded users.')
+        parser.add_argument('--seed', type=float, default=0.42, help='Random seed, between -1 and 1.')
+        parser.add_argument('--batch-size', type=int, default=100000, help='Cases written per statement.')
+        parser.add_argument('--flush', action='store_true',
+                            help='Delete every region, facility, user, case and message first.')
+
+    def handle(self, *args, **options):
+        if not -1 <= options['seed'] <= 1:
+            raise CommandError('--seed must be between -1 and 1.')
+        started = time.perf_counter()
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            if options['flush']:
+                tables = ', '.join(connection.ops.quote_name(model._meta.db_table) for model in SEEDED_MODELS)
+                cursor.execute(f'TRUNCATE {tables} RESTART IDENTITY CASCADE')
+            elif any(model.objects.exists() for model in (Province, HealthFacility, User, CaseInformation.all_objects)):
+                raise CommandError('The database already has data, seed an empty one or pass --flush.')
+
+            cursor.execute('SELECT setseed(%s)', [options['seed']])
+            for sql in REGIONS_SQL + FACILITIES_SQL:
+                cursor.execute(sql, options)
+            cursor.execute(USERS_SQL, {'password': make_password(options['password'])})
+            self.report('regions, facilities and users', started)
+
+            for sql in DRAW_TABLES_SQL:
+                cursor.execute(sql)
+            params = dict(options, reporters=User.objects.filter(health_facility__facility_level='1').count(),
+                          sub_districts=SubDistrict.objects.count())
+            for start in range(1, options['cases'] + 1, options['batch_size']):
+                stop = min(start + options['batch_size'] - 1, options['cases'])
+                cursor.execute('SELECT coalesce(max(id), 0) FROM case_information')
+                after, = cursor.fetchone()
+                cursor.execute(CASES_SQL, dict(params, start=start, stop=stop))
+                cursor.execute(MESSAGES_SQL, {'after': after})
+                self.report(f'{stop} cases', started)
+
+            # the rows were not written through save(): rebuild what the signals maintain
+            FacilityReferral.objects.rebuild()
+            CaseDailyRollup.objects.rebuild()
+
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+        # reaches running servers through a shared cache backend, or after RESPONSE_CACHE_MAX_AGE
+        region_cache.invalidate()
+        facility_cache.invalidate()
+
+        self.stdout.write(
+            f'Seeded {Province.objects.count()} province(s), {SubDistrict.objects.count()} sub district(s), '
+            f'{HealthFacility.objects.count()} facilities, {User.objects.count()} user(s), '
+            f'{CaseInformation.objects.count()} case(s) and {MessageInformation.objects.count()} message(s) '
+            f'in {time.perf_counter() - started:.1f}s'
+        )
+
+    def report(self, step: str, started: float):
+        self.stdout.write(f'{time.perf_counter() - started:7.1f}s  {step}')
@@ -0,0 +1,21 @@
+# Generated by Django 2.0.2 on 2026-10-18 18:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sms', '0007_auto_20190912_1415'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='messageinformation',
+            index=models.Index(fields=['origin_facility', '-created', '-id'], name='message_origin_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='messageinformation',
+            index=models.Index(fields=['destination_facility', '-created', '-id'], name='message_dest_created_idx'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 2.0.2 on 2026-10-18 18:53
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('sms', '0009_notification_outbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='caseinformation',
+            name='client_reference',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AlterUniqueTogether(
+            name='caseinformation',
+            unique_together={('user', 'client_reference')},
+        ),
+    ]
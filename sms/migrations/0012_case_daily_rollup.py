@@ -0,0 +1,52 @@
+# Generated by Django 2.0.2 on 2026-10-18 19:10
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def populate_rollups(apps, schema_editor):
+    # see CaseDailyRollupQuerySet.rebuild()
+    schema_editor.execute(
+        'INSERT INTO case_daily_rollup (day, province_id, city_id, district_id, sub_district_id, '
+        'disease_type, classification_case, cases) '
+        'SELECT (created AT TIME ZONE %s)::date, COALESCE(province_id, 0), COALESCE(city_id, 0), '
+        'COALESCE(district_id, 0), COALESCE(sub_district_id, 0), disease_type, classification_case, count(*) '
+        'FROM case_information WHERE is_active GROUP BY 1, 2, 3, 4, 5, 6, 7',
+        [settings.TIME_ZONE]
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sms', '0011_idempotency_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CaseDailyRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('province_id', models.IntegerField()),
+                ('city_id', models.IntegerField()),
+                ('district_id', models.IntegerField()),
+                ('sub_district_id', models.IntegerField()),
+                ('disease_type', models.CharField(choices=[('pf', 'Plasmodium Falciparum'), ('pv', 'Plasmodium Vivax'), ('pm', 'Plasmodium Malariae'), ('po', 'Plasmodium Ovale')], max_length=15)),
+                ('classification_case', models.CharField(blank=True, choices=[('imp', 'Imported Case'), ('ind', 'Indigenous Case')], max_length=15)),
+                ('cases', models.IntegerField(default=0)),
+            ],
+            options={
+                'db_table': 'case_daily_rollup',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='casedailyrollup',
+            index=models.Index(fields=['district_id', 'day'], name='rollup_district_day_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='casedailyrollup',
+            unique_together={('day', 'province_id', 'city_id', 'district_id', 'sub_district_id', 'disease_type', 'classification_case')},
+        ),
+        migrations.RunPython(populate_rollups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    """ Indexes of the active cases only, the ones `CaseInformation.objects` returns.
+    """
+
+    dependencies = [
+        ('sms', '0012_case_daily_rollup'),
+    ]
+
+    operations = [
+        # case exports, by creation date
+        migrations.RunSQL(
+            'CREATE INDEX case_active_created_idx ON case_information (created, id) WHERE is_active',
+            'DROP INDEX case_active_created_idx',
+        ),
+    ]
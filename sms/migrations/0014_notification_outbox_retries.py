@@ -0,0 +1,37 @@
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sms', '0013_active_partial_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notificationoutbox',
+            name='next_attempt',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='notificationoutbox',
+            name='dead',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        # the rows the drain used to skip for having failed 5 times
+        migrations.RunSQL(
+            'UPDATE notification_outbox SET dead = now() WHERE sent IS NULL AND attempts >= 5',
+            migrations.RunSQL.noop,
+        ),
+        migrations.RemoveIndex(
+            model_name='notificationoutbox',
+            name='notification_outbox_sent_idx',
+        ),
+        # the rows still to send, by due time
+        migrations.RunSQL(
+            'CREATE INDEX notification_outbox_due_idx ON notification_outbox (next_attempt, id) '
+            'WHERE sent IS NULL AND dead IS NULL',
+            'DROP INDEX notification_outbox_due_idx',
+        ),
+    ]
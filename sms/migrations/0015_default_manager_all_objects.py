@@ -0,0 +1,24 @@
+# Generated by Django 2.0.2 on 2026-10-18 19:58
+
+from django.db import migrations
+import django.db.models.manager
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sms', '0014_notification_outbox_retries'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='caseinformation',
+            options={'default_manager_name': 'all_objects'},
+        ),
+        migrations.AlterModelManagers(
+            name='caseinformation',
+            managers=[
+                ('all_objects', django.db.models.manager.Manager()),
+            ],
+        ),
+    ]
@@ -1,13 +1,21 @@
-from django.db import models, router
-from django.db.models.signals import post_save
+import hashlib
+from collections import OrderedDict, Counter
+
+from django.contrib.postgres.fields import JSONField
+from django.db import models, router, transaction, connections
+from django.db.models.signals import post_save, pre_save
 from django.dispatch import receiver
 from django.urls import reverse
+from django.utils import timezone
 
 from app import settings
 from healthfacility.models import HealthFacility
 from masterdata.models import Province, City, District, SubDistrict
-from sms.helpers import send_notification_email
+from masterdata.names import get_region_names
 from users.models import User
+from sms.queue import NOTIFICATION_BACKEND_AMQP, get_notification_backend, publish_on_commit
+from sms.recipients import get_facility, get_user
+from utils.models import ActiveManager
 
 
 GENDER_TYPE_MEN = '1'
@@ -70,6 +78,9 @@ class CaseInformation(models.Model):
 
     is_pregnant = models.BooleanField(default=False)
 
+    # set by the reporting device, identifies the case across retried batch uploads
+    client_reference = models.CharField(max_length=64, blank=True, null=True)
+
     user = models.ForeignKey(
         User,
         on_delete=models.SET_NULL,
@@ -110,15 +121,30 @@ class CaseInformation(models.Model):
         null=True
     )
 
+    # active cases only, see utils.models.ActiveManager
+    objects = ActiveManager()
+    all_objects = models.Manager()
+
     def __str__(self):
         return f'{self.name}'
 
     class Meta:
         db_table = 'case_information'
+        # `objects` hides the deactivated cases; dumpdata, the admin and the like see them all
+        default_manager_name = 'all_objects'
+        unique_together = ('user', 'client_reference')
 
     def get_absolute_url(self):
         return reverse('case_information_details', kwargs={'pk': self.pk})
 
+    def save(self, *args, **kwargs):
+        """ Saves in a transaction, so that the row locked by `capture_case_rollup_key` stays
+        locked until `update_case_rollup` has moved the case to its new rollup cell.
+        """
+        using = kwargs.get('using') or router.db_for_write(self.__class__, instance=self)
+        with transaction.atomic(using=using):
+            super().save(*args, **kwargs)
+
     def delete(self, using=None, keep_parents=False):
         """
         Override delete, just set is_active = False
@@ -131,6 +157,75 @@ class CaseInformation(models.Model):
         return self.save(using=using)
 
 
+class MessageInformationQuerySet(models.QuerySet):
+
+    def fan_out(self, case_information: CaseInformation, origin_facility: HealthFacility,
+                destination_facility_ids, message_type: str=MESSAGE_TYPE_INBOX) -> list:
+        """ Sends a case from `origin_facility` to each of the destination facilities.
+
+        :return: the messages that were created
+        """
+        return self.fan_out_many(origin_facility, [(case_information, destination_facility_ids)], message_type)
+
+    def fan_out_many(self, origin_facility: HealthFacility, routes: list, message_type: str=MESSAGE_TYPE_INBOX) -> list:
+        """ Sends several cases from `origin_facility`, each to its own destination facilities.
+
+        All messages are written with a single INSERT, and their notifications queued as a
+        single batch, so the number of queries depends neither on the number of cases nor
+        on the number of destinations.  Messages that already exist, e.g. written by a
+        retried or concurrent request, are skipped by the `unique_together` constraint
+        (ON CONFLICT DO NOTHING) and are not notified again.
+
+        :param routes: (case information, destination facility ids) pairs
+        :return: the messages that were created
+        """
+        now = timezone.now()
+        messages = OrderedDict(
+            ((case.pk, destination_facility_id), self.model(
+                case_information=case,
+                origin_facility=origin_facility,
+                destination_facility_id=destination_facility_id,
+                message_type=message_type,
+                created=now,
+                modified=now
+            ))
+            for case, destination_ids in routes
+            for destination_facility_id in destination_ids
+        )
+        if not messages:
+            return []
+
+        columns = 'case_information_id, origin_facility_id, destination_facility_id, message_type'
+        placeholders = ', '.join(['(%s, %s, %s, %s, %s, %s)'] * len(messages))
+        params = [
+            param for m in messages.values()
+            for param in (m.case_information_id, m.origin_facility_id, m.destination_facility_id,
+                          m.message_type, m.created, m.modified)
+        ]
+        with transaction.atomic(using=self.db):
+            with connections[self.db].cursor() as cursor:
+                cursor.execute(
+                    f'INSERT INTO message_information ({columns}, created, modified) VALUES {placeholders} '
+                    f'ON CONFLICT ({columns}) DO NOTHING '
+                    f'RETURNING id, case_information_id, destination_facility_id',
+                    params
+                )
+                inserted = cursor.fetchall()
+
+            ids = {(case_information_id, destination_facility_id): pk
+                   for pk, case_information_id, destination_facility_id in inserted}
+            created = []
+            for key, message in messages.items():
+                if key in ids:
+                    message.pk = ids[key]
+                    message._state.adding = False
+                    message._state.db = self.db
+                    created.append(message)
+            # the INSERT does not send post_save, so queue the notifications here
+            queue_notifications(created, using=self.db)
+        return created
+
+
 class MessageInformation(models.Model):
     case_information = models.ForeignKey(
         CaseInformation,
@@ -157,57 +252,342 @@ class MessageInformation(models.Model):
     modified = models.DateTimeField(auto_now=True)
     message_type = models.CharField(max_length=15, default=MESSAGE_TYPE_INBOX, choices=MESSAGE_TYPES)
 
+    objects = MessageInformationQuerySet.as_manager()
+
     def __str__(self):
         return f'{self.message_type}'
 
     class Meta:
         db_table = 'message_information'
         unique_together = ('case_information', 'origin_facility', 'destination_facility', 'message_type')
+        indexes = [
+            # access paths of the sent / received feeds, newest first (see sms.views)
+            models.Index(fields=['origin_facility', '-created', '-id'], name='message_origin_created_idx'),
+            models.Index(fields=['destination_facility', '-created', '-id'], name='message_dest_created_idx'),
+        ]
+
+
+def build_notification_payload(message: MessageInformation, case_information: CaseInformation) -> dict:
+    regions = get_region_names()
+    return {
+        'mi': message.pk,
+        'ci': case_information.pk,
+        'name': case_information.name,
+        'gender': f'{case_information.get_gender_display()}',
+        'age': case_information.age,
+        'patient_contact': case_information.patient_contact,
+        'disease_type': f'{case_information.get_disease_type_display()}',
+        'case_report_type': f'{case_information.get_case_report_type_display()}',
+        'classification_case': f'{case_information.get_classification_case_display()}',
+        'address': case_information.address,
+        'province': regions['province'].get(case_information.province_id, ''),
+        'city': regions['city'].get(case_information.city_id, ''),
+        'district': regions['district'].get(case_information.district_id, ''),
+        'sub_district': regions['sub_district'].get(case_information.sub_district_id, ''),
+        'is_pregnant': case_information.is_pregnant,
+    }
+
+
+class NotificationOutboxManager(models.Manager):
+
+    def enqueue(self, messages: list) -> list:
+        """ Queues the notifications for freshly created messages with a single INSERT.
+
+        The case information the messages don't already hold is read in one query.
+        Messages without a destination facility have nobody to notify.
+        """
+        messages = [m for m in messages if m.destination_facility_id is not None]
+        if not messages:
+            return []
+
+        cases = get_notified_cases(messages)
+        return self.bulk_create([
+            self.model(
+                message_information=m,
+                reporter_id=cases[m.case_information_id].user_id,
+                destination_facility_id=m.destination_facility_id,
+                payload=build_notification_payload(m, cases[m.case_information_id])
+            )
+            for m in messages
+        ])
+
+
+class NotificationOutbox(models.Model):
+    """ Notification emails waiting to be sent.
+
+    A row is written in the same transaction as the MessageInformation it announces, so
+    creating a case never waits on the mail server; the `drain_notification_outbox`
+    command sends them in batches over a single SMTP connection.
+
+    A row is due from `next_attempt` on: a drain worker claiming it pushes that back while
+    it sends it, and a failure pushes it back further.  Once it failed too many times it is
+    `dead`, and left alone.
+    """
+    message_information = models.ForeignKey(
+        MessageInformation,
+        on_delete=models.CASCADE,
+        related_name='notifications',
+        blank=True,
+        null=True
+    )
+    reporter = models.ForeignKey(
+        User,
+        on_delete=models.SET_NULL,
+        related_name='+',
+        blank=True,
+        null=True
+    )
+    destination_facility = models.ForeignKey(
+        HealthFacility,
+        on_delete=models.SET_NULL,
+        related_name='+',
+        blank=True,
+        null=True
+    )
+    payload = JSONField()
+    created = models.DateTimeField(auto_now_add=True)
+    sent = models.DateTimeField(blank=True, null=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    next_attempt = models.DateTimeField(default=timezone.now)
+    dead = models.DateTimeField(blank=True, null=True)
+
+    objects = NotificationOutboxManager()
+
+    def __str__(self):
+        return f'#MI{self.message_information_id}'
+
+    class Meta:
+        db_table = 'notification_outbox'
+        # the pending rows are read through the partial notification_outbox_due_idx, see
+        # migration 0014
+
+
+def get_notified_cases(messages: list) -> dict:
+    """ The case information of the messages: the instances they were created with, the
+    others read in one query.  Reporters and regions are resolved from the caches.
+    """
+    cases = {
+        m.case_information_id: m.case_information
+        for m in messages if MessageInformation.case_information.is_cached(m)
+    }
+    missing = {m.case_information_id for m in messages} - cases.keys()
+    if missing:
+        cases.update(CaseInformation.objects.in_bulk(missing))
+    return cases
 
 
-# @receiver(post_save, sender=MessageInformation)
-# def create_queue_message(sender, instance: MessageInformation, created, **kwargs):
-#     if created:
-#         notification_message = {
-#             'name': instance.case_information.name,
-#             'gender': f'{instance.case_information.get_gender_display()}',
-#             'age': instance.case_information.age,
-#             'patient_contact': instance.case_information.patient_contact,
-#             'disease_type': f'{instance.case_information.get_disease_type_display()}',
-#             'case_report_type': f'{instance.case_information.get_case_report_type_display()}',
-#             'classification_case': f'{instance.case_information.get_classification_case_display()}',
-#             'address': instance.case_information.address,
-#             'is_pregnant': instance.case_information.is_pregnant,
-#             'email': instance.case_information.user.email,
-#             'from_facility_code': instance.origin_facility.code,
-#             'to_facility_code': instance.destination_facility.code
-#         }
-#         from kombu import Connection
-#         conn_string = f'amqp://{settings.QUEUE_USER}:{settings.QUEUE_PASSWORD}@' \
-#                       f'{settings.QUEUE_SERVER}//'
-#         with Connection(conn_string) as conn:
-#             queue = conn.SimpleQueue(settings.EMAIL_NOTIF_QUEUE_NAME)
-#             queue.put(notification_message)
+def build_queue_messages(messages: list) -> list:
+    """ The queue bodies announcing freshly created messages, as read by the
+    `email_notification_subscribe` worker: the notification payload, with the email of the
+    reporter and the code of the destination facility.
+    """
+    messages = [m for m in messages if m.destination_facility_id is not None]
+    if not messages:
+        return []
+
+    cases = get_notified_cases(messages)
+    bodies = []
+    for m in messages:
+        case_information = cases[m.case_information_id]
+        reporter = get_user(pk=case_information.user_id) if case_information.user_id is not None else None
+        destination = get_facility(pk=m.destination_facility_id)
+        body = build_notification_payload(m, case_information)
+        body['email'] = reporter.email if reporter else None
+        body['code'] = destination.code if destination else None
+        bodies.append(body)
+    return bodies
+
+
+def queue_notifications(messages: list, using: str=None):
+    """ Hands the notifications of freshly created messages to `settings.NOTIFICATION_BACKEND`:
+    queued in the NotificationOutbox, in the same transaction, or published to the
+    notification queue once the transaction commits (see sms.queue).
+    """
+    if get_notification_backend() == NOTIFICATION_BACKEND_AMQP:
+        publish_on_commit(build_queue_messages(messages), using=using)
+    else:
+        NotificationOutbox.objects.db_manager(using).enqueue(messages)
+
+
+class IdempotencyKeyManager(models.Manager):
+
+    def lookup(self, user: User, key: str):
+        """ The Location returned by the original request sent with `key`, or None.
+        """
+        return self.filter(
+            user=user,
+            key=self.digest(key),
+            expires__gt=timezone.now()
+        ).values_list('location', flat=True).first()
+
+    def remember(self, user: User, key: str, location: str):
+        """ Stores the outcome of a request; meant to run in the transaction that performed it,
+        so that a concurrent request with the same key fails on the unique constraint.
+        """
+        digest, now = self.digest(key), timezone.now()
+        self.filter(user=user, key=digest, expires__lte=now).delete()
+        return self.create(user=user, key=digest, location=location, expires=now + settings.IDEMPOTENCY_KEY_TTL)
+
+    def evict_expired(self) -> int:
+        return self.filter(expires__lte=timezone.now()).delete()[0]
+
+    @staticmethod
+    def digest(key: str) -> str:
+        # fixed width, whatever the client sends
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+class IdempotencyKey(models.Model):
+    """ Outcome of a request sent with an `Idempotency-Key` header.
+
+    A retried request with the same key is answered from here, without touching the
+    write path again.  Keys expire after `settings.IDEMPOTENCY_KEY_TTL` and are removed by
+    the `evict_idempotency_keys` command.
+    """
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='+'
+    )
+    key = models.CharField(max_length=64)
+    location = models.CharField(max_length=255)
+    created = models.DateTimeField(auto_now_add=True)
+    expires = models.DateTimeField(db_index=True)
+
+    objects = IdempotencyKeyManager()
+
+    def __str__(self):
+        return f'{self.key}'
+
+    class Meta:
+        db_table = 'idempotency_key'
+        unique_together = ('user', 'key')
+
+
+ROLLUP_KEY_FIELDS = (
+    'day', 'province_id', 'city_id', 'district_id', 'sub_district_id', 'disease_type', 'classification_case'
+)
+# region ids of the cases with no region; 0 rather than NULL, which would defeat the unique key
+ROLLUP_UNKNOWN_REGION = 0
+
+
+def get_rollup_key(case_information: CaseInformation):
+    """ The rollup cell a case is counted in, None for the cases that are not counted (inactive).
+    """
+    if not case_information.is_active or case_information.created is None:
+        return None
+    return (
+        timezone.localtime(case_information.created).date(),
+        case_information.province_id or ROLLUP_UNKNOWN_REGION,
+        case_information.city_id or ROLLUP_UNKNOWN_REGION,
+        case_information.district_id or ROLLUP_UNKNOWN_REGION,
+        case_information.sub_district_id or ROLLUP_UNKNOWN_REGION,
+        case_information.disease_type,
+        case_information.classification_case,
+    )
+
+
+class CaseDailyRollupQuerySet(models.QuerySet):
+
+    def record(self, cases: list):
+        """ Counts newly created cases, e.g. the ones inserted by `bulk_create()`, which sends no signal.
+        """
+        self.apply(Counter(key for key in map(get_rollup_key, cases) if key is not None))
+
+    def apply(self, deltas: Counter):
+        """ Adds `delta` cases to each cell, creating the missing cells, in one statement.
+
+        The cells are written in key order, so that concurrent statements lock the rows they
+        share in the same order rather than deadlock.
+        """
+        deltas = sorted((key, delta) for key, delta in deltas.items() if delta)
+        if not deltas:
+            return
+        columns = ', '.join(ROLLUP_KEY_FIELDS)
+        placeholders = ', '.join(['(%s, %s, %s, %s, %s, %s, %s, %s)'] * len(deltas))
+        params = [param for key, delta in deltas for param in key + (delta,)]
+        with connections[self.db].cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO case_daily_rollup ({columns}, cases) VALUES {placeholders} '
+                f'ON CONFLICT ({columns}) DO UPDATE SET cases = case_daily_rollup.cases + EXCLUDED.cases',
+                params
+            )
+
+    def rebuild(self) -> int:
+        """ Recounts every cell from the `case_information` table.
+        """
+        columns = ', '.join(ROLLUP_KEY_FIELDS)
+        with transaction.atomic(using=self.db), connections[self.db].cursor() as cursor:
+            cursor.execute('DELETE FROM case_daily_rollup')
+            cursor.execute(
+                f'INSERT INTO case_daily_rollup ({columns}, cases) '
+                f'SELECT (created AT TIME ZONE %s)::date, '
+                f'COALESCE(province_id, %s), COALESCE(city_id, %s), COALESCE(district_id, %s), '
+                f'COALESCE(sub_district_id, %s), disease_type, classification_case, count(*) '
+                f'FROM case_information WHERE is_active GROUP BY 1, 2, 3, 4, 5, 6, 7',
+                [settings.TIME_ZONE] + [ROLLUP_UNKNOWN_REGION] * 4
+            )
+            return cursor.rowcount
+
+
+class CaseDailyRollup(models.Model):
+    """ Number of active cases per day, region, disease type and classification.
+
+    Kept up to date as cases are created and modified (see `update_case_rollup`), so that
+    case statistics are read from a few rollup rows rather than counted over every case.
+    Region ids are plain integers, `ROLLUP_UNKNOWN_REGION` for the cases without one.
+    """
+    day = models.DateField()
+    province_id = models.IntegerField()
+    city_id = models.IntegerField()
+    district_id = models.IntegerField()
+    sub_district_id = models.IntegerField()
+    disease_type = models.CharField(max_length=15, choices=DISEASE_TYPES)
+    classification_case = models.CharField(max_length=15, blank=True, choices=CLASSIFICATION_TYPES)
+    cases = models.IntegerField(default=0)
+
+    objects = CaseDailyRollupQuerySet.as_manager()
+
+    def __str__(self):
+        return f'{self.day} {self.sub_district_id} {self.disease_type}: {self.cases}'
+
+    class Meta:
+        db_table = 'case_daily_rollup'
+        unique_together = ROLLUP_KEY_FIELDS
+        indexes = [
+            models.Index(fields=['district_id', 'day'], name='rollup_district_day_idx'),
+        ]
 
 
 @receiver(post_save, sender=MessageInformation)
-def create_message(sender, instance: MessageInformation, created, **kwargs):
+def create_message(sender, instance: MessageInformation, created, using, **kwargs):
     if created:
-        case_information = {
-            'mi': instance.pk,
-            'ci': instance.case_information.pk,
-            'name': instance.case_information.name,
-            'gender': f'{instance.case_information.get_gender_display()}',
-            'age': instance.case_information.age,
-            'patient_contact': instance.case_information.patient_contact,
-            'disease_type': f'{instance.case_information.get_disease_type_display()}',
-            'case_report_type': f'{instance.case_information.get_case_report_type_display()}',
-            'classification_case': f'{instance.case_information.get_classification_case_display()}',
-            'address': instance.case_information.address,
-            'province': instance.case_information.province.name,
-            'city': instance.case_information.city.name,
-            'district': instance.case_information.district.name,
-            'sub_district': instance.case_information.sub_district.name,
-            'is_pregnant': instance.case_information.is_pregnant,
-        }
-        send_notification_email(instance.case_information.user, instance.destination_facility, case_information)
\ No newline at end of file
+        queue_notifications([instance], using=using)
+
+
+@receiver(pre_save, sender=CaseInformation)
+def capture_case_rollup_key(sender, instance: CaseInformation, raw, using, **kwargs):
+    if raw or instance._state.adding:
+        instance._previous_rollup_key = None
+        return
+    # locked until the save commits (see CaseInformation.save), so that concurrent updates of
+    # the case move it between rollup cells one after the other
+    previous = CaseInformation.all_objects.using(using).select_for_update().filter(pk=instance.pk).only(
+        'is_active', 'created', 'province', 'city', 'district', 'sub_district', 'disease_type', 'classification_case'
+    ).first()
+    instance._previous_rollup_key = get_rollup_key(previous) if previous is not None else None
+
+
+@receiver(post_save, sender=CaseInformation)
+def update_case_rollup(sender, instance: CaseInformation, raw, using, **kwargs):
+    if raw:
+        return
+    previous, current = getattr(instance, '_previous_rollup_key', None), get_rollup_key(instance)
+    if previous != current:
+        deltas = Counter()
+        if previous is not None:
+            deltas[previous] -= 1
+        if current is not None:
+            deltas[current] += 1
+        CaseDailyRollup.objects.using(using).apply(deltas)
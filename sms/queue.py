@@ -0,0 +1,325 @@
+"""
+Notification Queue
+==================
+
+Publishes the case notifications to the `EMAIL_NOTIF_QUEUE_NAME` queue, read by the
+`email_notification_subscribe` worker, when `settings.NOTIFICATION_BACKEND` is 'amqp'.
+
+Connections come from kombu's process-wide pool and stay open, so publishing does not pay
+a TCP and AMQP handshake.  The notifications of a transaction (all those of a request) are
+published together once it commits, with publisher confirms: the whole batch is written,
+then the broker's acks are awaited once, instead of a round trip per message.
+
+When the broker can't be reached, or does not confirm a message in time, the notifications
+are appended to a spill file (`settings.NOTIFICATION_SPILL_PATH`, one JSON body per line)
+and the broker is left alone for `RETRY_AFTER` seconds, so requests don't queue up behind
+connection timeouts; `replay_notification_spill` publishes them later.  Delivery is at
+least once: a batch that fails half-way is spilled whole.
+
+The notifications the worker fails to send are published again to a retry queue, one per
+delay of `settings.NOTIFICATION_RETRY_DELAYS`.  Those have no consumer: their messages
+expire after the delay and the broker dead-letters them back to the notification exchange.
+After the last retry, or on a permanent error, a notification goes to the dead letter queue
+(`<queue>.dead`), where `notification_dead_letters` lists and replays them.
+"""
+import fcntl
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from kombu import Connection, Exchange, Queue, Producer
+from kombu.exceptions import LimitExceeded
+from kombu.pools import connections
+
+NOTIFICATION_BACKEND_OUTBOX = 'outbox'
+NOTIFICATION_BACKEND_AMQP = 'amqp'
+NOTIFICATION_BACKENDS = (NOTIFICATION_BACKEND_OUTBOX, NOTIFICATION_BACKEND_AMQP)
+
+RETRY_AFTER = 30.0
+
+# headers of the notifications published again by the worker
+RETRIES_HEADER = 'x-retries'
+ERROR_HEADER = 'x-error'
+
+logger = logging.getLogger(__name__)
+
+
+def get_notification_backend() -> str:
+    backend = getattr(settings, 'NOTIFICATION_BACKEND', NOTIFICATION_BACKEND_OUTBOX)
+    if backend not in NOTIFICATION_BACKENDS:
+        raise ImproperlyConfigured(f'NOTIFICATION_BACKEND must be one of {", ".join(NOTIFICATION_BACKENDS)}.')
+    return backend
+
+
+def publish_on_commit(bodies: list, using: str=None):
+    """ Publishes the notification bodies once the current transaction commits, right away
+    outside of one.
+    """
+    if bodies:
+        transaction.on_commit(lambda: publish_or_spill(bodies), using=using)
+
+
+def publish_or_spill(bodies: list):
+    """ Publishes the notification bodies, spilling them on any error: the transaction that
+    created them has committed already, so raising would only fail the response.
+    """
+    publisher = get_publisher()
+    try:
+        publisher.publish(bodies)
+    except Exception:
+        logger.exception('Cannot publish notifications, spilling %d', len(bodies))
+        try:
+            publisher.spill(bodies)
+        except Exception:
+            logger.exception('Cannot spill notifications, %d lost: %s', len(bodies),
+                             json.dumps(bodies, cls=DjangoJSONEncoder))
+
+
+def get_notification_queue(name: str) -> Queue:
+    return Queue(name, Exchange(name, type='direct'), routing_key=name)
+
+
+def get_retry_queues(name: str, delays: list) -> list:
+    """ The queues holding the notifications to send again, one per delay in seconds; their
+    messages expire into the notification queue.
+    """
+    return [
+        Queue(f'{name}.retry.{delay:g}', routing_key=f'{name}.retry.{delay:g}', queue_arguments={
+            'x-message-ttl': int(delay * 1000),
+            'x-dead-letter-exchange': name,
+            'x-dead-letter-routing-key': name,
+        })
+        for delay in delays
+    ]
+
+
+def get_dead_letter_queue(name: str) -> Queue:
+    return Queue(f'{name}.dead', routing_key=f'{name}.dead')
+
+
+class NotificationPublisher(object):
+
+    def __init__(self, url: str, queue_name: str, spill_path: str, confirm_timeout: float=5.0,
+                 retry_after: float=RETRY_AFTER):
+        self.connection = Connection(url, connect_timeout=confirm_timeout)
+        self.queue = get_notification_queue(queue_name)
+        self.exchange = self.queue.exchange
+        self.spill_path = spill_path
+        self.confirm_timeout = confirm_timeout
+        self.retry_after = retry_after
+        self.unavailable_until = 0.0
+
+    def publish(self, bodies: list) -> int:
+        """ Publishes a batch of notifications; the ones the broker did not take are spilled.
+
+        :return: the number of notifications the broker confirmed
+        """
+        if not bodies:
+            return 0
+        if time.monotonic() < self.unavailable_until:
+            self.spill(bodies)
+            return 0
+
+        errors = self.connection.connection_errors + self.connection.channel_errors + (OSError,)
+        unconfirmed = bodies
+        # a pooled connection may have been dropped while idle: retry once on a new one
+        for attempt in range(2):
+            try:
+                with connections[self.connection].acquire(block=True, timeout=self.confirm_timeout) as conn:
+                    try:
+                        unconfirmed = self._publish(conn, bodies)
+                    except errors:
+                        conn.collect()
+                        raise
+                break
+            except LimitExceeded:
+                logger.warning('No free broker connection, spilling %d notification(s)', len(bodies))
+                break
+            except errors as e:
+                if attempt:
+                    logger.warning('Cannot publish notifications, spilling %d: %s', len(bodies), e)
+                    self.unavailable_until = time.monotonic() + self.retry_after
+
+        if unconfirmed:
+            self.spill(unconfirmed)
+        return len(bodies) - len(unconfirmed)
+
+    def _publish(self, conn: Connection, bodies: list) -> list:
+        """ :return: the bodies that were not confirmed
+        """
+        # a single attempt; `default_channel` alone would retry connecting forever
+        conn.connect()
+        channel = conn.default_channel
+        # declared once per channel, i.e. again after a reconnection
+        producer = getattr(channel, 'notification_producer', None)
+        if producer is None:
+            self.queue(channel).declare()
+            producer = channel.notification_producer = Producer(
+                channel, exchange=self.exchange, routing_key=self.queue.routing_key,
+                serializer='json', auto_declare=False
+            )
+        confirms = ConfirmTracker.get(channel)
+
+        tags = {}
+        for body in bodies:
+            if confirms is not None:
+                tags[confirms.add()] = body
+            producer.publish(body, delivery_mode=2)
+
+        if confirms is None:
+            # in-memory transport, no confirms
+            return []
+        return [tags[tag] for tag in sorted(confirms.wait(conn, tags, self.confirm_timeout))]
+
+    def spill(self, bodies: list):
+        """ Appends the bodies to the spill file.
+        """
+        data = ''.join(json.dumps(body, cls=DjangoJSONEncoder) + '\n' for body in bodies)
+        with self.open_spill_file() as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def open_spill_file(self):
+        """ The spill file, open for appending and locked.
+        """
+        directory = os.path.dirname(self.spill_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        while True:
+            f = open(self.spill_path, 'a', encoding='utf-8')
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                # moved away by `replay()` while we were waiting for the lock
+                if os.path.exists(self.spill_path) and os.stat(self.spill_path).st_ino == os.fstat(f.fileno()).st_ino:
+                    return f
+            except OSError:
+                pass
+            f.close()
+
+    def replay(self, batch_size: int=500) -> tuple:
+        """ Publishes the spilled notifications again.
+
+        The spill file is moved aside first, so notifications spilled in the meantime (or
+        again) go to a new one.  Lines that are not valid JSON (e.g. cut short by a crash
+        while spilling) are logged and skipped.
+
+        :return: the numbers of notifications read, confirmed and skipped
+        """
+        if not os.path.exists(self.spill_path):
+            return 0, 0, 0
+        replay_path = f'{self.spill_path}.{os.getpid()}.replay'
+        with self.open_spill_file():
+            os.rename(self.spill_path, replay_path)
+            # writers waiting on the lock notice the rename when they get it; hold it until
+            # the replay is done so none of them writes to the file being replayed
+            self.unavailable_until = 0.0
+            read = confirmed = skipped = 0
+            batch = []
+            with open(replay_path, encoding='utf-8', errors='replace') as replayed:
+                for number, line in enumerate(replayed, start=1):
+                    if line.strip():
+                        try:
+                            batch.append(json.loads(line))
+                        except ValueError as e:
+                            logger.error('Skipping spilled notification on line %d, not valid JSON (%s): %r',
+                                         number, e, line[:500])
+                            skipped += 1
+                    if len(batch) >= batch_size:
+                        read, confirmed = read + len(batch), confirmed + self.publish(batch)
+                        batch = []
+            if batch:
+                read, confirmed = read + len(batch), confirmed + self.publish(batch)
+            os.remove(replay_path)
+        return read, confirmed, skipped
+
+
+class ConfirmTracker(object):
+    """ The publisher confirms of a channel, so that the acks of a whole batch can be awaited
+    at once.  Deliveries are numbered by the broker from 1 once the channel is in confirm mode.
+    """
+
+    def __init__(self):
+        self.last_tag = 0
+        self.pending = set()
+        self.nacked = set()
+
+    @classmethod
+    def get(cls, channel):
+        """ The tracker of the channel, which is put in confirm mode the first time; None for
+        the transports that don't support confirms.
+        """
+        if not hasattr(channel, 'confirm_select'):
+            return None
+        tracker = getattr(channel, 'notification_confirms', None)
+        if tracker is None:
+            channel.confirm_select()
+            tracker = channel.notification_confirms = cls()
+            channel.events['basic_ack'].add(tracker.on_ack)
+            channel.events['basic_nack'].add(tracker.on_nack)
+        return tracker
+
+    def add(self) -> int:
+        """ The delivery tag of the next message published on the channel.
+        """
+        self.last_tag += 1
+        self.pending.add(self.last_tag)
+        return self.last_tag
+
+    def on_ack(self, delivery_tag: int, multiple: bool):
+        self.settle(delivery_tag, multiple)
+
+    def on_nack(self, delivery_tag: int, multiple: bool):
+        self.nacked |= self.settle(delivery_tag, multiple)
+
+    def settle(self, delivery_tag: int, multiple: bool) -> set:
+        settled = {tag for tag in self.pending if tag <= delivery_tag} if multiple else self.pending & {delivery_tag}
+        self.pending -= settled
+        return settled
+
+    def wait(self, conn: Connection, tags, timeout: float) -> set:
+        """ Reads the acks of the given deliveries, for up to `timeout` seconds.
+
+        :return: the tags that were nacked, or not confirmed in time
+        """
+        tags = set(tags)
+        deadline = time.monotonic() + timeout
+        while self.pending & tags:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                conn.drain_events(timeout=remaining)
+            except socket.timeout:
+                break
+        failed = (self.pending | self.nacked) & tags
+        self.pending -= tags
+        self.nacked -= tags
+        return failed
+
+
+_publisher = None
+_publisher_lock = threading.Lock()
+
+
+def get_publisher() -> NotificationPublisher:
+    """ The publisher of this process.
+    """
+    global _publisher
+    if _publisher is None:
+        with _publisher_lock:
+            if _publisher is None:
+                _publisher = NotificationPublisher(
+                    settings.NOTIFICATION_BROKER_URL,
+                    settings.EMAIL_NOTIF_QUEUE_NAME,
+                    settings.NOTIFICATION_SPILL_PATH,
+                    confirm_timeout=settings.NOTIFICATION_CONFIRM_TIMEOUT,
+                )
+    return _publisher
@@ -0,0 +1,51 @@
+"""
+Notification Recipients
+=======================
+
+Resolves who a notification is from and to (the reporter, the destination facility and
+the emails of its members) from an in-process cache, so that building and sending a
+notification costs no query in steady state.
+
+The cache (users.cache) is invalidated whenever a user or a health facility is saved (see
+users.models).  As with the other versioned caches (utils.cache), that only reaches other
+processes, e.g. the `email_notification_subscribe` worker, with a shared cache backend;
+otherwise their entries are read again after `settings.RESPONSE_CACHE_MAX_AGE` seconds.
+"""
+from healthfacility.models import HealthFacility
+from users.cache import recipient_cache
+from users.models import User
+
+
+def get_user(pk: int=None, email: str=None) -> User:
+    """ The user with the given id or email, with its health facility; None if there is none.
+
+    The instance is shared: read it, don't change it.
+    """
+    if pk is not None:
+        key, lookup = f'user:{pk}', {'pk': pk}
+    else:
+        key, lookup = f'user-email:{email}', {'email': email}
+    return recipient_cache.get(
+        key, lambda: User.objects.select_related('health_facility').filter(**lookup).first()
+    )
+
+
+def get_facility(pk: int=None, code: str=None) -> HealthFacility:
+    """ The health facility with the given id or code, deactivated or not; None if there is none.
+
+    The instance is shared: read it, don't change it.
+    """
+    if pk is not None:
+        key, lookup = f'facility:{pk}', {'pk': pk}
+    else:
+        key, lookup = f'facility-code:{code}', {'code': code}
+    return recipient_cache.get(key, lambda: HealthFacility.all_objects.filter(**lookup).first())
+
+
+def get_recipients(facility_id: int) -> tuple:
+    """ The emails of the active members of a health facility.
+    """
+    return recipient_cache.get(f'recipients:{facility_id}', lambda: tuple(
+        User.objects.filter(health_facility_id=facility_id, is_active=True)
+        .exclude(email='').order_by('id').values_list('email', flat=True)
+    ))
@@ -0,0 +1,31 @@
+from sms.models import GENDER_TYPES, DISEASE_TYPES, CASE_TYPES, CLASSIFICATION_TYPES
+from utils.schema import RequestSchema, CharField, IntegerField, BooleanField, ChoiceField
+
+
+class CaseInformationUpdateSchema(RequestSchema):
+    """ Body of `PUT /case-information-list/<pk>`
+    """
+    name = CharField(max_length=50)
+    gender = ChoiceField(GENDER_TYPES, allow_blank=True)
+    age = IntegerField(null=True)
+    is_pregnant = BooleanField()
+    patient_contact = CharField(max_length=16, allow_blank=True, null=True)
+    disease_type = ChoiceField(DISEASE_TYPES)
+    case_report_type = ChoiceField(CASE_TYPES)
+    classification_case = ChoiceField(CLASSIFICATION_TYPES, allow_blank=True)
+    address = CharField(max_length=255, allow_blank=True, null=True)
+
+
+class CaseInformationSchema(CaseInformationUpdateSchema):
+    """ Body of `POST /case-information-list/`
+    """
+    province = IntegerField(null=True)
+    city = IntegerField(null=True)
+    district = IntegerField(null=True)
+    sub_district = IntegerField(null=True)
+
+
+class CaseInformationBatchItemSchema(CaseInformationSchema):
+    """ One case of `POST /case-information-batch/`
+    """
+    client_reference = CharField(max_length=64)
@@ -1,11 +1,15 @@
 from django.urls import path
 
 from sms.views import CaseInformationListAPI, CaseInformationDetailAPI, CaseInformationReceivedListAPI, \
-    CaseInformationSentListAPI
+    CaseInformationSentListAPI, CaseInformationBatchAPI, CaseStatisticsAPI, \
+    CaseInformationExportAPI
 
 urlpatterns = [
     path('case-information-list/', CaseInformationListAPI.as_view(), name='case_information_list'),
+    path('case-information-batch/', CaseInformationBatchAPI.as_view(), name='case_information_batch'),
     path('case-information-list/<int:pk>', CaseInformationDetailAPI.as_view(), name='case_information_details'),
     path('received-case-list/', CaseInformationReceivedListAPI.as_view(), name='received_case_list'),
     path('sent-case-list/', CaseInformationSentListAPI.as_view(), name='sent_case_list'),
+    path('case-statistics/', CaseStatisticsAPI.as_view(), name='case_statistics'),
+    path('case-information-export/', CaseInformationExportAPI.as_view(), name='case_information_export'),
 ]
\ No newline at end of file
@@ -1,112 +1,355 @@
 import json
+from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
 from http import HTTPStatus
 
-from django.db.models import Q
-from django.http import JsonResponse, HttpRequest, HttpResponse
+from django.db import transaction, IntegrityError
+from django.db.models import Sum
+from django.http import HttpRequest, HttpResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
 from django.urls import reverse
+from django.utils.dateparse import parse_date
+from rest_framework.exceptions import ParseError, PermissionDenied, ValidationError
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.views import APIView
 
 from healthfacility.models import HealthFacility
-from sms.helpers import send_notification_email
-from sms.models import CaseInformation, MessageInformation, MESSAGE_TYPE_INBOX, MESSAGE_TYPE_SENTBOX
-
-
-class CaseInformationListAPI(APIView):
+from masterdata.names import get_region_names
+from sms.models import CaseInformation, CaseDailyRollup, MessageInformation, IdempotencyKey, MESSAGE_TYPE_INBOX, \
+    MESSAGE_TYPE_SENTBOX, DISEASE_TYPES, CLASSIFICATION_TYPES
+from sms.export import EXPORT_FORMATS, EXPORT_REGION_FILTERS, get_export_queryset, iter_export
+from sms.schemas import CaseInformationSchema, CaseInformationUpdateSchema, CaseInformationBatchItemSchema
+from utils.drf import KeysetLinkHeaderPagination
+from utils.http import JsonResponse
+from utils.models import is_unique_violation
+
+
+MESSAGE_LIST_FIELDS = (
+    'case_information',
+    'case_information__name',
+    'case_information__patient_contact',
+    'case_information__disease_type',
+    'case_information__case_report_type',
+    'case_information__classification_case',
+    'case_information__created',
+    'created',
+    'origin_facility',
+    'origin_facility__name',
+    'destination_facility',
+    'destination_facility__name',
+)
+
+
+def get_case_destinations(origin_facility: HealthFacility, sub_district_ids) -> dict:
+    """ Routes the cases reported from `origin_facility`, per patient sub-district.
+
+    A case always goes to the facility the reporter's facility is linked to.  When the patient
+    lives in another sub-district than the reporter's facility, it also goes to every health
+    facility of the patient's sub-district.  The facilities of all the sub-districts are read
+    in one query.
+
+    :return: patient sub-district id -> destination facility ids
+    """
+    linked_facility_id = origin_facility.linked_facility_id if origin_facility else None
+    origin_sub_district_id = origin_facility.sub_district_id if origin_facility else ''
+
+    destinations = {sub_district_id: [linked_facility_id] for sub_district_id in sub_district_ids}
+    other_sub_district_ids = [pk for pk in destinations if pk != origin_sub_district_id]
+    if other_sub_district_ids:
+        facilities = HealthFacility.objects.filter(sub_district_id__in=other_sub_district_ids) \
+            .values_list('sub_district_id', 'id')
+        for sub_district_id, facility_id in facilities:
+            destinations[sub_district_id].append(facility_id)
+    return destinations
+
+
+def validate_case_regions(case):
+    """ Checks the region ids of a validated case payload against the region names
+    (masterdata.names), so that an unknown id is a 400 rather than a foreign key violation.
+    """
+    errors = {}
+    for level, names in get_region_names().items():
+        pk = getattr(case, level)
+        if pk is not None and pk not in names:
+            errors[level] = [f'Invalid pk "{pk}" - object does not exist.']
+    if errors:
+        raise ValidationError(errors)
+
+
+class CaseMessageListAPI(APIView, metaclass=ABCMeta):
+    """ Shared list engine for the case message feeds (inbox, sent and received).
+
+    Subclasses only decide which messages belong to the current health facility
+    (`get_querysets`).  The whole page is then fetched in a single query, joining the case
+    information and both facilities, and selecting only the columns that end up in the
+    response.  The messages of deactivated cases are left out.
+
+    Feeds are paginated on (created, id) with an opaque cursor, see
+    `utils.drf.KeysetLinkHeaderPagination`; the next page is linked from the Link header.
+    """
     permission_classes = (IsAuthenticated,)
+    pagination_class = KeysetLinkHeaderPagination
+    ordering = ('-created', '-id')
+    page_size = 100
+
+    @abstractmethod
+    def get_querysets(self, facility) -> list:
+        """ The branches of the feed; a feed made of several branches is paginated as
+        their union, each branch walking its own index.
+        """
 
-    def get(self, request):
-        """ Gets all case informations based on user's health facility
+    def get_feed_querysets(self, facility) -> list:
+        """ The branches of the feed, as they are paginated.
         """
+        return [
+            queryset
+            .filter(case_information__is_active=True)
+            .select_related('case_information', 'origin_facility', 'destination_facility')
+            .only(*MESSAGE_LIST_FIELDS)
+            for queryset in self.get_querysets(facility)
+        ]
+
+    def get(self, request):
         # get current health facility
         current_facility = self.request.user.health_facility
 
-        messageinformation = MessageInformation.objects.filter(Q(origin_facility=current_facility) |
-                                                               Q(destination_facility=current_facility)
-                                                               ).order_by('-created')
-        messageinformation = messageinformation[:100]
+        querysets = self.get_feed_querysets(current_facility)
 
-        resp_json = []
-        for c in messageinformation:
-            resp_json.append({
-                'id': c.case_information.id,
-                'name': c.case_information.name,
-                'patientContact': c.case_information.patient_contact,
-                'diseaseType': c.case_information.get_disease_type_display(),
-                'caseReportType': c.case_information.get_case_report_type_display(),
-                'classificationCase': c.case_information.get_classification_case_display(),
-                'healthFacilityFrom': c.origin_facility.name,
-                'healthFacilityTo': c.destination_facility.name,
-                'created': c.case_information.created,
-                'href': request.build_absolute_uri(
-                    reverse('case_information_details', kwargs={'pk': c.case_information.id})
-                ),
-            })
+        paginator = self.pagination_class(ordering=self.ordering, page_size=self.page_size)
+        messageinformation = paginator.paginate_union(querysets, request)
 
-        return JsonResponse(resp_json, safe=False)
+        resp_json = [self.serialize_message(request, c) for c in messageinformation]
 
-    def post(self, request: HttpRequest) -> HttpResponse:
-        ci = CaseInformation.objects.create(
-            name=json.loads(request.body)['name'],
-            gender=json.loads(request.body)['gender'],
-            age=json.loads(request.body)['age'],
-            is_pregnant=json.loads(request.body)['is_pregnant'],
-            patient_contact=json.loads(request.body)['patient_contact'],
-            disease_type=json.loads(request.body)['disease_type'],
-            case_report_type=json.loads(request.body)['case_report_type'],
-            classification_case=json.loads(request.body)['classification_case'],
-            address=json.loads(request.body)['address'],
-            province_id=json.loads(request.body)['province'],
-            city_id=json.loads(request.body)['city'],
-            district_id=json.loads(request.body)['district'],
-            sub_district_id=json.loads(request.body)['sub_district'],
-            user=self.request.user
-        )
-        MessageInformation.objects.create(
-            case_information=ci,
-            origin_facility=self.request.user.health_facility if self.request.user.health_facility else '',
-            destination_facility=self.request.user.health_facility.linked_facility if self.request.user.health_facility else '',
-            message_type=MESSAGE_TYPE_INBOX
-        )
+        response = JsonResponse(resp_json, safe=False)
+        for header, value in paginator.get_paginated_headers().items():
+            response[header] = value
+        return response
+
+    @staticmethod
+    def serialize_message(request, c: MessageInformation) -> dict:
+        return {
+            'id': c.case_information.id,
+            'name': c.case_information.name,
+            'patientContact': c.case_information.patient_contact,
+            'diseaseType': c.case_information.get_disease_type_display(),
+            'caseReportType': c.case_information.get_case_report_type_display(),
+            'classificationCase': c.case_information.get_classification_case_display(),
+            'healthFacilityFrom': c.origin_facility.name,
+            'healthFacilityTo': c.destination_facility.name,
+            'created': c.case_information.created,
+            'href': request.build_absolute_uri(
+                reverse('case_information_details', kwargs={'pk': c.case_information.id})
+            ),
+        }
+
+
+class CaseInformationListAPI(CaseMessageListAPI):
+
+    def get_querysets(self, facility) -> list:
+        """ Gets all case informations based on user's health facility
+
+        Read as the union of the sent and the received feed rather than as an OR, so that
+        each branch walks its own (facility, created) index.
+        """
+        return [
+            MessageInformation.objects.filter(origin_facility=facility),
+            MessageInformation.objects.filter(destination_facility=facility),
+        ]
 
-        patient_sub_district_id = json.loads(request.body)['sub_district']
-        origin_sub_district_id = self.request.user.health_facility.sub_district_id if self.request.user.health_facility else ''
-
-        if patient_sub_district_id != origin_sub_district_id:
-            check_other_hf = HealthFacility.objects.filter(sub_district_id=patient_sub_district_id)
-            for other_mi in check_other_hf:
-                MessageInformation.objects.create(
-                    case_information=ci,
-                    origin_facility=self.request.user.health_facility if self.request.user.health_facility else '',
-                    destination_facility=other_mi,
-                    message_type=MESSAGE_TYPE_INBOX
+    def post(self, request: HttpRequest) -> HttpResponse:
+        # a retried request carrying the same Idempotency-Key gets the original answer back,
+        # without going through the write path again (see sms.models.IdempotencyKey)
+        idempotency_key = request.META.get('HTTP_IDEMPOTENCY_KEY')
+        if idempotency_key:
+            location = IdempotencyKey.objects.lookup(self.request.user, idempotency_key)
+            if location is not None:
+                return self.created_response(location, replayed=True)
+
+        case = CaseInformationSchema.parse(request.body)
+        validate_case_regions(case)
+
+        # the case, its messages and their queued notifications (see
+        # sms.models.NotificationOutbox) are written in one transaction
+        try:
+            with transaction.atomic():
+                ci = CaseInformation.objects.create(
+                    name=case.name,
+                    gender=case.gender,
+                    age=case.age,
+                    is_pregnant=case.is_pregnant,
+                    patient_contact=case.patient_contact,
+                    disease_type=case.disease_type,
+                    case_report_type=case.case_report_type,
+                    classification_case=case.classification_case,
+                    address=case.address,
+                    province_id=case.province,
+                    city_id=case.city,
+                    district_id=case.district,
+                    sub_district_id=case.sub_district,
+                    user=self.request.user
                 )
+                origin_facility = self.request.user.health_facility
+                destination_facility_ids = get_case_destinations(origin_facility, [case.sub_district])[case.sub_district]
 
+                MessageInformation.objects.fan_out(ci, origin_facility, destination_facility_ids, MESSAGE_TYPE_INBOX)
 
-        # case_information = {
-        #     'mi': mi.pk,
-        #     'ci': ci.pk,
-        #     'name': ci.name,
-        #     'gender': f'{ci.get_gender_display()}',
-        #     'age': ci.age,
-        #     'patient_contact': ci.patient_contact,
-        #     'disease_type': f'{ci.get_disease_type_display()}',
-        #     'case_report_type': f'{ci.get_case_report_type_display()}',
-        #     'classification_case': f'{ci.get_classification_case_display()}',
-        #     'address': ci.address,
-        #     'is_pregnant': ci.is_pregnant,
-        # }
-        # send_notification_email(self.request.user, self.request.user, case_information)
+                if idempotency_key:
+                    IdempotencyKey.objects.remember(self.request.user, idempotency_key, ci.pk)
+        except IntegrityError:
+            # a concurrent request with the same key got there first
+            location = IdempotencyKey.objects.lookup(self.request.user, idempotency_key) if idempotency_key else None
+            if location is None:
+                raise
+            return self.created_response(location, replayed=True)
 
+        return self.created_response(ci.pk)
+
+    @staticmethod
+    def created_response(location, replayed: bool=False) -> HttpResponse:
         response = HttpResponse(status=HTTPStatus.CREATED)
-        response['Location'] = ci.pk
+        response['Location'] = location
+        if replayed:
+            response['Idempotent-Replayed'] = 'true'
         return response
 
 
+class CaseInformationBatchAPI(APIView):
+    """ Bulk case ingestion, for field devices that upload the cases they collected offline.
+
+    The body is either a JSON array or an NDJSON stream (`Content-Type: application/x-ndjson`)
+    of case payloads, each carrying a device generated `client_reference`.  Valid cases are
+    inserted in bulk, together with their messages and notifications, and the response
+    holds one result per item, in order.
+
+    Uploading a batch again is safe: cases whose `client_reference` is already known for
+    the user are reported as `duplicate` and not written twice.
+    """
+    permission_classes = (IsAuthenticated,)
+    max_batch_size = 500
+    ndjson_content_types = ('application/x-ndjson', 'application/ndjson')
+
+    def post(self, request: HttpRequest) -> HttpResponse:
+        items = self.get_items(request)
+        if len(items) > self.max_batch_size:
+            raise ValidationError({'non_field_errors': [f'A batch holds at most {self.max_batch_size} cases.']})
+
+        results, cases = [], OrderedDict()
+        for index, item in enumerate(items):
+            try:
+                case = CaseInformationBatchItemSchema.validate(item)
+                validate_case_regions(case)
+            except ValidationError as e:
+                results.append({
+                    'index': index,
+                    'clientReference': item.get('client_reference') if isinstance(item, dict) else None,
+                    'status': 'invalid',
+                    'errors': e.detail,
+                })
+                continue
+            result = {'index': index, 'clientReference': case.client_reference}
+            results.append(result)
+            cases.setdefault(case.client_reference, (case, []))[1].append(result)
+
+        for attempt in range(2):
+            try:
+                ids = self.create_cases(list(cases.values()))
+                break
+            except IntegrityError as e:
+                # a concurrent upload of the same batch won the race, its cases are now duplicates
+                if attempt or not is_unique_violation(e):
+                    raise
+
+        for client_reference, (case, case_results) in cases.items():
+            pk, created = ids[client_reference]
+            for result in case_results:
+                result.update({
+                    'status': 'created' if created else 'duplicate',
+                    'id': pk,
+                    'href': request.build_absolute_uri(reverse('case_information_details', kwargs={'pk': pk})),
+                })
+                # the same case repeated within the batch is only created once
+                created = False
+
+        return JsonResponse(results, safe=False)
+
+    def get_items(self, request) -> list:
+        if request.content_type.split(';')[0].strip() in self.ndjson_content_types:
+            items = []
+            for line in (request.stream or ()):
+                if not line.strip():
+                    continue
+                try:
+                    items.append(json.loads(line))
+                except ValueError as e:
+                    raise ParseError(f'NDJSON parse error on item {len(items)} - {e}')
+            return items
+
+        try:
+            items = json.loads(request.body)
+        except ValueError as e:
+            raise ParseError(f'JSON parse error - {e}')
+        if not isinstance(items, list):
+            raise ParseError('Expected a JSON array of cases.')
+        return items
+
+    def create_cases(self, cases: list) -> dict:
+        """ Inserts the cases that are not known yet, with their messages and notifications.
+
+        :param cases: (validated payload, results) pairs
+        :return: client reference -> (case id, whether it was created by this call)
+        """
+        user = self.request.user
+        origin_facility = user.health_facility
+
+        with transaction.atomic():
+            ids = {
+                client_reference: (pk, False) for client_reference, pk in
+                # a deactivated case still holds its client reference
+                CaseInformation.all_objects.filter(
+                    user=user,
+                    client_reference__in=[case.client_reference for case, _ in cases]
+                ).values_list('client_reference', 'id')
+            }
+
+            new_cases = CaseInformation.objects.bulk_create([
+                CaseInformation(
+                    name=case.name,
+                    gender=case.gender,
+                    age=case.age,
+                    is_pregnant=case.is_pregnant,
+                    patient_contact=case.patient_contact,
+                    disease_type=case.disease_type,
+                    case_report_type=case.case_report_type,
+                    classification_case=case.classification_case,
+                    address=case.address,
+                    province_id=case.province,
+                    city_id=case.city,
+                    district_id=case.district,
+                    sub_district_id=case.sub_district,
+                    client_reference=case.client_reference,
+                    user=user
+                )
+                for case, _ in cases if case.client_reference not in ids
+            ])
+
+            # bulk_create() sends no post_save
+            CaseDailyRollup.objects.record(new_cases)
+
+            destinations = get_case_destinations(origin_facility, {ci.sub_district_id for ci in new_cases})
+            MessageInformation.objects.fan_out_many(
+                origin_facility,
+                [(ci, destinations[ci.sub_district_id]) for ci in new_cases],
+                MESSAGE_TYPE_INBOX
+            )
+
+        ids.update((ci.client_reference, (ci.pk, True)) for ci in new_cases)
+        return ids
+
+
 class CaseInformationDetailAPI(APIView):
 
     def get(self, request, pk):
-        c = CaseInformation.objects.get(pk=pk)
+        c = get_object_or_404(CaseInformation.objects.select_related('user'), pk=pk)
         return JsonResponse({
             'name': c.name,
             'gender': c.get_gender_display(),
@@ -121,105 +364,166 @@ class CaseInformationDetailAPI(APIView):
         })
 
     def post(self, request, pk):
-        ci = CaseInformation.objects.get(pk=pk)
-        mi = MessageInformation.objects.create(
+        ci = get_object_or_404(CaseInformation.objects, pk=pk)
+        MessageInformation.objects.create(
             case_information=ci,
             origin_facility=self.request.user.health_facility if self.request.user.health_facility else '',
             destination_facility=self.request.user.health_facility.linked_facility if self.request.user.health_facility else '',
             message_type=MESSAGE_TYPE_SENTBOX
         )
-        case_information = {
-            'mi': mi.pk,
-            'ci': ci.pk,
-            'name': ci.name,
-            'gender': f'{ci.get_gender_display()}',
-            'age': ci.age,
-            'patient_contact': ci.patient_contact,
-            'disease_type': f'{ci.get_disease_type_display()}',
-            'case_report_type': f'{ci.get_case_report_type_display()}',
-            'classification_case': f'{ci.get_classification_case_display()}',
-            'address': ci.address,
-            'is_pregnant': ci.is_pregnant,
-        }
-        send_notification_email(self.request.user, self.request.user, case_information)
         return HttpResponse(status=HTTPStatus.OK)
 
     def put(self, request, pk):
-        c = CaseInformation.objects.get(pk=pk)
-        c.name = json.loads(request.body)['name']
-        c.gender = json.loads(request.body)['gender']
-        c.age = json.loads(request.body)['age']
-        c.is_pregnant = json.loads(request.body)['is_pregnant']
-        c.patient_contact = json.loads(request.body)['patient_contact']
-        c.disease_type = json.loads(request.body)['disease_type']
-        c.case_report_type = json.loads(request.body)['case_report_type']
-        c.classification_case = json.loads(request.body)['classification_case']
-        c.address = json.loads(request.body)['address']
+        case = CaseInformationUpdateSchema.parse(request.body)
+
+        c = get_object_or_404(CaseInformation.objects, pk=pk)
+        c.name = case.name
+        c.gender = case.gender
+        c.age = case.age
+        c.is_pregnant = case.is_pregnant
+        c.patient_contact = case.patient_contact
+        c.disease_type = case.disease_type
+        c.case_report_type = case.case_report_type
+        c.classification_case = case.classification_case
+        c.address = case.address
         c.save()
         return HttpResponse(status=HTTPStatus.OK)
 
 
-class CaseInformationSentListAPI(APIView):
-    permission_classes = (IsAuthenticated,)
+class CaseInformationSentListAPI(CaseMessageListAPI):
 
-    def get(self, request):
+    def get_querysets(self, facility) -> list:
         """ Gets sent case informations based on user's health facility
         """
-        # get current health facility
-        current_facility = self.request.user.health_facility
+        return [MessageInformation.objects.filter(origin_facility=facility)]
+
+
+class CaseInformationReceivedListAPI(CaseMessageListAPI):
+
+    def get_querysets(self, facility) -> list:
+        """ Gets received case informations based on user's health facility
+        """
+        return [MessageInformation.objects.filter(destination_facility=facility)]
+
+
+def get_case_filters(request) -> dict:
+    """ The region ids (`province`, `city`, `district`, `sub_district`) and days (`from`, `to`,
+    YYYY-MM-DD) given in the query string, validated.
+    """
+    filters = {}
+    for param in EXPORT_REGION_FILTERS:
+        value = request.GET.get(param)
+        if value:
+            if not value.isdigit():
+                raise ValidationError({param: ['A valid integer is required.']})
+            filters[param] = int(value)
+
+    for param in ('from', 'to'):
+        value = request.GET.get(param)
+        if value:
+            try:
+                day = parse_date(value)
+            except ValueError:
+                day = None
+            if day is None:
+                raise ValidationError({param: ['Date has wrong format. Use YYYY-MM-DD.']})
+            filters[param] = day
+    return filters
+
+
+class CaseStatisticsAPI(APIView):
+    """ Case counts, grouped by any of day, region, disease type and classification.
+
+    Answered from the `CaseDailyRollup` cells rather than from the cases themselves.
+
+    * `group_by`: comma separated, among day, province, city, district, sub_district,
+      disease_type and classification_case (default: day);
+    * `from`, `to`: first and last day (YYYY-MM-DD) counted;
+    * `province`, `city`, `district`, `sub_district`, `disease_type`, `classification_case`:
+      only count the matching cases.
+
+    Region ids are 0 for the cases reported without that region.
+    """
+    permission_classes = (IsAuthenticated,)
+    group_fields = OrderedDict([
+        # parameter, rollup field, response key
+        ('day', ('day', 'day')),
+        ('province', ('province_id', 'province')),
+        ('city', ('city_id', 'city')),
+        ('district', ('district_id', 'district')),
+        ('sub_district', ('sub_district_id', 'subDistrict')),
+        ('disease_type', ('disease_type', 'diseaseType')),
+        ('classification_case', ('classification_case', 'classificationCase')),
+    ])
+    choice_filters = {
+        'disease_type': [value for value, _ in DISEASE_TYPES],
+        # '' counts the cases not classified yet
+        'classification_case': [''] + [value for value, _ in CLASSIFICATION_TYPES],
+    }
 
-        messageinformation = MessageInformation.objects.filter(origin_facility=current_facility).order_by('-created')
+    def get(self, request):
+        group_by = [param.strip() for param in request.GET.get('group_by', 'day').split(',') if param.strip()]
+        unknown = [param for param in group_by if param not in self.group_fields]
+        if unknown or not group_by:
+            raise ValidationError({'group_by': [f'Group by any of {", ".join(self.group_fields)}.']})
+        fields = [self.group_fields[param][0] for param in group_by]
 
-        messageinformation = messageinformation[:100]
+        rollups = CaseDailyRollup.objects.filter(**self.get_filters(request))
+        cells = rollups.values(*fields).annotate(total=Sum('cases')).filter(total__gt=0).order_by(*fields)
 
         resp_json = []
-        for c in messageinformation:
-            resp_json.append({
-                'id': c.case_information.id,
-                'name': c.case_information.name,
-                'patientContact': c.case_information.patient_contact,
-                'diseaseType': c.case_information.get_disease_type_display(),
-                'caseReportType': c.case_information.get_case_report_type_display(),
-                'classificationCase': c.case_information.get_classification_case_display(),
-                'healthFacilityFrom': c.origin_facility.name,
-                'healthFacilityTo': c.destination_facility.name,
-                'created': c.case_information.created,
-                'href': request.build_absolute_uri(
-                    reverse('case_information_details', kwargs={'pk': c.case_information.id})
-                ),
-            })
+        for cell in cells:
+            item = {self.group_fields[param][1]: cell[field] for param, field in zip(group_by, fields)}
+            item['cases'] = cell['total']
+            resp_json.append(item)
 
         return JsonResponse(resp_json, safe=False)
 
+    def get_filters(self, request) -> dict:
+        case_filters = get_case_filters(request)
+        filters = {f'{param}_id': case_filters[param] for param in EXPORT_REGION_FILTERS if param in case_filters}
+        for param, lookup in (('from', 'day__gte'), ('to', 'day__lte')):
+            if param in case_filters:
+                filters[lookup] = case_filters[param]
 
-class CaseInformationReceivedListAPI(APIView):
-    permission_classes = (IsAuthenticated,)
+        for param, choices in self.choice_filters.items():
+            value = request.GET.get(param)
+            if value is not None:
+                if value not in choices:
+                    raise ValidationError({param: [f'"{value}" is not a valid choice.']})
+                filters[param] = value
+        return filters
 
-    def get(self, request):
-        """ Gets received case informations based on user's health facility
-        """
-        # get current health facility
-        current_facility = self.request.user.health_facility
 
-        messageinformation = MessageInformation.objects.filter(destination_facility=current_facility).order_by( '-created')
+class CaseInformationExportAPI(APIView):
+    """ Streams the active cases, oldest first, for the surveillance reports.
 
-        messageinformation = messageinformation[:100]
+    Staff export every case; the members of a health facility only the cases it sent or
+    received.
 
-        resp_json = []
-        for c in messageinformation:
-            resp_json.append({
-                'id': c.case_information.id,
-                'name': c.case_information.name,
-                'patientContact': c.case_information.patient_contact,
-                'diseaseType': c.case_information.get_disease_type_display(),
-                'caseReportType': c.case_information.get_case_report_type_display(),
-                'classificationCase': c.case_information.get_classification_case_display(),
-                'healthFacilityFrom': c.origin_facility.name,
-                'healthFacilityTo': c.destination_facility.name,
-                'created': c.case_information.created,
-                'href': request.build_absolute_uri(
-                    reverse('case_information_details', kwargs={'pk': c.case_information.id})
-                ),
-            })
+    * `type`: csv (default) or ndjson;
+    * `from`, `to`: first and last day (YYYY-MM-DD) of the cases' creation;
+    * `province`, `city`, `district`, `sub_district`: only export the cases of a region.
+    """
+    permission_classes = (IsAuthenticated,)
 
-        return JsonResponse(resp_json, safe=False)
+    def get(self, request):
+        export_format = request.GET.get('type', 'csv')
+        if export_format not in EXPORT_FORMATS:
+            raise ValidationError({'type': [f'Export as any of {", ".join(EXPORT_FORMATS)}.']})
+
+        filters = get_case_filters(request)
+        date_from, date_to = filters.pop('from', None), filters.pop('to', None)
+        if request.user.is_staff:
+            facility = None
+        elif request.user.health_facility_id is not None:
+            facility = request.user.health_facility_id
+        else:
+            raise PermissionDenied('Only the staff and the members of a health facility can export cases.')
+
+        response = StreamingHttpResponse(
+            iter_export(get_export_queryset(date_from, date_to, facility=facility, **filters), export_format),
+            content_type=EXPORT_FORMATS[export_format]
+        )
+        response['Content-Disposition'] = f'attachment; filename="cases.{export_format}"'
+        return response
@@ -0,0 +1,5 @@
+from utils.cache import VersionedResponseCache
+
+# users and their health facilities, as notification recipients (see sms.recipients);
+# invalidated whenever a user or a health facility is saved (see users.models)
+recipient_cache = VersionedResponseCache('recipients', max_entries=4096)
@@ -1,9 +1,12 @@
 from django.contrib.auth.models import AbstractUser, UserManager
 from django.contrib.postgres.fields import JSONField
 from django.db import models
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from django.urls import reverse
 
 from healthfacility.models import HealthFacility
+from users.cache import recipient_cache
 
 
 class UserManager(UserManager):
@@ -67,4 +70,15 @@ class User(AbstractUser):
     #     return reverse('users:user:user-profiles', kwargs={'username': self.username})
 
     class Meta:
-        db_table = 'user'
\ No newline at end of file
+        db_table = 'user'
+
+
+@receiver(post_save, sender=User)
+@receiver(post_save, sender=HealthFacility)
+@receiver(post_delete, sender=User)
+@receiver(post_delete, sender=HealthFacility)
+def invalidate_recipient_cache(sender, update_fields=None, **kwargs):
+    # a login only stamps last_login
+    if update_fields is not None and set(update_fields) <= {'last_login'}:
+        return
+    recipient_cache.invalidate(using=kwargs.get('using'))
@@ -1,3 +1,23 @@
-from django.test import TestCase
+from django.test import TransactionTestCase
 
-# Create your tests here.
+from healthfacility.models import HealthFacility
+from users.cache import recipient_cache
+from users.models import User
+
+
+class RecipientCacheTest(TransactionTestCase):
+
+    def test_saving_users_and_facilities_invalidates(self):
+        version = recipient_cache.get_version()
+        facility = HealthFacility.objects.create(name='Puskesmas', code='H1', facility_level='2')
+        self.assertGreater(recipient_cache.get_version(), version)
+
+        version = recipient_cache.get_version()
+        user = User.objects.create_user(email='petugas@puskesmas.test', password='secret', phone_number='0811',
+                                        health_facility=facility)
+        self.assertGreater(recipient_cache.get_version(), version)
+
+        # a login only stamps last_login
+        version = recipient_cache.get_version()
+        user.save(update_fields=['last_login'])
+        self.assertEqual(recipient_cache.get_version(), version)
@@ -7,10 +7,11 @@ from rest_framework.views import APIView
 from rest_framework_jwt.serializers import JSONWebTokenSerializer
 from rest_framework_jwt.settings import api_settings
 from rest_framework_jwt.views import jwt_response_payload_handler
-from django.http import JsonResponse, HttpRequest, HttpResponse
+from django.http import HttpRequest, HttpResponse
 from rest_framework.permissions import IsAuthenticated
 
 from users.models import User
+from utils.http import JsonResponse
 
 
 class ObtainJSONWebToken(APIView):
@@ -0,0 +1,172 @@
+"""
+Response Caching
+================
+
+In-process caches for read-mostly endpoints.
+
+Responses are kept already serialized, with a strong ETag computed from their bytes,
+so a hit neither touches the database nor re-encodes any JSON; a client revalidating
+with `If-None-Match` gets a bodyless 304.
+
+Each cache is a namespace with a version number, bumped whenever the underlying data
+changes (usually from a post_save receiver), once the transaction that changed it has
+committed.  The version lives in Django's cache, so that with a shared cache backend
+(`CACHE_BACKEND` in the settings) a save in one process invalidates every process; with
+the default local-memory backend it only reaches the process that saved.  Either way,
+entries are built again once they are older than `max_age` seconds
+(`settings.RESPONSE_CACHE_MAX_AGE` by default), so that no process serves them forever;
+a `max_age` of 0 (or less) turns the caching off.
+"""
+import gzip
+import hashlib
+import itertools
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.http import parse_etags
+
+from utils.metrics import measure_serialization
+
+
+class CachedResponse(object):
+    """ A serialized response body and its strong ETag.
+
+    With `compress`, a gzip-compressed copy of the body is prepared once, up front, and
+    served to the clients that accept it.  `headers` (e.g. pagination links) are sent
+    along with the body.
+    """
+    def __init__(self, body: bytes, content_type: str='application/json', compress: bool=False,
+                 headers: dict=None):
+        self.body = body
+        self.content_type = content_type
+        self.headers = headers or {}
+        self.version = hashlib.sha1(body).hexdigest()
+        self.etag = f'"{self.version}"'
+        self.gzip_body = gzip.compress(body, compresslevel=9) if compress else None
+        # a strong ETag identifies the bytes, so the compressed copy gets its own
+        self.gzip_etag = f'"{self.version}-gzip"' if compress else None
+
+    @classmethod
+    def from_json(cls, data, compress: bool=False, headers: dict=None) -> 'CachedResponse':
+        with measure_serialization():
+            body = json.dumps(data, cls=DjangoJSONEncoder).encode('utf-8')
+        return cls(body, compress=compress, headers=headers)
+
+
+class VersionedResponseCache(object):
+    """ A bounded, versioned, in-process cache of `CachedResponse` objects.
+
+    .. code-block:: python
+
+        region_cache = VersionedResponseCache('masterdata')
+
+        entry = region_cache.get('province-list', lambda: CachedResponse.from_json(build()))
+        return cached_response(request, entry)
+
+        # whenever the data changes
+        region_cache.invalidate()
+
+    Any value can be stored, `CachedResponse` objects or not, None included.
+    """
+    def __init__(self, namespace: str, max_entries: int=256, max_age: float=None):
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.max_age = settings.RESPONSE_CACHE_MAX_AGE if max_age is None else max_age
+        self._entries = OrderedDict()
+        self._version = None
+        self._lock = threading.Lock()
+        self._uncached = itertools.count()
+
+    @property
+    def version_key(self) -> str:
+        return f'response-cache:{self.namespace}:version'
+
+    def get_version(self) -> int:
+        version = cache.get(self.version_key)
+        if version is None:
+            cache.add(self.version_key, 1, timeout=None)
+            version = cache.get(self.version_key, 1)
+        return version
+
+    def get_generation(self) -> tuple:
+        """ The current version, and the number of `max_age` periods elapsed in this process:
+        the key of data derived from the same tables as the cache (e.g. an in-memory index),
+        to be built again when it changes.  Without caching, it changes on every call.
+        """
+        if self.max_age <= 0:
+            return self.get_version(), next(self._uncached)
+        return self.get_version(), int(time.monotonic() // self.max_age)
+
+    def invalidate(self, using: str=None):
+        """ Bumps the version once the current transaction commits, right away outside of one,
+        so that no process builds its entries again from data it cannot see yet.
+        """
+        transaction.on_commit(self._invalidate, using=using)
+
+    def _invalidate(self):
+        try:
+            cache.incr(self.version_key)
+        except ValueError:
+            cache.set(self.version_key, 1, timeout=None)
+        with self._lock:
+            self._entries.clear()
+            self._version = None
+
+    def get(self, key: str, builder) -> CachedResponse:
+        """ The entry stored under `key` for the current version, built by calling `builder()`
+        on a miss.
+        """
+        if self.max_age <= 0:
+            return builder()
+        version = self.get_version()
+        now = time.monotonic()
+        with self._lock:
+            if self._version != version:
+                self._entries.clear()
+                self._version = version
+            stored = self._entries.get(key)
+            if stored is not None and now - stored[1] < self.max_age:
+                self._entries.move_to_end(key)
+                return stored[0]
+
+        entry = builder()
+        with self._lock:
+            # don't store what was built from data that has changed in the meantime
+            if self._version == version:
+                self._entries[key] = (entry, now)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return entry
+
+
+def cached_response(request, entry: CachedResponse) -> HttpResponse:
+    """ Serves a cached entry, or a 304 when the client already holds it.
+    """
+    use_gzip = entry.gzip_body is not None and \
+        'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', '')
+    etag = entry.gzip_etag if use_gzip else entry.etag
+
+    if {entry.etag, entry.gzip_etag} & set(parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))):
+        response = HttpResponseNotModified()
+    elif use_gzip:
+        response = HttpResponse(entry.gzip_body, content_type=entry.content_type)
+        response['Content-Encoding'] = 'gzip'
+    else:
+        response = HttpResponse(entry.body, content_type=entry.content_type)
+
+    for header, value in entry.headers.items():
+        response[header] = value
+    if entry.gzip_body is not None:
+        response['Vary'] = 'Accept-Encoding'
+    response['ETag'] = etag
+    # clients may keep a copy, but must revalidate it
+    response['Cache-Control'] = 'no-cache'
+    return response
@@ -7,16 +7,21 @@ to provide for our use cases within our application.
 """
 from datetime import datetime
 
+import json
 import uuid
 import warnings
+from base64 import b64decode, b64encode
 from calendar import timegm
 from django.conf import settings
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db.models import Q
 from django.utils.translation import get_language_from_request
 from djangorestframework_camel_case.render import CamelCaseJSONRenderer
 from rest_framework import pagination, permissions
+from rest_framework.exceptions import NotFound
 from rest_framework.permissions import BasePermission
 from rest_framework.response import Response
-from rest_framework.utils.urls import replace_query_param
+from rest_framework.utils.urls import replace_query_param, remove_query_param
 from rest_framework_jwt.compat import get_username_field, get_username
 from rest_framework_jwt.settings import api_settings
 
@@ -91,6 +96,162 @@ class LinkHeaderPagination(pagination.PageNumberPagination):
         return Response(data, headers=headers)
 
 
+class KeysetLinkHeaderPagination(object):
+    """ Keyset (a.k.a. 'cursor') pagination that returns its navigation data in the
+    same HTTP Link header format as `LinkHeaderPagination`.
+
+    Instead of an OFFSET, the client sends back an opaque cursor holding the ordering
+    values of the last item it has seen, and the next page is fetched with a row
+    comparison on those values.  Every page therefore costs the same, however deep
+    it is, and a cursor stays valid across reconnects, so a client can resume a feed
+    from the last cursor it received.
+
+    The ordering must be unique (finish it with the primary key) for the cursor to
+    be unambiguous.  Only 'next' and 'first' links are emitted; a total count would
+    defeat the purpose of not scanning the skipped rows.
+    """
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'per_page'
+    page_size = 100
+    max_page_size = 250
+    ordering = ('-created', '-id')
+    invalid_cursor_message = 'Invalid cursor'
+
+    def __init__(self, ordering: tuple=None, page_size: int=None):
+        if ordering is not None:
+            self.ordering = ordering
+        if page_size is not None:
+            self.page_size = page_size
+        self.request = None
+        self.cursor = None
+        self.next_position = None
+
+    def paginate_queryset(self, queryset, request) -> list:
+        return self.get_page(self._fetch(queryset, request))
+
+    def paginate_union(self, querysets: list, request) -> list:
+        """ Paginates the union of several querysets of the same model.
+
+        Each queryset is paginated on its own, so that an `a OR b` filter can be served
+        by one index range scan per branch rather than by sorting every matching row;
+        the branches are then merged and de-duplicated here.  Every ordering field must
+        sort in the same direction.
+        """
+        results = {}
+        for queryset in querysets:
+            results.update((obj.pk, obj) for obj in self._fetch(queryset, request))
+        results = sorted(
+            results.values(),
+            key=lambda obj: [self._get_value(obj, field) for field in self.ordering],
+            reverse=self.ordering[0].startswith('-'))
+        return self.get_page(results)
+
+    def _fetch(self, queryset, request) -> list:
+        """ Fetches the rows after the requested cursor, plus one to tell whether there
+        is a next page at all.
+        """
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.cursor = request.query_params.get(self.cursor_query_param)
+
+        queryset = queryset.order_by(*self.ordering)
+        if self.cursor:
+            queryset = queryset.filter(self.get_keyset_filter(self.decode_cursor(self.cursor, queryset.model)))
+
+        return list(queryset[:self.page_size + 1])
+
+    def get_page(self, results: list) -> list:
+        """ Trims the 'one extra' row off an ordered result list, remembering where the
+        next page has to start.
+        """
+        page = results[:self.page_size]
+        if len(results) > self.page_size:
+            self.next_position = [self._get_value(page[-1], field) for field in self.ordering]
+        return page
+
+    def get_page_size(self, request) -> int:
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(page_size, 1), self.max_page_size)
+
+    def get_keyset_filter(self, position: list) -> Q:
+        """ Builds the row comparison `(a, b) < (x, y)` as `a <= x AND (a < x OR (a = x AND b < y))`.
+
+        The redundant leading bound is what lets the database seek straight to the cursor
+        in an index on the ordering, instead of filtering every row before it.
+        """
+        keyset_filter = Q()
+        for index, field in enumerate(self.ordering):
+            name = field.lstrip('-')
+            lookup = 'lt' if field.startswith('-') else 'gt'
+            condition = Q(**{f'{name}__{lookup}': position[index]})
+            for previous_field, previous_value in zip(self.ordering[:index], position[:index]):
+                condition &= Q(**{previous_field.lstrip('-'): previous_value})
+            keyset_filter |= condition
+
+        first_field = self.ordering[0]
+        lookup = 'lte' if first_field.startswith('-') else 'gte'
+        return Q(**{f'{first_field.lstrip("-")}__{lookup}': position[0]}) & keyset_filter
+
+    def encode_cursor(self, position: list) -> str:
+        data = json.dumps([v.isoformat() if isinstance(v, datetime) else v for v in position])
+        return b64encode(data.encode('utf-8'), altchars=b'-_').decode('ascii')
+
+    def decode_cursor(self, cursor: str, model) -> list:
+        """ The ordering values held by a cursor, each parsed by its field of `model`, so that
+        a tampered cursor is answered with a 404 rather than reaching the database.
+        """
+        try:
+            position = json.loads(b64decode(cursor.encode('ascii'), altchars=b'-_', validate=True))
+        except (TypeError, ValueError, UnicodeError):
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(position, list) or len(position) != len(self.ordering):
+            raise NotFound(self.invalid_cursor_message)
+
+        values = []
+        for field, value in zip(self.ordering, position):
+            try:
+                value = model._meta.get_field(field.lstrip('-')).to_python(value)
+            except (DjangoValidationError, TypeError, ValueError):
+                raise NotFound(self.invalid_cursor_message)
+            if value is None:
+                raise NotFound(self.invalid_cursor_message)
+            values.append(value)
+        return values
+
+    def get_next_link(self) -> str:
+        if self.next_position is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.next_position))
+
+    def get_first_link(self) -> str:
+        if not self.cursor:
+            return None
+        url = self.request.build_absolute_uri()
+        return remove_query_param(url, self.cursor_query_param)
+
+    def get_paginated_headers(self) -> dict:
+        next_url = self.get_next_link()
+        first_url = self.get_first_link()
+
+        link_parts = []
+        if next_url is not None:
+            link_parts.append(LinkHeaderField(url=next_url, rel=LinkHeaderRel.next))
+        if first_url is not None:
+            link_parts.append(LinkHeaderField(url=first_url, rel=LinkHeaderRel.first))
+
+        if not link_parts:
+            return {}
+        return {'Link': ", ".join([str(link) for link in link_parts])}
+
+    @staticmethod
+    def _get_value(instance, field: str):
+        return getattr(instance, field.lstrip('-'))
+
+
 def convert_env_boolean(env_value: str) -> bool:
     """ Converts an envvar string into a boolean.  Rules: true/True/TRUE/t/T/1 -> True;  All others false
 
@@ -7,6 +7,10 @@ Helper classes to make working with HTTP-related values a little bit easier.
 from enum import Enum
 import re
 
+from django import http
+
+from utils.metrics import measure_serialization
+
 
 class LinkPaginationRel(Enum):
     first = 'first'
@@ -117,3 +121,12 @@ class MalformedLinkHeader(Exception):
     """ Raised when an HTTP link header is in an invalid format.
     """
     pass
+
+
+class JsonResponse(http.JsonResponse):
+    """ Django's `JsonResponse`, reporting the time spent encoding the data as the
+    serialization time of the request (see `utils.middleware.RequestMetricsMiddleware`).
+    """
+    def __init__(self, data, *args, **kwargs):
+        with measure_serialization():
+            super().__init__(data, *args, **kwargs)
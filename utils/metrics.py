@@ -0,0 +1,168 @@
+"""
+Request Metrics
+===============
+
+Per-request measurements (database queries, serialization, wall time), collected by
+`utils.middleware.RequestMetricsMiddleware`, and the in-process histograms they are
+aggregated in, exposed in the Prometheus text format by `metrics_view`.
+
+The histograms live in the memory of each server process: with several worker
+processes, every scrape reads the one worker that answered it.
+"""
+import hmac
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+_local = threading.local()
+
+
+class RequestMetrics(object):
+    """ What one request cost.  Durations in seconds.
+    """
+    __slots__ = ('started', 'queries', 'db_time', 'serialize_time', 'total_time')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.serialize_time = 0.0
+        self.total_time = 0.0
+
+    def execute_wrapper(self, execute, sql, params, many, context):
+        """ Counts and times the queries, see `connection.execute_wrapper()`.
+        """
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.db_time += time.perf_counter() - started
+
+    def finish(self):
+        self.total_time = time.perf_counter() - self.started
+
+    def get_server_timing(self) -> str:
+        app_time = max(self.total_time - self.db_time - self.serialize_time, 0.0)
+        return ', '.join([
+            f'db;dur={self.db_time * 1000:.2f};desc="{self.queries} queries"',
+            f'serialize;dur={self.serialize_time * 1000:.2f}',
+            f'app;dur={app_time * 1000:.2f}',
+            f'total;dur={self.total_time * 1000:.2f}',
+        ])
+
+
+def get_current_metrics():
+    """ The metrics of the request being served by this thread, if any.
+    """
+    return getattr(_local, 'metrics', None)
+
+
+def set_current_metrics(metrics):
+    _local.metrics = metrics
+
+
+@contextmanager
+def measure_serialization():
+    """ Adds the time spent in the block to the serialization time of the current request.
+    """
+    metrics = get_current_metrics()
+    if metrics is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.serialize_time += time.perf_counter() - started
+
+
+class Histogram(object):
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        # one count per bucket, plus +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class MetricsRegistry(object):
+    """ Request histograms, per route, method and status class (2xx, 4xx...).
+    """
+    histograms = (
+        # name, help, buckets, RequestMetrics attribute
+        ('http_request_duration_seconds', 'Wall time of the requests.', DURATION_BUCKETS, 'total_time'),
+        ('http_request_db_duration_seconds', 'Time spent in database queries.', DURATION_BUCKETS, 'db_time'),
+        ('http_request_serialize_duration_seconds', 'Time spent serializing the responses.',
+         DURATION_BUCKETS, 'serialize_time'),
+        ('http_request_db_queries', 'Database queries per request.', QUERY_COUNT_BUCKETS, 'queries'),
+    )
+
+    def __init__(self):
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, route: str, method: str, status: int, metrics: RequestMetrics):
+        labels = (route, method, f'{status // 100}xx')
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [Histogram(buckets) for _, _, buckets, _ in self.histograms]
+            for histogram, (_, _, _, attribute) in zip(series, self.histograms):
+                histogram.observe(getattr(metrics, attribute))
+
+    def render(self) -> str:
+        """ All the histograms, in the Prometheus text exposition format.
+        """
+        with self._lock:
+            series = [(labels, [(list(h.counts), h.sum) for h in histograms])
+                      for labels, histograms in sorted(self._series.items())]
+
+        lines = []
+        for index, (name, help_text, buckets, _) in enumerate(self.histograms):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} histogram')
+            for (route, method, status), values in series:
+                counts, total = values[index]
+                labels = f'route="{escape_label(route)}",method="{method}",status="{status}"'
+                cumulative = 0
+                for bound, count in zip(buckets + ('+Inf',), counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_sum{{{labels}}} {total}')
+                lines.append(f'{name}_count{{{labels}}} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+
+def escape_label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+registry = MetricsRegistry()
+
+
+def metrics_view(request):
+    """ The request histograms, for Prometheus to scrape.
+
+    When `settings.METRICS_TOKEN` is set, the scraper has to send it as a bearer token;
+    otherwise only the addresses of `settings.METRICS_INTERNAL_IPS` may scrape.
+    """
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    if token:
+        allowed = hmac.compare_digest(request.META.get('HTTP_AUTHORIZATION', ''), f'Bearer {token}')
+    else:
+        allowed = request.META.get('REMOTE_ADDR') in getattr(settings, 'METRICS_INTERNAL_IPS', ())
+    if not allowed:
+        return HttpResponseForbidden()
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,56 @@
+import time
+from contextlib import ExitStack
+
+from django.db import connections
+
+from utils.metrics import RequestMetrics, registry, get_current_metrics, set_current_metrics
+
+
+class RequestMetricsMiddleware(object):
+    """ Measures every request: number and duration of its database queries, serialization
+    time and wall time.
+
+    The measurements are sent back in a `Server-Timing` header, and added to the per-route
+    histograms of `utils.metrics.registry`.  Queries are counted by a database execute
+    wrapper, so the overhead is a couple of `perf_counter()` calls per query.  The body of a
+    streaming response is produced after the middleware is done: its queries are not counted.
+
+    Goes first in `settings.MIDDLEWARE`, to time the whole request.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        metrics = RequestMetrics()
+        set_current_metrics(metrics)
+        try:
+            with ExitStack() as stack:
+                for alias in connections:
+                    stack.enter_context(connections[alias].execute_wrapper(metrics.execute_wrapper))
+                response = self.get_response(request)
+        finally:
+            set_current_metrics(None)
+
+        metrics.finish()
+        response['Server-Timing'] = metrics.get_server_timing()
+        registry.observe(self.get_route(request), request.method, response.status_code, metrics)
+        return response
+
+    def process_template_response(self, request, response):
+        """ Times the rendering of the lazy responses (DRF's `Response`), which happens after the view.
+        """
+        metrics = get_current_metrics()
+        if metrics is not None:
+            started = time.perf_counter()
+
+            def rendered(response):
+                metrics.serialize_time += time.perf_counter() - started
+            response.add_post_render_callback(rendered)
+        return response
+
+    @staticmethod
+    def get_route(request) -> str:
+        match = getattr(request, 'resolver_match', None)
+        if match is None:
+            return 'unmatched'
+        return match.view_name or match._func_path
@@ -5,10 +5,11 @@ from json import JSONDecodeError
 
 from django.conf import settings
 from django.contrib.postgres.fields import JSONField
-from django.db import models
+from django.db import models, IntegrityError
 from django.db.models import Model
 from django.db.models.fields import SlugField
 from django.utils.text import slugify
+from psycopg2 import errorcodes
 
 
 def generate_slug(model_class: Model, base_text: str, tries=0) -> str:
@@ -112,6 +113,30 @@ class MultiLangCharField(JSONField):
         return super(MultiLangCharField, self).pre_save(model_instance, add)
 
 
+def is_unique_violation(error: IntegrityError) -> bool:
+    """ Whether an IntegrityError was raised by a unique constraint, rather than e.g. a foreign key.
+    """
+    return getattr(error.__cause__, 'pgcode', None) == errorcodes.UNIQUE_VIOLATION
+
+
+class ActiveManager(models.Manager):
+    """ Manager of the soft-deletable models (the ones whose `delete()` only clears `is_active`):
+    leaves the inactive rows out.
+
+    Declared first, as `objects`, it makes every query read live rows only; declare a plain
+    `models.Manager()` as `all_objects` next to it for the queries that need every row.
+
+    .. code-block:: python
+
+        class HealthFacility(models.Model):
+            ...
+            objects = ActiveManager()
+            all_objects = models.Manager()
+    """
+    def get_queryset(self):
+        return super().get_queryset().filter(is_active=True)
+
+
 class TimestampedModel(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     modified = models.DateTimeField(auto_now=True)
@@ -0,0 +1,169 @@
+"""
+Request Schemas
+===============
+
+A small, declarative way of validating JSON request bodies without going through
+a full DRF serializer.
+
+A schema is compiled once, when its class is created: the declared fields are
+collected into a flat tuple and a namedtuple type is built for the result.  Parsing a
+request then decodes the body once, runs every field over the decoded object and
+returns an immutable, typed payload.
+
+.. code-block:: python
+
+    class PatientSchema(RequestSchema):
+        name = CharField(max_length=50)
+        gender = ChoiceField(GENDER_TYPES, allow_blank=True)
+        age = IntegerField(null=True)
+
+    patient = PatientSchema.parse(request.body)
+    patient.name
+
+Any problem is reported as a DRF `ParseError` (400) for an undecodable body, or a
+`ValidationError` (400) listing every invalid field.
+"""
+import json
+from collections import namedtuple
+
+from rest_framework.exceptions import ParseError, ValidationError
+
+
+class Field(object):
+    """ Base schema field: checks presence and nullability, then hands the value to `to_python`.
+    """
+    default_error_messages = {
+        'required': 'This field is required.',
+        'null': 'This field may not be null.',
+        'invalid': 'Invalid value.',
+    }
+
+    def __init__(self, required: bool=True, null: bool=False, default=None):
+        self.required = required
+        self.null = null
+        self.default = default
+        self.name = None
+
+    def clean(self, data: dict):
+        try:
+            value = data[self.name]
+        except KeyError:
+            if self.required:
+                raise FieldError(self.default_error_messages['required'])
+            return self.default
+        if value is None:
+            if not self.null:
+                raise FieldError(self.default_error_messages['null'])
+            return None
+        return self.to_python(value)
+
+    def to_python(self, value):
+        return value
+
+
+class CharField(Field):
+    def __init__(self, max_length: int=None, allow_blank: bool=False, **kwargs):
+        super(CharField, self).__init__(**kwargs)
+        self.max_length = max_length
+        self.allow_blank = allow_blank
+
+    def to_python(self, value) -> str:
+        if not isinstance(value, str):
+            raise FieldError('Not a valid string.')
+        if not value and not self.allow_blank:
+            raise FieldError('This field may not be blank.')
+        if self.max_length is not None and len(value) > self.max_length:
+            raise FieldError(f'Ensure this field has no more than {self.max_length} characters.')
+        return value
+
+
+class IntegerField(Field):
+    def to_python(self, value) -> int:
+        # bool is an int subclass, but `true` is never a valid id or age
+        if isinstance(value, bool):
+            raise FieldError('A valid integer is required.')
+        if isinstance(value, int):
+            return value
+        # as DRF does, 3.0 is an integer but 3.7 is not truncated to one
+        if isinstance(value, float):
+            if not value.is_integer():
+                raise FieldError('A valid integer is required.')
+            return int(value)
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            raise FieldError('A valid integer is required.')
+
+
+class BooleanField(Field):
+    def to_python(self, value) -> bool:
+        if isinstance(value, bool):
+            return value
+        if value in (0, 1):
+            return bool(value)
+        raise FieldError('Must be a valid boolean.')
+
+
+class ChoiceField(CharField):
+    """ Accepts only the keys of a django `choices` tuple.
+    """
+    def __init__(self, choices: tuple, **kwargs):
+        super(ChoiceField, self).__init__(**kwargs)
+        self.choices = frozenset(key for key, _ in choices)
+
+    def to_python(self, value) -> str:
+        value = super(ChoiceField, self).to_python(value)
+        if value and value not in self.choices:
+            raise FieldError(f'"{value}" is not a valid choice.')
+        return value
+
+
+class RequestSchema(object):
+    """ Base class of the request schemas; see the module documentation.
+    """
+    fields = ()
+    payload_class = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        fields = {}
+        for klass in reversed(cls.__mro__):
+            for name, field in vars(klass).items():
+                if isinstance(field, Field):
+                    field.name = name
+                    fields[name] = field
+        cls.fields = tuple(fields.values())
+        cls.payload_class = namedtuple(f'{cls.__name__}Payload', [field.name for field in cls.fields])
+
+    @classmethod
+    def parse(cls, body: bytes):
+        """ Decodes a JSON request body and validates it.
+        """
+        try:
+            data = json.loads(body)
+        except (TypeError, ValueError) as e:
+            raise ParseError(f'JSON parse error - {e}')
+        return cls.validate(data)
+
+    @classmethod
+    def validate(cls, data: dict):
+        """ Validates an already decoded object, returning the typed payload.
+        """
+        if not isinstance(data, dict):
+            raise ValidationError({'non_field_errors': ['Expected a JSON object.']})
+
+        values, errors = [], {}
+        for field in cls.fields:
+            try:
+                values.append(field.clean(data))
+            except FieldError as e:
+                errors[field.name] = [str(e)]
+        if errors:
+            raise ValidationError(errors)
+        return cls.payload_class(*values)
+
+
+class FieldError(Exception):
+    """ Raised by a schema field when its value is invalid.
+    """
+    pass
@@ -0,0 +1,89 @@
+"""
+SMTP Sink
+=========
+
+A minimal SMTP server that accepts every email and throws it away, counting it, to
+benchmark the senders without a real mail server.
+
+Each connection is served by its own thread.  `latency` seconds are waited before each
+email is accepted, standing in for the time a real server takes to queue it.  Setting
+`data_reply` to e.g. '451 4.7.1 rate limited' makes it refuse the emails instead.
+"""
+import socketserver
+import threading
+import time
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host: str='127.0.0.1', port: int=0, latency: float=0.0):
+        super().__init__((host, port), SMTPSinkHandler)
+        self.latency = latency
+        self.data_reply = '250 queued'
+        self.lock = threading.Lock()
+        self.connections = self.emails = self.recipients = 0
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def start(self) -> 'SMTPSink':
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def reset(self):
+        with self.lock:
+            self.connections = self.emails = self.recipients = 0
+
+
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        self.reply('220 smtpsink ready')
+        recipients = 0
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.split(b' ', 1)[0].strip().upper()
+            if command == b'EHLO':
+                self.reply('250-smtpsink', '250 8BITMIME')
+            elif command in (b'HELO', b'NOOP'):
+                self.reply('250 ok')
+            elif command in (b'MAIL', b'RSET'):
+                recipients = 0
+                self.reply('250 ok')
+            elif command == b'RCPT':
+                recipients += 1
+                self.reply('250 ok')
+            elif command == b'DATA':
+                self.reply('354 end data with <CR><LF>.<CR><LF>')
+                for data in iter(self.rfile.readline, b''):
+                    if data in (b'.\r\n', b'.\n'):
+                        break
+                if server.latency:
+                    time.sleep(server.latency)
+                reply = server.data_reply
+                if reply.startswith('2'):
+                    with server.lock:
+                        server.emails += 1
+                        server.recipients += recipients
+                recipients = 0
+                self.reply(reply)
+            elif command == b'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('502 command not implemented')
+
+    def reply(self, *lines: str):
+        self.wfile.write(''.join(f'{line}\r\n' for line in lines).encode('ascii'))